@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Measures the run time of Database.objects() with and without model ids.
+
+By default, a synthetic FRGC tree with 12000 training signatures of 3000 clients, 4000 targets and 2000 queries is generated in a temporary directory;
+use ``--database`` to run the benchmark on the original FRGC data instead.
+The lists and masks are loaded before the timing starts, so that only the queries themselves are measured.
+
+Usage::
+
+  python benchmarks/objects.py [--database DIR] [--clients N] [--runs N]
+"""
+
+import os, sys
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy
+
+import bob.db.frgc
+
+
+def write_list(list_file, signatures, complex=False):
+  """Writes the given (client, [(presentation, path)]) signatures as an FRGC signature set."""
+  tag = 'complex-biometric-signature' if complex else 'biometric-signature'
+  with open(list_file, 'w') as f:
+    f.write('<?xml version="1.0"?>\n<biometric-signature-set>\n')
+    for client, presentations in signatures:
+      f.write(' <%s name="nd1S%05d">\n' % (tag, client))
+      for presentation, path in presentations:
+        f.write('  <presentation name="nd1R%s" modality="face" file-name="%s" file-format="jpeg"/>\n' % (presentation, path))
+      f.write(' </%s>\n' % tag)
+    f.write('</biometric-signature-set>\n')
+
+
+def create_tree(base_dir, clients, seed=3):
+  """Creates a synthetic FRGC tree with 4 training signatures per client, and 4 targets and 2 queries per client for a third of the clients."""
+  list_dir = os.path.join(base_dir, 'BEE_DIST', 'FRGC2.0', 'signature_sets', 'experiments')
+  os.makedirs(list_dir)
+  counter = [100]
+
+  def presentation(client, semester):
+    counter[0] += 1
+    presentation = '%05dd%d' % (client, counter[0])
+    return presentation, '%s/%s.jpg' % (semester, presentation)
+
+  dev_clients = range(10, 10 + clients // 3)
+  training = [(c, [presentation(c, 'Fall2002')]) for c in range(1, clients + 1) for _ in range(4)]
+  targets = [(c, [presentation(c, 'Spring2003')]) for c in dev_clients for _ in range(4)]
+  target_sets = [(targets[i][0], [targets[i + j][1][0] for j in range(4)]) for i in range(0, len(targets), 4)]
+  queries = [(c, [presentation(c, 'Spring2004')]) for c in dev_clients for _ in range(2)]
+  write_list(os.path.join(list_dir, 'FRGC_Exp_2.0.1_Training.xml'), training)
+  write_list(os.path.join(list_dir, 'FRGC_Exp_2.0.1_Target.xml'), targets)
+  write_list(os.path.join(list_dir, 'FRGC_Exp_2.0.2_Target.xml'), target_sets, complex=True)
+  write_list(os.path.join(list_dir, 'FRGC_Exp_2.0.4_Target.xml'), targets)
+  write_list(os.path.join(list_dir, 'FRGC_Exp_2.0.4_Query.xml'), queries)
+
+  random_state = numpy.random.RandomState(seed)
+  for experiment, (rows, columns) in (('1', (targets, targets)), ('2', (target_sets, target_sets)), ('4', (queries, targets))):
+    mask_dir = os.path.join(base_dir, 'BEE_DIST', 'FRGC2.0', 'Experiment' + experiment, 'output')
+    os.makedirs(mask_dir)
+    mask_iii = (random_state.rand(len(rows), len(columns)) < 0.5) * 0xff
+    mask_iii[:, ::5] = 0
+    mask_i = (random_state.rand(len(rows), len(columns)) < 0.5) * 0x7f
+    mask_i[::3] = 0
+    for mask_type, mask in (('maskI', mask_i), ('maskII', numpy.maximum(mask_i, mask_iii)), ('maskIII', mask_iii)):
+      bob.db.frgc.write_matrix(os.path.join(mask_dir, mask_type + '.mtx'), mask.astype(numpy.uint8), 'FRGC_target.xml', 'FRGC_query.xml', matrix_type='B')
+
+
+def benchmark(name, function, runs):
+  """Prints the mean run time of the given function over the given number of runs."""
+  start = time.perf_counter()
+  for _ in range(runs):
+    result = function()
+  print("%-36s %10.1f ms  (%d files)" % (name, (time.perf_counter() - start) / runs * 1000., len(result)))
+
+
+def main(command_line_parameters = None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('-d', '--database', help="The FRGC base directory to use; by default, a synthetic tree is generated.")
+  parser.add_argument('-c', '--clients', type=int, default=3000, help="The number of training clients of the synthetic tree.")
+  parser.add_argument('-r', '--runs', type=int, default=3, help="The number of runs, over which the run time is averaged.")
+  args = parser.parse_args(command_line_parameters)
+
+  temp_dir = None
+  base_dir = args.database
+  if base_dir is None:
+    temp_dir = tempfile.mkdtemp(prefix='frgc_benchmark_')
+    base_dir = os.path.join(temp_dir, 'FRGC')
+    create_tree(base_dir, args.clients)
+  try:
+    db = bob.db.frgc.Database(base_dir)
+    clients = db.client_ids(groups='world')
+    models = db.model_ids(groups='dev', protocol='2.0.1')
+    models_4 = db.model_ids(groups='dev', protocol='2.0.4')
+    # load all lists and masks before timing
+    db.objects(groups='world')
+    db.objects(groups='dev')
+    print("%d training clients, %d models of 2.0.1, %d models of 2.0.4" % (len(clients), len(models), len(models_4)))
+
+    benchmark("world, %d client ids" % len(clients[::2]), lambda: db.objects(groups='world', model_ids=clients[::2]), args.runs)
+    benchmark("dev 2.0.1, %d model ids" % len(models[::2]), lambda: db.objects(groups='dev', protocol='2.0.1', model_ids=models[::2]), args.runs)
+    benchmark("dev 2.0.4, %d model ids" % len(models_4[::2]), lambda: db.objects(groups='dev', protocol='2.0.4', model_ids=models_4[::2]), args.runs)
+    benchmark("world, no model ids", lambda: db.objects(groups='world'), args.runs)
+    benchmark("dev 2.0.4, no model ids", lambda: db.objects(groups='dev', protocol='2.0.4'), args.runs)
+  finally:
+    if temp_dir is not None:
+      shutil.rmtree(temp_dir)
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
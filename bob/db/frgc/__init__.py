@@ -5,7 +5,7 @@
 """
 
 from .query import Database
-from .models import File, FileSet
+from .models import File, FileSet, MatrixWriter, read_matrix, write_matrix
 from .driver import Interface
 
 
@@ -36,6 +36,9 @@ __appropriate__(
     File,
     FileSet,
     Interface,
+    MatrixWriter,
+    read_matrix,
+    write_matrix,
     )
 
 
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""An asyncio interface to the FRGC database, which can be used inside of event loops.
+"""
+
+import asyncio
+
+from .models import get_list, get_mask, list_key, load_annotations
+from .query import Database
+
+
+class AsyncDatabase:
+  """Provides awaitable versions of the queries of the :py:class:`bob.db.frgc.Database`.
+
+  All blocking work, i.e., reading and parsing the lists, masks and annotations, as well as the queries themselves, is run in an executor, so that the event loop is never blocked.
+  Concurrent requests that require the same list, mask or annotations share a single load.
+
+  Keyword Parameters:
+
+  database
+    The :py:class:`bob.db.frgc.Database` to wrap; if not given, a new one is created with the given ``kwargs``.
+
+  executor
+    The :py:class:`concurrent.futures.Executor` to use; by default, the default executor of the event loop is used.
+    Since the data is shared through the module, a :py:class:`concurrent.futures.ThreadPoolExecutor` is required.
+  """
+
+  def __init__(self, database=None, executor=None, **kwargs):
+    self.m_database = database if database is not None else Database(**kwargs)
+    self.m_executor = executor
+    # the loads that are running or have finished, indexed by what is loaded
+    self.m_loads = {}
+
+  @property
+  def database(self):
+    """The wrapped (synchronous) database."""
+    return self.m_database
+
+  async def _run(self, function, *args, **kwargs):
+    """Runs the given function in the executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.m_executor, lambda: function(*args, **kwargs))
+
+  async def _load(self, key, function, *args):
+    """Runs the given load function in the executor, unless the same load is already running or has finished."""
+    future = self.m_loads.get(key)
+    if future is None:
+      loop = asyncio.get_running_loop()
+      future = loop.run_in_executor(self.m_executor, function, *args)
+      self.m_loads[key] = future
+
+      def forget_failed(future):
+        # failed loads are tried again by the next request
+        if future.cancelled() or future.exception() is not None:
+          self.m_loads.pop(key, None)
+      future.add_done_callback(forget_failed)
+    # a cancelled request must not cancel the load that other requests are waiting for
+    return await asyncio.shield(future)
+
+  async def _prepare(self, groups=None, protocol=None, purposes=None, mask_type='maskIII', annotations=False):
+    """Loads all lists and masks that are required by the given query in parallel."""
+    db = self.m_database
+    if db.m_client is not None:
+      # the query server has loaded everything already
+      return
+    directory = db.original_directory
+    groups = db.check_parameters_for_validity(groups, "group", db.m_groups)
+    loads = []
+    if 'world' in groups:
+      loads.append(self._load(list_key('world'), get_list, directory, 'world'))
+    if 'dev' in groups:
+      protocols = db.check_parameters_for_validity(protocol, "protocol", db.m_protocols)
+      purposes = db.check_parameters_for_validity(purposes, "purpose", db.m_purposes)
+      mask_type = db._check_mask_type(mask_type)
+      for p in protocols:
+        # the enrollment list is always required to select the probes
+        # 2.0.1 and 2.0.2 read enrollment and probe files from the same list, which must be loaded only once
+        for key, purpose in dict((list_key('dev', p, purpose), purpose) for purpose in set(purposes) | {'enroll'}).items():
+          loads.append(self._load(key, get_list, directory, 'dev', p, purpose))
+        # mask expressions are evaluated lazily, only the original masks are loaded in advance
+        if isinstance(mask_type, str):
+          loads.append(self._load(('mask', p, mask_type), get_mask, directory, p, mask_type))
+    if annotations:
+      loads.append(self._load(('annotations',), load_annotations, directory))
+    await asyncio.gather(*loads)
+
+  async def preload(self, groups=None, protocols=None, mask_types=None, annotations=True):
+    """Loads the lists, masks and annotations for the given groups, protocols and mask types (by default: all of them) in parallel."""
+    db = self.m_database
+    mask_types = db.check_parameters_for_validity(mask_types, "mask type", db.m_mask_types)
+    await asyncio.gather(*[self._prepare(groups, protocols, None, mask_type, annotations) for mask_type in mask_types])
+
+  async def client_ids(self, groups=None, protocol=None, purposes=None, mask_type='maskIII'):
+    """Awaitable version of :py:meth:`bob.db.frgc.Database.client_ids`."""
+    await self._prepare(groups, protocol, purposes, mask_type)
+    return await self._run(self.m_database.client_ids, groups, protocol, purposes, mask_type)
+
+  async def model_ids(self, groups=None, protocol=None, mask_type='maskIII', **kwargs):
+    """Awaitable version of :py:meth:`bob.db.frgc.Database.model_ids`."""
+    await self._prepare(groups, protocol, 'enroll', mask_type)
+    return await self._run(self.m_database.model_ids, groups, protocol, mask_type, **kwargs)
+
+  async def objects(self, groups=None, protocol=None, purposes=None, model_ids=None, mask_type='maskIII', **kwargs):
+    """Awaitable version of :py:meth:`bob.db.frgc.Database.objects`."""
+    await self._prepare(groups, protocol, purposes, mask_type)
+    return await self._run(self.m_database.objects, groups, protocol, purposes, model_ids, mask_type, **kwargs)
+
+  async def object_sets(self, groups=None, protocol='2.0.2', purposes=None, model_ids=None, mask_type='maskIII', **kwargs):
+    """Awaitable version of :py:meth:`bob.db.frgc.Database.object_sets`."""
+    await self._prepare(groups, protocol, purposes, mask_type)
+    return await self._run(self.m_database.object_sets, groups, protocol, purposes, model_ids, mask_type, **kwargs)
+
+  async def annotations(self, file):
+    """Awaitable version of :py:meth:`bob.db.frgc.Database.annotations`."""
+    db = self.m_database
+    if db.m_client is None and db.m_index is None:
+      # the query server and the SQLite index answer the query without the original annotations
+      await self._load(('annotations',), load_annotations, db.original_directory)
+    return await self._run(db.annotations, file)
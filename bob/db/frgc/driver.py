@@ -33,8 +33,8 @@ def dumplist(args):
       purposes=args.purpose,
       mask_type = 'maskII') # here we take mask II since this is the combination of mask I and mask III
 
-  for f in r:
-    output.write('%s\n' % f.make_path(args.directory, args.extension))
+  for path in db.file_paths(r, args.directory, args.extension):
+    output.write('%s\n' % path)
 
   return 0
 
@@ -54,17 +54,19 @@ def checkfiles(args):
 
   r = db.objects(mask_type = 'maskII') # here we take mask II since this is the combination of mask I and mask III
 
+  paths = db.file_paths(r, args.directory, args.extension)
+
+  if args.manifest:
+    return check_manifest(args, paths, output)
+
   # go through all files, check if they are available on the filesystem
-  good = {}
-  bad = {}
-  for f in r:
-    if os.path.exists(f.make_path(args.directory, args.extension)): good[f.id] = f
-    else: bad[f.id] = f
+  from .models import paths_exist
+  bad = [path for path, exists in zip(paths, paths_exist(paths)) if not exists]
 
   # report
   if bad:
-    for id, f in bad.items():
-      output.write('Cannot find file "%s"\n' % f.make_path(args.directory, args.extension))
+    for path in bad:
+      output.write('Cannot find file "%s"\n' % path)
     output.write('%d files (out of %d) were not found at "%s"\n' % \
         (len(bad), len(r), args.directory))
 
@@ -72,6 +74,83 @@ def checkfiles(args):
 
 
 
+def check_manifest(args, file_paths, output):
+  """Checks the files with the given paths against the manifest of sizes, modification times and digests, and writes the updated manifest"""
+
+  from .manifest import read_manifest, write_manifest, check_files
+
+  directory = args.directory or os.curdir
+  paths = [os.path.relpath(path, directory) for path in file_paths]
+
+  algorithm, manifest = args.algorithm or 'sha1', {}
+  if os.path.exists(args.manifest):
+    manifest_algorithm, manifest = read_manifest(args.manifest)
+    if args.algorithm is None or args.algorithm == manifest_algorithm:
+      algorithm = manifest_algorithm
+    elif not args.rehash:
+      print("The manifest '%s' uses the hash algorithm '%s'; use --rehash to hash all files again with '%s'." % (args.manifest, manifest_algorithm, args.algorithm))
+      return 1
+    else:
+      # the digests of the manifest cannot be compared with those of the new algorithm
+      manifest = {}
+
+  entries, missing, modified, hashed = check_files(paths, directory, manifest, algorithm, args.processes, args.rehash)
+
+  # keep the known entries of missing files, and of modified files unless the modifications are accepted
+  for path in missing:
+    if path in manifest:
+      entries[path] = manifest[path]
+  if not args.update:
+    for path in modified:
+      entries[path] = manifest[path]
+  write_manifest(args.manifest, algorithm, entries)
+
+  # report
+  for path in missing:
+    output.write('Cannot find file "%s"\n' % os.path.join(directory, path))
+  for path in modified:
+    output.write('The file "%s" differs from the manifest\n' % os.path.join(directory, path))
+  output.write('%d files checked, %d hashed, %d not found and %d modified; the manifest was written to "%s"\n' % \
+      (len(paths), hashed, len(missing), len(modified), args.manifest))
+
+  return 1 if missing or modified else 0
+
+
+
+def create(args):
+  """Creates the SQLite index of the FRGC lists, masks and annotations"""
+
+  from .sqlindex import create_index
+
+  if os.path.exists(args.sqlite_file):
+    if not args.recreate:
+      print("The SQLite index '%s' already exists; use --recreate to overwrite it." % args.sqlite_file)
+      return 1
+    os.remove(args.sqlite_file)
+
+  if args.verbose:
+    print("Creating the SQLite index '%s' from the FRGC database in '%s'" % (args.sqlite_file, args.database))
+  create_index(args.database, args.sqlite_file)
+
+  return 0
+
+
+
+def serve(args):
+  """Serves the FRGC queries from memory on a Unix domain socket"""
+
+  from .query import Database
+  from .server import serve as serve_queries
+
+  db = Database(args.database, sqlite_file=args.sqlite_file, mask_cache_directory=args.mask_cache_directory, cache_directory=args.cache_directory)
+  if args.verbose:
+    print("Loading the FRGC database from '%s' and serving it on '%s'" % (args.database, args.socket))
+  serve_queries(db, args.socket)
+
+  return 0
+
+
+
 class Interface(bob.db.base.driver.Interface):
 
   def name(self):
@@ -92,6 +171,16 @@ class Interface(bob.db.base.driver.Interface):
     You might want to adapt this directory to your needs."""
     return '/idiap/resource/database/frgc/FRGC-2.0-dist'
 
+  def sqlite_file(self):
+    """Returns the default location of the (optional) SQLite index, which can be created with the 'create' command."""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db.sql3')
+
+  def server_socket(self):
+    """Returns the default Unix domain socket of the query server, which can be started with the 'serve' command.
+    The socket is placed in a per-user directory, which is not writable by other users."""
+    from .server import socket_directory
+    return os.path.join(socket_directory(), 'bob.db.frgc.sock')
+
   def type(self):
     """Defines the type of the database, which is not SQL3, but text based"""
     return 'text'
@@ -118,5 +207,28 @@ class Interface(bob.db.base.driver.Interface):
     check_files_parser.add_argument('-D', '--database', default=self.frgc_database_directory(), help="The base directory of the FRGC database.")
     check_files_parser.add_argument('-d', '--directory', help="if given, this path will be prepended to every entry returned.")
     check_files_parser.add_argument('-e', '--extension', default='.jpg', help="if given, this extension will be appended to every entry returned.")
+    check_files_parser.add_argument('-M', '--manifest', help="if given, the files are hashed, and sizes, modification times and digests are verified against (or written to) this manifest file; only files with changed size or modification time are hashed again.")
+    check_files_parser.add_argument('-a', '--algorithm', help="the hash algorithm used for new manifests (default: sha1); the algorithm of an existing manifest is changed only together with --rehash.")
+    check_files_parser.add_argument('-P', '--processes', type=int, help="the number of processes used for hashing; by default, one per CPU.")
+    check_files_parser.add_argument('--rehash', action='store_true', help="hash all files, even if their size and modification time did not change; required to change the --algorithm of an existing manifest.")
+    check_files_parser.add_argument('--update', action='store_true', help="accept the digests of modified files into the manifest.")
     check_files_parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     check_files_parser.set_defaults(func=checkfiles) #action
+
+    # the "create" action
+    create_parser = subparsers.add_parser('create', help=create.__doc__)
+    create_parser.add_argument('-D', '--database', default=self.frgc_database_directory(), help="The base directory of the FRGC database.")
+    create_parser.add_argument('-s', '--sqlite-file', default=self.sqlite_file(), help="The SQLite index file to create.")
+    create_parser.add_argument('-R', '--recreate', action='store_true', help="If set, an existing SQLite index will be overwritten.")
+    create_parser.add_argument('-v', '--verbose', action='store_true', help="Print the progress.")
+    create_parser.set_defaults(func=create) #action
+
+    # the "serve" action
+    serve_parser = subparsers.add_parser('serve', help=serve.__doc__)
+    serve_parser.add_argument('-D', '--database', default=self.frgc_database_directory(), help="The base directory of the FRGC database.")
+    serve_parser.add_argument('-S', '--socket', default=self.server_socket(), help="The Unix domain socket to listen on; its directory must be owned by the current user and must not be writable by others.")
+    serve_parser.add_argument('-s', '--sqlite-file', help="If given, the queries are answered from this SQLite index.")
+    serve_parser.add_argument('-m', '--mask-cache-directory', help="If given, the masks are cached in this directory.")
+    serve_parser.add_argument('-c', '--cache-directory', help="If given, the lists, masks and annotations are cached in this directory, which can be shared with other processes; masks are cached in the --mask-cache-directory instead, if given.")
+    serve_parser.add_argument('-v', '--verbose', action='store_true', help="Print the progress.")
+    serve_parser.set_defaults(func=serve) #action
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Evaluation of full FRGC score matrices with the ROC I, II and III masks
+"""
+
+import os
+import math
+import collections
+import concurrent.futures
+import numpy
+
+from .models import client_codes
+
+
+def row_blocks(rows, block_size):
+  """Returns the list of (first, last) row ranges with the given block size."""
+  return [(first, min(first + block_size, rows)) for first in range(0, rows, block_size)]
+
+
+def map_blocks(function, blocks, parallel=None):
+  """Applies the given function to all blocks and yields the results in order.
+
+  If ``parallel`` is larger than 1, the blocks are processed by that many threads;
+  only twice as many blocks as threads are processed at the same time, so that memory stays bounded.
+  """
+  if parallel is None:
+    parallel = os.cpu_count() or 1
+  if parallel <= 1:
+    for block in blocks:
+      yield function(*block)
+    return
+
+  with concurrent.futures.ThreadPoolExecutor(parallel) as executor:
+    pending = collections.deque()
+    for block in blocks:
+      pending.append(executor.submit(function, *block))
+      if len(pending) >= 2 * parallel:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+
+def dyadic_level(low, high, bins):
+  """Returns the smallest level ``k``, for which the bins ``[i * 2**k, (i+1) * 2**k)`` cover the given score range with at most ``bins`` bins.
+  The level is also large enough that the bin indices of all scores in the range are exact integers."""
+  magnitude = max(abs(low), abs(high))
+  level = math.frexp(magnitude)[1] - 52 if magnitude > 0 else 0
+  if high > low:
+    level = max(level, math.frexp((high - low) / (bins - 1))[1])
+  while math.floor(math.ldexp(high, -level)) - math.floor(math.ldexp(low, -level)) >= bins:
+    level += 1
+  return level
+
+def coarsen(histogram, level):
+  """Returns the given dyadic histogram (level, offset, counts) at the given coarser level, by merging the counts of neighboring bins."""
+  old_level, offset, counts = histogram
+  if level == old_level:
+    return histogram
+  indices = (offset + numpy.arange(counts.shape[1], dtype=numpy.int64)) >> (level - old_level)
+  starts = numpy.flatnonzero(numpy.concatenate(([True], indices[1:] != indices[:-1])))
+  return level, int(indices[0]), numpy.add.reduceat(counts, starts, axis=1)
+
+def merge_histograms(first, second, bins):
+  """Merges two dyadic histograms (level, offset, counts), which might have different levels and offsets, into one with at most ``bins`` bins.
+  Since the bins of coarser levels are unions of bins of finer levels, the merged counts are exact."""
+  if first is None or second is None:
+    return second if first is None else first
+  level = max(first[0], second[0])
+  while True:
+    first, second = coarsen(first, level), coarsen(second, level)
+    offset = min(first[1], second[1])
+    end = max(first[1] + first[2].shape[1], second[1] + second[2].shape[1])
+    if end - offset <= bins:
+      break
+    level += 1
+  counts = numpy.zeros((first[2].shape[0], end - offset), dtype=numpy.int64)
+  for histogram in (first, second):
+    counts[:, histogram[1] - offset : histogram[1] - offset + histogram[2].shape[1]] += histogram[2]
+  return level, offset, counts
+
+
+def far_threshold_rank(impostors, far):
+  """Returns the number of impostor scores that might be accepted at the given false acceptance rate."""
+  return int(numpy.floor(far * impostors + 1e-9))
+
+
+def evaluate(scores, model_files, probe_files, masks, far_values=(0.001,), bins=65536, score_range=None, block_size=256, parallel=None, exact=True):
+  """Computes the ROC curves and verification rates at the given false acceptance rates for several masks at once.
+
+  The score matrix is processed in blocks of ``block_size`` rows.
+  For each block and mask, histograms of genuine and impostor scores are accumulated, so that no scores need to be sorted.
+  When the ``score_range`` is not given, the histograms use bins of width ``2**k``, whose level ``k`` is chosen per block and increased while merging the blocks,
+  so that the histograms of all blocks can be merged exactly without knowing the range of the scores in advance.
+  Hence, the score matrix is read only once, unless ``exact`` is enabled:
+  then, the verification rates are refined by a second pass over the score matrix, which keeps only the scores inside the histogram bins of the thresholds and selects the exact threshold by partial selection.
+
+  Keyword parameters:
+
+  scores
+    A 2D score matrix laid out like the masks (query x target), e.g., a memory-mapped matrix read by :py:func:`read_matrix`.
+
+  model_files, probe_files
+    The lists of FRGCFile's for the "Target" and "Query" lists, which define the genuine and impostor pairs.
+
+  masks
+    A dictionary of masks (of the same shape as ``scores``), which define the pairs to evaluate.
+    To evaluate all pairs, use the mask expression :py:class:`bob.db.frgc.masks.AllPairs`.
+
+  far_values
+    The false acceptance rates, at which the verification rates are computed; ``0.001`` is the standard FRGC operating point.
+
+  bins
+    The number of histogram bins; when no ``score_range`` is given, between ``bins/2`` and ``bins`` bins cover the range of the scores.
+
+  score_range
+    The (minimum, maximum) of the scores; if not given, it is determined while accumulating the histograms.
+
+  block_size
+    The number of score matrix rows that are processed at once.
+
+  parallel
+    The number of threads to use; by default, all available cores are used.
+
+  exact
+    Refine the thresholds and verification rates to their exact values.
+
+  Returns a dictionary, which contains for each mask a dictionary with the entries:
+
+  * ``'genuines'``, ``'impostors'``: the number of genuine and impostor scores
+  * ``'thresholds'``, ``'far'``, ``'vr'``: the points of the ROC curve at the lower edges of the histogram bins
+  * ``'vr_at_far'``: a dictionary mapping each far value to a tuple (threshold, far, vr)
+  """
+  shape = (len(probe_files), len(model_files))
+  if tuple(scores.shape) != shape:
+    raise ValueError("The score matrix of shape %s does not fit to the %d probes and %d models." % (scores.shape, shape[0], shape[1]))
+  if bins < 2:
+    raise ValueError("At least two histogram bins are required.")
+  for name, mask in masks.items():
+    if mask is None:
+      raise ValueError("The mask '%s' is None; to evaluate all pairs, please use the mask expression bob.db.frgc.masks.AllPairs()." % (name,))
+    if tuple(mask.shape) != shape:
+      raise ValueError("The mask '%s' of shape %s does not fit to the score matrix of shape %s." % (name, mask.shape, shape))
+
+  model_codes, probe_codes = client_codes(model_files, probe_files)
+  names = list(masks.keys())
+  blocks = row_blocks(shape[0], block_size)
+
+  def load(first, last):
+    """Returns the scores, the genuine labels and the valid pairs per mask for the given block of rows."""
+    block = numpy.asarray(scores[first:last], dtype=numpy.float64)
+    genuine = probe_codes[first:last, None] == model_codes[None, :]
+    finite = numpy.isfinite(block)
+    return block, genuine, [finite & (numpy.asarray(masks[name][first:last]) > 0) for name in names]
+
+  if score_range is None:
+    # one pass: dyadic histograms, which are merged across blocks
+    def histograms(first, last):
+      block, genuine, selected = load(first, last)
+      valid = numpy.logical_or.reduce(selected)
+      if not valid.any():
+        return None
+      values = block[valid]
+      level = dyadic_level(values.min(), values.max(), bins)
+      indices = numpy.zeros(block.shape, dtype=numpy.int64)
+      indices[valid] = numpy.floor(numpy.ldexp(values, -level))
+      offset = int(indices[valid].min())
+      indices -= offset
+      length = int(indices[valid].max()) + 1
+      counts = [numpy.bincount(indices[s & g], minlength=length) for s in selected for g in (genuine, ~genuine)]
+      return level, offset, numpy.array(counts, dtype=numpy.int64).reshape(2 * len(names), length)
+
+    histogram = None
+    for result in map_blocks(histograms, blocks, parallel):
+      histogram = merge_histograms(histogram, result, bins)
+    if histogram is None:
+      raise ValueError("None of the masks selects any valid score.")
+    level, offset, merged = histogram
+    bins = merged.shape[1]
+    counts = [[merged[2 * m], merged[2 * m + 1]] for m in range(len(names))]
+    low, scale = math.ldexp(offset, level), math.ldexp(1., -level)
+
+    def bin_indices(block):
+      with numpy.errstate(invalid='ignore'):
+        return numpy.clip(numpy.floor(numpy.ldexp(block, -level)), offset, offset + bins - 1).astype(numpy.int64) - offset
+
+  else:
+    low, high = score_range
+    if high <= low:
+      high = low + 1.
+    scale = bins / (high - low)
+
+    def bin_indices(block):
+      return numpy.clip(((block - low) * scale).astype(numpy.int64), 0, bins - 1)
+
+    # one pass: histograms of genuine and impostor scores for all masks
+    def histograms(first, last):
+      block, genuine, selected = load(first, last)
+      indices = bin_indices(block)
+      return [(numpy.bincount(indices[s & genuine], minlength=bins), numpy.bincount(indices[s & ~genuine], minlength=bins)) for s in selected]
+
+    counts = [[numpy.zeros(bins, numpy.int64), numpy.zeros(bins, numpy.int64)] for name in names]
+    for result in map_blocks(histograms, blocks, parallel):
+      for c, (genuine, impostor) in zip(counts, result):
+        c[0] += genuine
+        c[1] += impostor
+
+  thresholds = low + numpy.arange(bins) / scale
+  results = {}
+  requests = []
+  for m, name in enumerate(names):
+    # number of scores in or above each bin
+    genuines_above = numpy.cumsum(counts[m][0][::-1])[::-1]
+    impostors_above = numpy.cumsum(counts[m][1][::-1])[::-1]
+    genuines, impostors = int(genuines_above[0]), int(impostors_above[0])
+    result = {
+        'genuines' : genuines,
+        'impostors' : impostors,
+        'thresholds' : thresholds,
+        'far' : impostors_above / float(max(impostors, 1)),
+        'vr' : genuines_above / float(max(genuines, 1)),
+        'vr_at_far' : {},
+    }
+    for far in far_values:
+      rank = far_threshold_rank(impostors, far)
+      # the first bin, in which at most rank impostors are accepted
+      b = int(numpy.searchsorted(-impostors_above, -rank))
+      if b >= bins:
+        # all impostors can be accepted
+        result['vr_at_far'][far] = (low, impostors / float(max(impostors, 1)), genuines / float(max(genuines, 1)))
+        continue
+      result['vr_at_far'][far] = (thresholds[b], impostors_above[b] / float(max(impostors, 1)), genuines_above[b] / float(max(genuines, 1)))
+      if exact and b > 0:
+        # the threshold lies inside the bin below
+        above = int(impostors_above[b]), int(genuines_above[b])
+        requests.append((m, far, b - 1, rank - above[0], above))
+    results[name] = result
+
+  if requests:
+    # second pass: collect the scores inside the threshold bins
+    def collect(first, last):
+      block, genuine, selected = load(first, last)
+      indices = bin_indices(block)
+      collected = []
+      for m, far, b, rank, above in requests:
+        inside = selected[m] & (indices == b)
+        collected.append((block[inside & ~genuine], block[inside & genuine]))
+      return collected
+
+    inside = [([], []) for request in requests]
+    for result in map_blocks(collect, blocks, parallel):
+      for i, (impostor, genuine) in zip(inside, result):
+        i[0].append(impostor)
+        i[1].append(genuine)
+
+    for (m, far, b, rank, above), (impostor, genuine) in zip(requests, inside):
+      impostor = numpy.concatenate(impostor)
+      genuine = numpy.concatenate(genuine)
+      result = results[names[m]]
+      if rank < len(impostor):
+        # the (rank+1)-th largest impostor score inside this bin must be rejected
+        rejected = numpy.partition(impostor, len(impostor) - rank - 1)[len(impostor) - rank - 1]
+        threshold = numpy.nextafter(rejected, numpy.inf)
+      else:
+        threshold = thresholds[b]
+      accepted_impostors = above[0] + int((impostor >= threshold).sum())
+      accepted_genuines = above[1] + int((genuine >= threshold).sum())
+      result['vr_at_far'][far] = (threshold, accepted_impostors / float(max(result['impostors'], 1)), accepted_genuines / float(max(result['genuines'], 1)))
+
+  return results
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A cache of cropped faces, stored in memory-mapped shards
+"""
+
+import os
+import json
+import numpy
+
+# the default size of the cropped faces and the positions of the eyes in them
+default_crop_size = (80, 64)
+default_right_eye = (16, 15)
+default_left_eye = (16, 48)
+
+
+def to_gray(image):
+  """Converts the given color image in bob format (3, height, width) to gray scale."""
+  image = numpy.asarray(image, dtype=numpy.float64)
+  if image.ndim == 2:
+    return image
+  return 0.299 * image[0] + 0.587 * image[1] + 0.114 * image[2]
+
+
+def crop_face(image, annotations, crop_size=default_crop_size, right_eye=default_right_eye, left_eye=default_left_eye):
+  """Crops the face from the given image, so that the eyes of the given annotations end up at the given positions.
+
+  The image is rotated, scaled and cropped using bilinear interpolation.
+  Gray images have the shape (height, width), color images the shape (3, height, width) of bob.
+
+  Returns the cropped face as a 2D or 3D float array.
+  """
+  image = numpy.asarray(image, dtype=numpy.float64)
+  # the eye positions in the image and in the crop, as (y, x)
+  source_right, source_left = numpy.array(annotations['reye'], dtype=float), numpy.array(annotations['leye'], dtype=float)
+  target_right, target_left = numpy.array(right_eye, dtype=float), numpy.array(left_eye, dtype=float)
+
+  # similarity transform mapping crop coordinates to image coordinates
+  source, target = source_left - source_right, target_left - target_right
+  scale = numpy.hypot(*source) / numpy.hypot(*target)
+  angle = numpy.arctan2(source[0], source[1]) - numpy.arctan2(target[0], target[1])
+  cos, sin = scale * numpy.cos(angle), scale * numpy.sin(angle)
+
+  y, x = numpy.mgrid[0:crop_size[0], 0:crop_size[1]].astype(numpy.float64)
+  y -= target_right[0]
+  x -= target_right[1]
+  source_y = source_right[0] + sin * x + cos * y
+  source_x = source_right[1] + cos * x - sin * y
+
+  # bilinear interpolation, with replicated borders
+  height, width = image.shape[-2:]
+  source_y = numpy.clip(source_y, 0, height - 1)
+  source_x = numpy.clip(source_x, 0, width - 1)
+  y0 = numpy.minimum(numpy.floor(source_y).astype(int), height - 2 if height > 1 else 0)
+  x0 = numpy.minimum(numpy.floor(source_x).astype(int), width - 2 if width > 1 else 0)
+  y1, x1 = numpy.minimum(y0 + 1, height - 1), numpy.minimum(x0 + 1, width - 1)
+  dy, dx = source_y - y0, source_x - x0
+  return (image[..., y0, x0] * (1 - dy) * (1 - dx) + image[..., y0, x1] * (1 - dy) * dx
+          + image[..., y1, x0] * dy * (1 - dx) + image[..., y1, x1] * dy * dx)
+
+
+def build_face_cache(database, files, cache_dir, crop_size=default_crop_size, right_eye=default_right_eye, left_eye=default_left_eye, gray=True, dtype=numpy.uint8, shard_size=4096, directory=None, extension=None, loader=None, parallel=4):
+  """Decodes the images of the given files once, crops the faces using the eye annotations of the database and stores them in fixed-shape ``.npy`` shards.
+
+  The images are decoded in parallel using :py:meth:`bob.db.frgc.Database.load_images`.
+  All files need eye annotations; a ValueError naming the first file without them is raised before anything is written.
+  The cache is complete only after the ``info.json`` file has been written, which happens last.
+
+  Keyword parameters:
+
+  database
+    The :py:class:`bob.db.frgc.Database`, which provides the images and annotations.
+
+  files
+    The :py:class:`bob.db.frgc.File` objects to cache, e.g., ``database.objects()``.
+
+  cache_dir
+    The directory to write the cache to.
+
+  crop_size, right_eye, left_eye
+    The size of the cropped faces and the positions of the eyes in them, as (y, x).
+
+  gray
+    Convert color images to gray scale before cropping.
+
+  dtype
+    The data type of the stored faces; values are rounded and clipped for integral types.
+
+  shard_size
+    The number of faces per shard.
+
+  directory, extension, loader, parallel
+    Passed to :py:meth:`bob.db.frgc.Database.load_images`.
+
+  Returns: a :py:class:`FaceCache` for the written cache
+  """
+  files = list(files)
+  # check the annotations before any shard is written
+  annotations = []
+  for file in files:
+    try:
+      file_annotations = database.annotations(file)
+    except KeyError:
+      file_annotations = None
+    if not file_annotations or 'reye' not in file_annotations or 'leye' not in file_annotations:
+      raise ValueError("The file '%s' has no eye annotations, so its face cannot be cropped." % file.id)
+    annotations.append(file_annotations)
+
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  info_file = os.path.join(cache_dir, 'info.json')
+  if os.path.exists(info_file):
+    os.remove(info_file)
+
+  dtype = numpy.dtype(dtype)
+  shard = None
+  for index, (file, image) in enumerate(database.load_images(files, directory, extension, loader, parallel)):
+    if gray:
+      image = to_gray(image)
+    face = crop_face(image, annotations[index], crop_size, right_eye, left_eye)
+    if numpy.issubdtype(dtype, numpy.integer):
+      limits = numpy.iinfo(dtype)
+      face = numpy.clip(numpy.round(face), limits.min, limits.max)
+
+    if index % shard_size == 0:
+      # start a new shard
+      del shard
+      count = min(shard_size, len(files) - index)
+      shard = numpy.lib.format.open_memmap(os.path.join(cache_dir, 'faces_%05d.npy' % (index // shard_size)), mode='w+', dtype=dtype, shape=(count,) + face.shape)
+    shard[index % shard_size] = face
+  del shard
+
+  numpy.save(os.path.join(cache_dir, 'ids.npy'), numpy.array([file.id for file in files]))
+  with open(info_file, 'w') as f:
+    json.dump({'count' : len(files), 'shard_size' : shard_size, 'crop_size' : list(crop_size), 'right_eye' : list(right_eye), 'left_eye' : list(left_eye), 'gray' : gray, 'dtype' : dtype.str}, f)
+
+  return FaceCache(cache_dir)
+
+
+class FaceCache:
+  """Provides access to the faces stored by :py:func:`build_face_cache`, which are memory-mapped on need."""
+  def __init__(self, cache_dir):
+    info_file = os.path.join(cache_dir, 'info.json')
+    if not os.path.exists(info_file):
+      raise IOError("The face cache in '%s' does not exist or is incomplete." % cache_dir)
+    with open(info_file) as f:
+      self.m_info = json.load(f)
+    self.m_cache_dir = cache_dir
+    self.m_index = dict((file_id, index) for index, file_id in enumerate(numpy.load(os.path.join(cache_dir, 'ids.npy')).tolist()))
+    self.m_shards = {}
+
+  @property
+  def info(self):
+    """The parameters, with which the cache was built."""
+    return self.m_info
+
+  def __len__(self):
+    return len(self.m_index)
+
+  def __contains__(self, file):
+    return getattr(file, 'id', file) in self.m_index
+
+  def _shard(self, shard):
+    if shard not in self.m_shards:
+      self.m_shards[shard] = numpy.load(os.path.join(self.m_cache_dir, 'faces_%05d.npy' % shard), mmap_mode='r')
+    return self.m_shards[shard]
+
+  def __getitem__(self, file):
+    """Returns the (memory-mapped) face of the given File or file id."""
+    file_id = getattr(file, 'id', file)
+    if file_id not in self.m_index:
+      raise KeyError("The file id '%s' is not in the face cache." % file_id)
+    index = self.m_index[file_id]
+    shard_size = self.m_info['shard_size']
+    return self._shard(index // shard_size)[index % shard_size]
+
+  def faces(self, files):
+    """Returns the faces of the given Files (or file ids) as one array."""
+    return numpy.array([self[file] for file in files])
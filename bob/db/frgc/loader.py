@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Parallel loading of the FRGC images
+"""
+
+import collections
+import concurrent.futures
+
+from .models import resolve_paths
+
+
+def default_loader(path):
+  """Loads the image with the given path using :py:func:`bob.io.base.load`."""
+  import bob.io.base
+  return bob.io.base.load(path)
+
+
+def load_images(files, directory=None, extension='.jpg', loader=None, parallel=4, prefetch=16, processes=False):
+  """Loads the images of the given files in parallel and yields them in the order of the files.
+
+  The images are decoded by a pool of threads (or processes), while at most ``prefetch`` images are loaded ahead of the consumer,
+  so that memory stays bounded even for long lists of files.
+
+  Keyword parameters:
+
+  files
+    A list of :py:class:`bob.db.frgc.File` objects, e.g., as returned by :py:meth:`bob.db.frgc.Database.objects`.
+
+  directory
+    The base directory of the images.
+
+  extension
+    The file name extension of the images; '.jpg' files are automatically replaced by '.JPG' where needed.
+
+  loader
+    The function to load an image from its path; by default, :py:func:`bob.io.base.load` is used.
+    When ``processes`` is enabled, the loader must be picklable.
+
+  parallel
+    The number of threads or processes that load the images.
+
+  prefetch
+    The maximum number of images that are loaded ahead.
+
+  processes
+    If enabled, a process pool is used instead of a thread pool, which is useful for loaders that do not release the GIL.
+
+  Yields: tuples (file, image)
+  """
+  if loader is None:
+    loader = default_loader
+  prefetch = max(prefetch, 1)
+  executor_type = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+
+  # the full paths (including the '.jpg'/'.JPG' check) are resolved here, sharing one listing per directory
+  listings = {}
+
+  with executor_type(parallel) as executor:
+    pending = collections.deque()
+    try:
+      for file in files:
+        pending.append((file, executor.submit(loader, resolve_paths([file.path], directory, extension, listings)[0])))
+        if len(pending) >= prefetch:
+          file, future = pending.popleft()
+          yield file, future.result()
+      while pending:
+        file, future = pending.popleft()
+        yield file, future.result()
+    finally:
+      # do not load the remaining images when the consumer stops early
+      for file, future in pending:
+        future.cancel()
+
+
+def load_batches(batches, directory=None, extension='.jpg', loader=None, parallel=4, prefetch=16, processes=False):
+  """Loads the images of client-grouped batches of files, e.g., as yielded by :py:meth:`bob.db.frgc.Database.training_batches`, and yields them batch by batch.
+
+  The images of all batches are loaded as one stream by :py:func:`load_images`, so that the images of the next batch are prefetched while the current batch is processed.
+  The batches are consumed lazily, i.e., at most ``prefetch`` images beyond the current batch are loaded ahead.
+
+  Keyword parameters:
+
+  batches
+    An iterable of batches, where each batch is a list of lists of :py:class:`bob.db.frgc.File` objects, one list per client.
+
+  directory, extension, loader, parallel, prefetch, processes
+    See :py:func:`load_images`.
+
+  Yields: one list per batch, which contains one list of tuples (file, image) per client
+  """
+  # the number of files of each client in the batches that have been passed to the loader
+  lengths = collections.deque()
+
+  def files():
+    for batch in batches:
+      batch = [client_files for client_files in batch if client_files]
+      if batch:
+        lengths.append([len(client_files) for client_files in batch])
+        for client_files in batch:
+          for file in client_files:
+            yield file
+
+  batch, client, client_lengths = [], [], None
+  for item in load_images(files(), directory, extension, loader, parallel, prefetch, processes):
+    if client_lengths is None:
+      # the lengths of this batch have been recorded when its first file was passed to the loader
+      client_lengths = lengths.popleft()
+    client.append(item)
+    if len(client) == client_lengths[len(batch)]:
+      batch.append(client)
+      client = []
+      if len(batch) == len(client_lengths):
+        yield batch
+        batch, client_lengths = [], None
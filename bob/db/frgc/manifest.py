@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Integrity manifests of the FRGC image files, which store size, modification time and digest of each file
+"""
+
+import os
+import hashlib
+import concurrent.futures
+
+# the first line of each manifest file, followed by the name of the hash algorithm
+manifest_header = '# bob.db.frgc manifest'
+
+
+def file_digest(path, algorithm='sha1', block_size=1 << 20):
+  """Returns the hex digest of the contents of the given file."""
+  digest = hashlib.new(algorithm)
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def file_stat(path):
+  """Returns the size and modification time of the given file, or None if it does not exist."""
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return stat.st_size, stat.st_mtime
+
+
+def read_manifest(filename):
+  """Reads the given manifest file.
+
+  Returns: a tuple (algorithm, entries), where entries is a dictionary from relative path to (size, mtime, digest)
+  """
+  entries = {}
+  with open(filename) as f:
+    header = f.readline().rstrip('\n')
+    if not header.startswith(manifest_header):
+      raise IOError("The file '%s' is not a manifest of the FRGC database." % filename)
+    algorithm = header[len(manifest_header):].strip()
+    for line in f:
+      path, size, mtime, digest = line.rstrip('\n').split('\t')
+      entries[path] = (int(size), float(mtime), digest)
+  return algorithm, entries
+
+
+def write_manifest(filename, algorithm, entries):
+  """Writes the given entries (see :py:func:`read_manifest`) into the given manifest file.
+  The file is replaced atomically, so that an interrupted write does not corrupt an existing manifest."""
+  temp_file = filename + '.tmp'
+  with open(temp_file, 'w') as f:
+    f.write('%s %s\n' % (manifest_header, algorithm))
+    for path in sorted(entries):
+      size, mtime, digest = entries[path]
+      f.write('%s\t%d\t%r\t%s\n' % (path, size, mtime, digest))
+  os.rename(temp_file, filename)
+
+
+def check_files(paths, directory, manifest=None, algorithm='sha1', processes=None, rehash=False):
+  """Checks the given files against the given manifest entries, and computes the manifest entries of the files.
+
+  Only files that are not in the manifest, or whose size or modification time differ from the manifest, are hashed (unless ``rehash`` is enabled).
+  Hashing is done in a pool of ``processes`` processes (by default, one per CPU).
+
+  Keyword parameters:
+
+  paths
+    The paths of the files relative to the ``directory``.
+
+  directory
+    The base directory of the files.
+
+  manifest
+    The manifest entries as returned by :py:func:`read_manifest`, or ``None`` to hash all files.
+
+  algorithm
+    The hash algorithm, see :py:func:`hashlib.new`.
+
+  processes
+    The number of processes used for hashing.
+
+  rehash
+    Hash all files, even if their size and modification time did not change.
+
+  Returns: a tuple (entries, missing, modified, hashed), where ``entries`` are the manifest entries of all existing files,
+  ``missing`` the paths of files that do not exist, ``modified`` the paths of files whose digest differs from the manifest,
+  and ``hashed`` the number of files that were hashed.
+  """
+  manifest = manifest or {}
+  entries, missing, modified, to_hash = {}, [], [], []
+  for path in paths:
+    stat = file_stat(os.path.join(directory, path))
+    if stat is None:
+      missing.append(path)
+    elif not rehash and path in manifest and manifest[path][:2] == stat:
+      entries[path] = manifest[path]
+    else:
+      to_hash.append((path, stat))
+
+  if to_hash:
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+      digests = executor.map(file_digest, [os.path.join(directory, path) for path, stat in to_hash], [algorithm] * len(to_hash), chunksize=64)
+      for (path, stat), digest in zip(to_hash, digests):
+        if path in manifest and manifest[path][2] != digest:
+          modified.append(path)
+        entries[path] = stat + (digest,)
+
+  return entries, missing, sorted(modified), len(to_hash)
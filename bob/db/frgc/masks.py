@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Lazily evaluated mask expressions, which combine and restrict the FRGC masks
+"""
+
+import operator
+import numpy
+
+from .models import get_list, get_mask, get_metadata, metadata_selected, presentation_ids, client_codes
+
+
+class MaskExpression:
+  """Base class of all mask expressions.
+
+  Mask expressions can be combined using ``|`` (union), ``&`` (intersection), ``-`` (difference) and ``~`` (complement),
+  and they can be passed as ``mask_type`` to all queries of the :py:class:`bob.db.frgc.Database`.
+  They are evaluated lazily, one block of mask rows at a time, so that no new full-size masks are materialized.
+  """
+
+  def __or__(self, other):
+    return Union(self, other)
+
+  def __and__(self, other):
+    return Intersection(self, other)
+
+  def __sub__(self, other):
+    return Difference(self, other)
+
+  def __invert__(self):
+    return Complement(self)
+
+  def bind(self, base_dir, protocol):
+    """Returns the :py:class:`LazyMask` of this expression for the given FRGC base directory and protocol."""
+    return LazyMask(self, base_dir, protocol)
+
+  def evaluate(self, context, rows):
+    """Evaluates this expression for the given slice of rows (probes) and all columns (models) of the mask.
+    The slice is normalized by the :py:class:`LazyMask`, i.e., its start and step are integers within the shape of the mask, and its stop is ``None`` if it lies before the first row.
+
+    Returns a 2D boolean array."""
+    raise NotImplementedError("Please implement this function in derived classes")
+
+
+class Mask (MaskExpression):
+  """One of the original FRGC masks ('maskI', 'maskII', 'maskIII')."""
+  def __init__(self, mask_type):
+    if mask_type not in ('maskI', 'maskII', 'maskIII'):
+      raise ValueError("The mask type '%s' is not known." % mask_type)
+    self.m_mask_type = mask_type
+
+  def evaluate(self, context, rows):
+    return numpy.asarray(get_mask(context.m_base_dir, context.m_protocol, self.m_mask_type)[rows]) > 0
+
+  def __repr__(self):
+    return self.m_mask_type
+
+
+class AllPairs (MaskExpression):
+  """A mask that contains all pairs of models and probes."""
+  def evaluate(self, context, rows):
+    return numpy.ones((context.row_count(rows), context.shape[1]), dtype=bool)
+
+  def __repr__(self):
+    return 'all'
+
+
+class Union (MaskExpression):
+  """The union of two mask expressions."""
+  def __init__(self, first, second):
+    self.m_first, self.m_second = as_expression(first), as_expression(second)
+
+  def evaluate(self, context, rows):
+    return self.m_first.evaluate(context, rows) | self.m_second.evaluate(context, rows)
+
+  def __repr__(self):
+    return '(%r | %r)' % (self.m_first, self.m_second)
+
+
+class Intersection (MaskExpression):
+  """The intersection of two mask expressions."""
+  def __init__(self, first, second):
+    self.m_first, self.m_second = as_expression(first), as_expression(second)
+
+  def evaluate(self, context, rows):
+    return self.m_first.evaluate(context, rows) & self.m_second.evaluate(context, rows)
+
+  def __repr__(self):
+    return '(%r & %r)' % (self.m_first, self.m_second)
+
+
+class Difference (MaskExpression):
+  """The pairs of the first expression that are not in the second."""
+  def __init__(self, first, second):
+    self.m_first, self.m_second = as_expression(first), as_expression(second)
+
+  def evaluate(self, context, rows):
+    return self.m_first.evaluate(context, rows) & ~self.m_second.evaluate(context, rows)
+
+  def __repr__(self):
+    return '(%r - %r)' % (self.m_first, self.m_second)
+
+
+class Complement (MaskExpression):
+  """All pairs that are not in the given expression."""
+  def __init__(self, expression):
+    self.m_expression = as_expression(expression)
+
+  def evaluate(self, context, rows):
+    return ~self.m_expression.evaluate(context, rows)
+
+  def __repr__(self):
+    return '~%r' % (self.m_expression,)
+
+
+class FileRestriction (MaskExpression):
+  """Selects the pairs, for which the model and the probe fulfill the given predicates.
+
+  Each predicate is called with an FRGCFile of the "Target" (for models) or "Query" (for probes) list, and returns whether it is selected.
+  The predicates are evaluated only once per FRGCFile."""
+  def __init__(self, models=None, probes=None):
+    self.m_models = models
+    self.m_probes = probes
+
+  def _selected(self, context, predicate, files):
+    if predicate is None:
+      return numpy.ones(len(files), dtype=bool)
+    return context.cached((self, predicate), lambda: numpy.array([bool(predicate(f)) for f in files], dtype=bool))
+
+  def evaluate(self, context, rows):
+    models = self._selected(context, self.m_models, context.model_files)
+    probes = self._selected(context, self.m_probes, context.probe_files)[rows]
+    return probes[:, None] & models[None, :]
+
+  def __repr__(self):
+    return 'files(%r, %r)' % (self.m_models, self.m_probes)
+
+
+class ClientRestriction (FileRestriction):
+  """Selects the pairs, for which the model and/or the probe belong to the given client ids."""
+  def __init__(self, model_clients=None, probe_clients=None):
+    self.m_model_clients = None if model_clients is None else frozenset(model_clients)
+    self.m_probe_clients = None if probe_clients is None else frozenset(probe_clients)
+    FileRestriction.__init__(self,
+        models = None if model_clients is None else lambda f: f.m_signature in self.m_model_clients,
+        probes = None if probe_clients is None else lambda f: f.m_signature in self.m_probe_clients)
+
+  def __repr__(self):
+    return 'clients(%d, %d)' % (len(self.m_model_clients or ()), len(self.m_probe_clients or ()))
+
+
+class MetadataRestriction (MaskExpression):
+  """Selects the pairs, for which the model and/or the probe fulfill the given metadata filters, see :py:meth:`bob.db.frgc.models.Metadata.select`.
+  For file sets, all files of the set need to fulfill the filters."""
+  def __init__(self, models=None, probes=None):
+    self.m_model_filters = models
+    self.m_probe_filters = probes
+
+  def _selected(self, context, filters, files):
+    if not filters:
+      return numpy.ones(len(files), dtype=bool)
+    return metadata_selected(context.m_base_dir, files, filters)
+
+  def evaluate(self, context, rows):
+    models = context.cached((self, 'models'), lambda: self._selected(context, self.m_model_filters, context.model_files))
+    probes = context.cached((self, 'probes'), lambda: self._selected(context, self.m_probe_filters, context.probe_files))[rows]
+    return probes[:, None] & models[None, :]
+
+  def __repr__(self):
+    return 'metadata(%r, %r)' % (self.m_model_filters, self.m_probe_filters)
+
+
+class MetadataPairRestriction (MaskExpression):
+  """Selects the pairs, for which the given predicate holds for the values of a metadata attribute of the probe and the model.
+  The predicate is evaluated block-wise, with the values of the probes as a column and of the models as a row vector, e.g.,
+  ``MetadataPairRestriction('capturedate', lambda probe, model: probe - model >= numpy.timedelta64(365, 'D'))`` selects pairs with a time lapse of at least one year.
+  For file sets, the value of the first file of the set is used; pairs with files without metadata are not selected."""
+  def __init__(self, name, predicate):
+    self.m_name = name
+    self.m_predicate = predicate
+
+  def _values(self, context, files):
+    metadata = get_metadata(context.m_base_dir)
+    rows = metadata.rows([presentation_ids[f.m_presentations[0]] for f in files])
+    return metadata[self.m_name][numpy.maximum(rows, 0)], rows >= 0
+
+  def evaluate(self, context, rows):
+    model_values, model_valid = context.cached((self, 'models'), lambda: self._values(context, context.model_files))
+    probe_values, probe_valid = context.cached((self, 'probes'), lambda: self._values(context, context.probe_files))
+    probe_values, probe_valid = probe_values[rows], probe_valid[rows]
+    return numpy.asarray(self.m_predicate(probe_values[:, None], model_values[None, :]), dtype=bool) & probe_valid[:, None] & model_valid[None, :]
+
+  def __repr__(self):
+    return 'metadata_pairs(%s, %r)' % (self.m_name, self.m_predicate)
+
+
+class PairRestriction (MaskExpression):
+  """Selects the pairs that fulfill the given predicate.
+
+  The predicate is called block-wise with the list of probe FRGCFile's of the current rows and the list of all model FRGCFile's,
+  and it needs to return a 2D boolean array of shape (len(probes), len(models))."""
+  def __init__(self, predicate):
+    self.m_predicate = predicate
+
+  def evaluate(self, context, rows):
+    return numpy.asarray(self.m_predicate(context.probe_files[rows], context.model_files), dtype=bool)
+
+  def __repr__(self):
+    return 'pairs(%r)' % (self.m_predicate,)
+
+
+class SameClient (PairRestriction):
+  """Selects the genuine pairs, i.e., where model and probe belong to the same client."""
+  def __init__(self):
+    PairRestriction.__init__(self, None)
+
+  def evaluate(self, context, rows):
+    model_codes, probe_codes = context.client_codes()
+    return probe_codes[rows][:, None] == model_codes[None, :]
+
+  def __repr__(self):
+    return 'genuine'
+
+
+def as_expression(mask_type):
+  """Converts the given mask type name into a mask expression, if required."""
+  if isinstance(mask_type, MaskExpression):
+    return mask_type
+  if mask_type is None:
+    return AllPairs()
+  return Mask(mask_type)
+
+
+class LazyMask:
+  """An array-like mask of a mask expression for a specific protocol, which is evaluated for the requested rows only.
+  It supports ``shape`` and indexing with a row index or slice, optionally followed by column indices, e.g., ``mask[first:last]`` or ``mask[first:last, columns]``."""
+  def __init__(self, expression, base_dir, protocol):
+    self.m_expression = expression
+    self.m_base_dir = base_dir
+    self.m_protocol = protocol
+    self.model_files = get_list(base_dir, 'dev', protocol, 'enroll')
+    self.probe_files = get_list(base_dir, 'dev', protocol, 'probe')
+    self.shape = (len(self.probe_files), len(self.model_files))
+    self.dtype = numpy.dtype(bool)
+    self.m_cache = {}
+
+  def cached(self, key, function):
+    """Returns the cached result of the given function."""
+    if key not in self.m_cache:
+      self.m_cache[key] = function()
+    return self.m_cache[key]
+
+  def client_codes(self):
+    """Returns integral client codes of the models and probes."""
+    return self.cached('client_codes', lambda: client_codes(self.model_files, self.probe_files))
+
+  def row_count(self, rows):
+    """Returns the number of rows selected by the given normalized slice."""
+    return len(range(self.shape[0])[rows])
+
+  def __getitem__(self, key):
+    if isinstance(key, tuple):
+      rows, columns = key[0], key[1:]
+    else:
+      rows, columns = key, ()
+    if isinstance(rows, slice):
+      # resolve negative and missing bounds once for all sub-expressions
+      start, stop, step = rows.indices(self.shape[0])
+      block = self.m_expression.evaluate(self, slice(start, stop if stop >= 0 else None, step))
+    else:
+      rows = operator.index(rows)
+      if not -self.shape[0] <= rows < self.shape[0]:
+        raise IndexError("The row index %d is out of range for the mask of shape %s." % (rows, self.shape))
+      rows %= self.shape[0]
+      block = self.m_expression.evaluate(self, slice(rows, rows + 1, 1))[0]
+    return block[(Ellipsis,) + columns] if columns else block
+
+  def __array__(self, dtype=None, copy=None):
+    block = self[:]
+    return block if dtype is None else block.astype(dtype)
+
+  def __repr__(self):
+    return 'LazyMask(%r, %s)' % (self.m_expression, self.m_protocol)
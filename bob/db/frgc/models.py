@@ -6,10 +6,28 @@
 
 import xml.sax
 import os
+import sys
+import errno
+import heapq
+import threading
+import json
+import re
+import zlib
+import zipfile
+import hashlib
+import contextlib
 import numpy
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 import bob.db.base
 
+import logging
+logger = logging.getLogger("bob.db.frgc")
+
 class File (bob.db.base.File):
   """This class is just the File object that is returned by the objects function.
   It will be created on need and is not stored anywhere."""
@@ -36,33 +54,107 @@ class File (bob.db.base.File):
 
     Returns a string containing the newly generated file path.
     """
-    if not directory: directory = ''
-    if not extension: extension = ''
+    return resolve_path(self.path, directory, extension)
+
+
+def resolve_path(path, directory=None, extension=None):
+  """Forms the complete path from the given file path, directory and extension.
+  If the extension is '.jpg', it is replaced by '.JPG' if necessary."""
+  if not directory: directory = ''
+  if not extension: extension = ''
+
+  # if extension is '.jpg', we have to check if we need to change it to '.JPG'
+  full_path = os.path.join(directory, path + extension)
+  if extension == '.jpg' and not os.path.isfile(full_path):
+    capital_path = os.path.join(directory, path + '.JPG')
+    if os.path.exists(capital_path):
+      return capital_path
+  return full_path
+
+def directory_entries(directory, listings):
+  """Returns the set of entries of the given directory, which is listed only once per ``listings`` dictionary.
+  Non-existing directories have no entries, while None is returned for directories that cannot be listed otherwise."""
+  if directory not in listings:
+    try:
+      listings[directory] = frozenset(os.listdir(directory or os.curdir))
+    except OSError as e:
+      listings[directory] = frozenset() if e.errno in (errno.ENOENT, errno.ENOTDIR) else None
+  return listings[directory]
+
+def paths_exist(full_paths, listings=None):
+  """Returns for each of the given paths, whether it exists, using one listing per directory instead of one file system query per path."""
+  if listings is None:
+    listings = {}
+  exist = []
+  for full_path in full_paths:
+    directory, _, name = full_path.rpartition(os.sep)
+    entries = directory_entries(directory, listings)
+    exist.append(os.path.exists(full_path) if entries is None else name in entries)
+  return exist
+
+def resolve_paths(paths, directory=None, extension=None, listings=None):
+  """Forms the complete paths of all given file paths, as :py:func:`resolve_path` does for a single path.
+  If the extension is '.jpg', each directory is listed only once to decide between '.jpg' and '.JPG', and the listings are kept in the given ``listings`` dictionary."""
+  if not extension: extension = ''
+  prefix = os.path.join(directory, '') if directory else ''
+  full_paths = [path + extension if os.path.isabs(path) else prefix + path + extension for path in paths]
+  if extension != '.jpg':
+    return full_paths
+
+  if listings is None:
+    listings = {}
+  for index, exists in enumerate(paths_exist(full_paths, listings)):
+    if not exists:
+      capital_path = full_paths[index][:-4] + '.JPG'
+      if paths_exist([capital_path], listings)[0]:
+        full_paths[index] = capital_path
+  return full_paths
 
-    # if extension is '.jpg', we have to check if we need to change it to '.JPG'
-    full_path = os.path.join(directory, self.path + extension)
-    if extension == '.jpg' and not os.path.isfile(full_path):
-      capital_path = os.path.join(directory, self.path + '.JPG')
-      if os.path.exists(capital_path):
-        return capital_path
-    return full_path
 
 
 class FileSet:
   """This class is just the FileSet object that is returned by the object_sets function.
-  It will be created on need and is not stored anywhere."""
+  It is created once per FRGCFile (see :py:meth:`FRGCFile.file_set`), while its files and path are generated on need."""
   def __init__(self, frgc_file):
     # The id is simply taken from the FRGCFile model id; WARNING: this ID is not stable and should not be stored anywhere.
     self.id = frgc_file.m_model
     self.client_id = frgc_file.m_signature
-    self.files = [File(frgc_file.m_signature, presentation, frgc_file.m_files[presentation]) for presentation in frgc_file.m_files]
-    # the path is simply a concatenation of the file names of all the files in the set; it is not really used anywhere
-    self.path = self.files[0].path[:3] + self.files[0].path[3:].split('d')[0] + "d" + "+".join([self.files[i].path[3:].split('d')[1] for i in range(len(self.files))])
+    self.m_frgc_file = frgc_file
+    self.m_files = None
+    self.m_path = None
+
+  @property
+  def files(self):
+    """The list of File objects in this set."""
+    if self.m_files is None:
+      frgc_file = self.m_frgc_file
+      self.m_files = [File(frgc_file.m_signature, presentation_ids[i], presentation_paths[i]) for i in frgc_file.m_presentations]
+    return self.m_files
+
+  @property
+  def path(self):
+    """The path is simply a concatenation of the file names of all the files in the set; it is not really used anywhere."""
+    if self.m_path is None:
+      paths = [presentation_paths[i] for i in self.m_frgc_file.m_presentations]
+      first = paths[0][3:].split('d')
+      self.m_path = paths[0][:3] + first[0] + "d" + "+".join([first[1]] + [path[3:].split('d')[1] for path in paths[1:]])
+    return self.m_path
 
   def __lt__(self, other):
     """Defines an order in the file sets."""
     return self.path < other.path
 
+  def __reduce__(self):
+    """File sets are pickled with the ids and paths of their files, since the presentation indices are only valid in the current process."""
+    presentations = self.m_frgc_file.m_presentations
+    return (restore_file_set, (self.id, self.client_id, [presentation_ids[i] for i in presentations], [presentation_paths[i] for i in presentations]))
+
+def restore_file_set(model, signature, ids, paths):
+  """Restores a :py:class:`FileSet` pickled in another process, keeping its model id."""
+  frgc_file = FRGCFile(signature, model)
+  frgc_file.m_presentations = tuple(intern_presentation(presentation, path, signature) for presentation, path in zip(ids, paths))
+  return frgc_file.file_set()
+
 
 ################################################################################
 ############# Internal IO and represenations of the FRGC files #################
@@ -70,23 +162,85 @@ class FileSet:
 # Global model index. This model index is generated on the fly and should not be stored between sessions.
 global model_index
 model_index = 1
+# Lists might be read in parallel threads, so the model index is protected by a lock.
+model_index_lock = threading.Lock()
+
+# Global intern table of all presentations that have been read from any list.
+# Each presentation id is mapped to an integral index, which indexes the id, path and client of the presentation.
+# The index is generated on the fly and should not be stored between sessions.
+presentation_index = {}
+presentation_ids = []
+presentation_paths = []
+presentation_clients = []
+presentation_lock = threading.Lock()
+
+def intern_presentation(presentation, path, signature):
+  """Returns the integral index of the given presentation, adding it to the intern table if required."""
+  with presentation_lock:
+    index = presentation_index.get(presentation)
+    if index is None:
+      index = len(presentation_ids)
+      presentation_index[presentation] = index
+      presentation_ids.append(presentation)
+      presentation_paths.append(path)
+      presentation_clients.append(signature)
+    else:
+      # the path or client might have been corrected in the lists
+      presentation_paths[index] = path
+      presentation_clients[index] = signature
+  return index
+
+def presentation_arrays(frgc_files):
+  """Returns the presentation indices of the given FRGCFile's as one integer array, and the offsets of each FRGCFile in this array."""
+  lengths = numpy.array([len(f.m_presentations) for f in frgc_files], dtype=numpy.int64)
+  offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+  indices = numpy.fromiter((i for f in frgc_files for i in f.m_presentations), dtype=numpy.int32, count=int(offsets[-1]))
+  return indices, offsets
+
+def client_codes(model_files, probe_files):
+  """Returns integral client codes for the given model and probe FRGCFile's, so that genuine pairs share the same code."""
+  codes = {}
+  model_codes = numpy.array([codes.setdefault(f.m_signature, len(codes)) for f in model_files], dtype=numpy.int64)
+  probe_codes = numpy.array([codes.setdefault(f.m_signature, len(codes)) for f in probe_files], dtype=numpy.int64)
+  return model_codes, probe_codes
 
 class FRGCFile:
   """This class holds all desired information about a specific file, or set of files"""
-  def __init__(self, signature):
+  __slots__ = ('m_signature', 'm_model', 'm_presentations', 'm_file_set')
+
+  def __init__(self, signature, model=None):
     # the client id
-    self.m_signature = signature
-    # a unique model id, which is generated on the fly
+    self.m_signature = sys.intern(signature)
+    # a unique model id, which is generated on the fly, unless it is restored from a snapshot
     global model_index
-    self.m_model = model_index
-    model_index += 1
-    # the files: map from record id to path (w/o file extension)
-    self.m_files = {}
+    with model_index_lock:
+      if model is None:
+        self.m_model = model_index
+        model_index += 1
+      else:
+        self.m_model = model
+        model_index = max(model_index, model + 1)
+    # the files: indices into the global presentation table
+    self.m_presentations = ()
+    # the FileSet representing this file, which is created on need
+    self.m_file_set = None
+
+  @property
+  def m_files(self):
+    """The files: map from record id to path (w/o file extension)."""
+    return dict((presentation_ids[i], presentation_paths[i]) for i in self.m_presentations)
+
+  def file_set(self):
+    """Returns the (cached) FileSet for this file."""
+    if self.m_file_set is None:
+      self.m_file_set = FileSet(self)
+    return self.m_file_set
 
   def add(self, presentation, path):
     # add the path to the list of files for this file (list)
-    assert presentation not in self.m_files
-    self.m_files[presentation] = os.path.splitext(path)[0]
+    index = intern_presentation(presentation, os.path.splitext(path)[0], self.m_signature)
+    assert index not in self.m_presentations
+    self.m_presentations += (index,)
 
 
 class ListFileReader (xml.sax.handler.ContentHandler):
@@ -121,11 +275,15 @@ class ListFileReader (xml.sax.handler.ContentHandler):
 
 
 class AnnotationFileReader (xml.sax.handler.ContentHandler):
-  """Class for reading the FRGC metadata list"""
+  """Class for reading the FRGC metadata list.
+  Besides the landmarks, all other attributes of each Recording, of its child elements and of its ancestor elements are collected as metadata."""
   def __init__(self):
     self.m_annotations = {}
     self.m_signature = None
     self.m_annotation_map = {}
+    self.m_metadata = {}
+    self.m_metadata_map = {}
+    self.m_ancestors = []
 
   def startDocument(self):
     pass
@@ -139,6 +297,9 @@ class AnnotationFileReader (xml.sax.handler.ContentHandler):
       self.m_signature = attrs['recording_id']
       self.m_annotations = {}
       self.m_use_recording = False
+      # attributes of ancestors and children are prefixed with the element name
+      self.m_metadata = dict(('%s.%s' % (element, key), value) for element, ancestor in self.m_ancestors for key, value in ancestor.items())
+      self.m_metadata.update((key, value) for key, value in attrs.items() if key != 'recording_id')
     elif name == 'LeftEyeCenter':
       self.m_annotations['leye'] = (int(attrs['y']), int(attrs['x']))
       self.m_use_recording = True
@@ -148,8 +309,10 @@ class AnnotationFileReader (xml.sax.handler.ContentHandler):
       self.m_annotations['nose'] = (int(attrs['y']), int(attrs['x']))
     elif name == 'Mouth':
       self.m_annotations['mouth'] = (int(attrs['y']), int(attrs['x']))
-    else: # other name
-      pass
+    elif self.m_signature is not None:
+      self.m_metadata.update(('%s.%s' % (name, key), value) for key, value in attrs.items())
+    else: # an ancestor of the Recording's
+      self.m_ancestors.append((name, dict((key, value) for key, value in attrs.items() if not key.startswith('xmlns'))))
 
   def endElement(self, name):
     if name == 'Recording':
@@ -159,34 +322,129 @@ class AnnotationFileReader (xml.sax.handler.ContentHandler):
       if self.m_use_recording:
         assert len(self.m_annotations) == 4
         self.m_annotation_map[self.m_signature] = self.m_annotations
+      self.m_metadata_map[self.m_signature] = self.m_metadata
       # new identity
       self.m_signature = None
+    elif self.m_signature is None:
+      self.m_ancestors.pop()
     else: # other name
       pass
 
 
+# the data types of the BEE matrices, indexed by the second character of the matrix header
+matrix_types = {'B':numpy.uint8, 'F':numpy.float32, 'S':numpy.float32, 'D':numpy.float64}
+
+# the magic number that is used to detect the byte order of the matrix data
+matrix_magic = 0x12345678
+
+def read_matrix_header(matrix_file):
+  """Reads the header of the given BEE matrix file.
+
+  Returns a tuple (matrix_type, shape, dtype, offset), where the offset is the position of the matrix data in the file."""
+  with open(matrix_file, 'rb') as f:
+    # read until the phrase "M?" is read, where ? is one of the known matrix types
+    while True:
+      m = f.read(1)
+      if m == b'':
+        raise ValueError("The given matrix file '" + matrix_file + "' is invalid.")
+      if m != b'M':
+        continue
+      t = f.read(1)
+      if t.decode('ascii', 'replace') in matrix_types and f.read(1) == b' ':
+        break
+      f.seek(-1, 1)
+
+    # read the matrix size and the magic number
+    line = f.readline()
+    rows, columns = line.split(b' ')[0:2]
+    magic = line[len(rows) + len(columns) + 2 : -1]
+    offset = f.tell()
+
+  matrix_type = t.decode('ascii')
+  dtype = numpy.dtype(matrix_types[matrix_type])
+  if len(magic) == 4 and numpy.frombuffer(magic, dtype='>u4')[0] == matrix_magic:
+    dtype = dtype.newbyteorder('>')
+  else:
+    dtype = dtype.newbyteorder('<')
+  return matrix_type, (int(rows), int(columns)), dtype, offset
+
+
+def read_matrix(matrix_file, mmap=True):
+  """Reads the BEE similarity matrix (or mask) from file.
+
+  By default, the matrix is memory-mapped read-only, so that even huge matrices can be accessed block-wise without being loaded into memory.
+  The matrix has the same layout as the masks, i.e., one row per query and one column per target entry."""
+  matrix_type, shape, dtype, offset = read_matrix_header(matrix_file)
+  if mmap:
+    return numpy.memmap(matrix_file, dtype=dtype, mode='r', offset=offset, shape=shape)
+  with open(matrix_file, 'rb') as f:
+    f.seek(offset)
+    matrix = numpy.fromfile(f, dtype=dtype, count=shape[0] * shape[1])
+  matrix.shape = shape
+  return matrix
+
+
 def read_mask(mask_file):
   """Reads the mask from file"""
-  # open the file
-  f = open(mask_file, 'rb')
-  # read until the phrase "MB" is read
-  b = None
-  while b not in ('B', '', b'B', b''):
-    m = None
-    while m not in ('M', '', b'M', b''):
-      m = f.read(1)
-    b = f.read(1)
-  if m not in ('M', b'M') or b not in ('B', b'B'):
+  matrix_type, shape, dtype, offset = read_matrix_header(mask_file)
+  if matrix_type != 'B':
     raise ValueError("The given mask file '" + mask_file + "' is invalid.")
+  return read_matrix(mask_file, mmap=False)
 
-  # read the mask size
-  queries, targets = f.readline().split(b' ')[1:3]
 
-  # read mask
-  mask = numpy.fromfile(f, dtype = numpy.uint8)
-  mask.shape = (int(queries), int(targets))
+class MatrixWriter:
+  """Writes BEE similarity matrices block-wise, so that the full matrix never needs to be held in memory.
 
-  return mask
+  Use it as a context manager and call :py:meth:`write` with consecutive blocks of rows::
+
+    with MatrixWriter('scores.mtx', (len(queries), len(targets))) as writer:
+      for block in blocks:
+        writer.write(block)
+  """
+  def __init__(self, matrix_file, shape, target_sigset='', query_sigset='', matrix_type='S', header_type='S2'):
+    if matrix_type not in matrix_types:
+      raise ValueError("The matrix type '%s' is not known; choose one of %s." % (matrix_type, sorted(matrix_types)))
+    self.m_shape = tuple(shape)
+    self.m_dtype = numpy.dtype(matrix_types[matrix_type]).newbyteorder('<')
+    self.m_rows = 0
+    self.m_file = open(matrix_file, 'wb')
+    self.m_file.write(('%s\n%s\n%s\nM%s %d %d ' % (header_type, target_sigset, query_sigset, matrix_type, self.m_shape[0], self.m_shape[1])).encode('ascii'))
+    self.m_file.write(numpy.array([matrix_magic], dtype='<u4').tobytes() + b'\n')
+
+  def write(self, block):
+    """Writes the next block of rows (or a single row) of the matrix."""
+    block = numpy.asarray(block, dtype=self.m_dtype)
+    if block.ndim == 1:
+      block = block.reshape(1, -1)
+    if block.shape[1] != self.m_shape[1] or self.m_rows + block.shape[0] > self.m_shape[0]:
+      raise ValueError("The block of shape %s does not fit into the matrix of shape %s after %d rows." % (block.shape, self.m_shape, self.m_rows))
+    block.tofile(self.m_file)
+    self.m_rows += block.shape[0]
+
+  def close(self):
+    """Closes the matrix file; raises a ValueError if not all rows of the matrix have been written."""
+    if self.m_file is not None:
+      self.m_file.close()
+      self.m_file = None
+      if self.m_rows != self.m_shape[0]:
+        raise ValueError("Only %d of the %d rows of the matrix have been written." % (self.m_rows, self.m_shape[0]))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    elif self.m_file is not None:
+      self.m_file.close()
+      self.m_file = None
+
+
+def write_matrix(matrix_file, matrix, target_sigset='', query_sigset='', matrix_type='S', block_size=1024):
+  """Writes the given matrix (which might be memory-mapped) as a BEE matrix file, ``block_size`` rows at a time."""
+  with MatrixWriter(matrix_file, matrix.shape, target_sigset, query_sigset, matrix_type) as writer:
+    for first in range(0, matrix.shape[0], block_size):
+      writer.write(matrix[first : first + block_size])
 
 
 # directories inside the FRGC database
@@ -197,6 +455,129 @@ meta_data_dir = "BEE_DIST/%(v)sFRGC2.0/metadata"
 dir_variants = ('linux/FRGC/', '')
 
 
+######################################################
+##### change detection ###############################
+
+# the source files of all lists, masks and annotations that have been read: key -> (file name, modification time, size)
+source_files = {}
+
+# functions that are called with the key of each source that has changed, so that data derived from it can be dropped
+invalidation_listeners = []
+
+def source_stat(filename):
+  """Returns the (file name, modification time, size) tuple of the given source file."""
+  stat = os.stat(filename)
+  return (filename, stat.st_mtime, stat.st_size)
+
+def source_changed(key):
+  """Returns True if the source file of the given key has been modified or removed since it was read."""
+  filename, mtime, size = source_files[key]
+  try:
+    return source_stat(filename) != (filename, mtime, size)
+  except OSError:
+    return True
+
+def add_invalidation_listener(listener):
+  """Registers a function that is called with the key of each source, which is reloaded by :py:func:`refresh`.
+  Keys are ``('list', group[, protocol[, purpose]])``, ``('mask', protocol, mask_type)`` or ``('annotations',)``."""
+  if listener not in invalidation_listeners:
+    invalidation_listeners.append(listener)
+
+
+######################################################
+##### shared on-disk cache ###########################
+
+# the directory of the on-disk cache of lists, masks and annotations, which is shared between processes; None disables the cache
+global cache_directory
+cache_directory = None
+
+def get_cache_directory():
+  """Returns the directory of the shared on-disk cache of lists, masks and annotations, or ``None``.
+  Masks are cached here only if no mask cache directory is set, see :py:func:`set_mask_cache_directory`."""
+  return cache_directory
+
+def set_cache_directory(directory):
+  """Sets the directory of the shared on-disk cache of lists, masks and annotations; ``None`` disables the cache."""
+  global cache_directory
+  cache_directory = directory
+
+@contextlib.contextmanager
+def cache_lock(lock_file):
+  """Holds an exclusive POSIX lock of the given lock file, which is shared by all processes (also on network file systems that support POSIX locks).
+  On systems without ``fcntl``, no lock is taken."""
+  if fcntl is None:
+    yield
+    return
+  with open(lock_file, 'a') as f:
+    fcntl.lockf(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.lockf(f, fcntl.LOCK_UN)
+
+def cache_generation(stat):
+  """Returns a short tag of the given source file stat, which is appended to the names of the cache files derived from the source file."""
+  return hashlib.sha1(json.dumps(list(stat)).encode('utf-8')).hexdigest()[:12]
+
+def source_tag(filename):
+  """Returns a short tag of the path of the given source file, which separates the cache files of several FRGC trees that share one cache directory."""
+  return hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()[:12]
+
+def remove_old_generations(name, cache_file):
+  """Removes the cache files of the given artifact that were derived from previous generations of the source file."""
+  for filename in os.listdir(cache_directory):
+    if filename.startswith(name + '.') and filename != os.path.basename(cache_file) and not filename.endswith(('.lock', '.tmp')):
+      try:
+        os.remove(os.path.join(cache_directory, filename))
+      except OSError:
+        pass
+
+def cached(name, stat, read, build, write):
+  """Returns the artifact with the given name, which is derived from the source file with the given stat, from the shared cache directory.
+
+  If the cache file of the current generation of the source file exists, the artifact is read by ``read(cache_file)``.
+  Otherwise, only one process at a time builds the artifact by ``build()`` and writes it by ``write(artifact, temp_file)``,
+  while the other processes wait for the lock and read the cache file afterwards.
+  The cache file is renamed into place atomically, so that readers never see partially written files.
+  If the cache cannot be used, the artifact is built without it.
+  """
+  cache_file = os.path.join(cache_directory, '%s.%s' % (name, cache_generation(stat)))
+
+  def read_if_exists():
+    if os.path.exists(cache_file):
+      try:
+        return read(cache_file)
+      except (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipfile) as e:
+        logger.warn("The cache file '%s' cannot be read: %s", cache_file, e)
+    return None
+
+  artifact = read_if_exists()
+  if artifact is not None:
+    return artifact
+  try:
+    if not os.path.isdir(cache_directory):
+      try:
+        os.makedirs(cache_directory)
+      except OSError:
+        # another process might have created it in the meantime
+        if not os.path.isdir(cache_directory):
+          raise
+    with cache_lock(os.path.join(cache_directory, name + '.lock')):
+      # the artifact might have been built by another process, while we were waiting for the lock
+      artifact = read_if_exists()
+      if artifact is None:
+        artifact = build()
+        temp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        write(artifact, temp_file)
+        os.rename(temp_file, cache_file)
+        remove_old_generations(name, cache_file)
+  except (IOError, OSError) as e:
+    logger.warn("The cache directory '%s' cannot be used: %s", cache_directory, e)
+    if artifact is None:
+      artifact = build()
+  return artifact
+
+
 ######################################################
 ##### lists ##########################################
 
@@ -211,58 +592,339 @@ xml_files = {'world':'FRGC_Exp_2.0.1_Training.xml',
 known_lists = {'world':None,
                'dev':{'2.0.1':None, '2.0.2':None, '2.0.4':{'enroll':None, 'probe':None}}}
 
-# collector for files and models that have been read
-file_dict = {}
+# collector for models that have been read; the files are collected in the presentation table
 model_dict = {}
 
+# the locks that serialize the reading of each list, mask and annotation file, indexed by its key,
+# so that concurrent queries never read the same source twice, while different sources are read in parallel
+load_locks = {}
+load_locks_lock = threading.Lock()
+
+def load_lock(key):
+  """Returns the lock of the source (list, mask or annotations) with the given key."""
+  with load_locks_lock:
+    return load_locks.setdefault(key, threading.RLock())
+
+def list_key(group, protocol=None, purpose=None):
+  """Returns the key, under which the list of the given group, protocol and purpose is stored."""
+  if group == 'world':
+    return ('list', group)
+  if protocol in ('2.0.1', '2.0.2'):
+    return ('list', group, protocol)
+  return ('list', group, protocol, purpose)
+
+def loaded_lists():
+  """Returns a dictionary of all lists that have been read so far, indexed by their key."""
+  lists = {list_key('world') : known_lists['world']}
+  for protocol in ('2.0.1', '2.0.2'):
+    lists[list_key('dev', protocol)] = known_lists['dev'][protocol]
+  for purpose in ('enroll', 'probe'):
+    lists[list_key('dev', '2.0.4', purpose)] = known_lists['dev']['2.0.4'][purpose]
+  return dict((key, list) for key, list in lists.items() if list)
+
+def store_list(key, frgc_files):
+  """Stores the given list (or None to drop it) under the given list key."""
+  if key[1] == 'world':
+    known_lists['world'] = frgc_files
+  elif len(key) == 3:
+    known_lists['dev'][key[2]] = frgc_files
+  else:
+    known_lists['dev'][key[2]][key[3]] = frgc_files
+
+def stored_list(key):
+  """Returns the list stored under the given list key, or None if it has not been read yet."""
+  if key[1] == 'world':
+    return known_lists['world']
+  if len(key) == 3:
+    return known_lists['dev'][key[2]]
+  return known_lists['dev'][key[2]][key[3]]
+
+def write_cached_list(frgc_files, cache_file):
+  """Writes the clients and presentations of the given list into the given ``.npz`` cache file; model ids are not stored."""
+  indices, offsets = presentation_arrays(frgc_files)
+  with open(cache_file, 'wb') as f:
+    numpy.savez(f,
+        signatures = numpy.asarray('\n'.join(frgc_file.m_signature for frgc_file in frgc_files)),
+        presentation_ids = numpy.asarray('\n'.join(presentation_ids[index] for index in indices)),
+        presentation_paths = numpy.asarray('\n'.join(presentation_paths[index] for index in indices)),
+        offsets = offsets)
+
+def read_cached_list(cache_file):
+  """Reads the list written by :py:func:`write_cached_list`; the models get new model ids."""
+  with numpy.load(cache_file) as arrays:
+    signatures = str(arrays['signatures'].item()).split('\n')
+    ids = str(arrays['presentation_ids'].item()).split('\n')
+    paths = str(arrays['presentation_paths'].item()).split('\n')
+    offsets = arrays['offsets'].tolist()
+  if len(offsets) != len(signatures) + 1 or offsets[-1] != len(ids) or len(ids) != len(paths):
+    raise ValueError("The cached list is inconsistent.")
+  frgc_files = []
+  for index, signature in enumerate(signatures):
+    frgc_file = FRGCFile(signature)
+    frgc_file.m_presentations = tuple(intern_presentation(ids[i], paths[i], frgc_file.m_signature) for i in range(offsets[index], offsets[index + 1]))
+    frgc_files.append(frgc_file)
+  return frgc_files
+
 def get_list(base_dir, group, protocol=None, purpose=None):
   """Reads and returns the list of file names for the given group, purpose and protocol."""
 
-  def read_if_needed(file, list):
+  def read_if_needed(file, key):
     """Reads the given list (if it has not been read yet) and fills the file and model dictionaries."""
+    list = stored_list(key)
     if not list:
-      files = [file % {'v':v} for v in dir_variants]
-      found = None
-      for f in files:
-        if os.path.exists(f):
-          found = f
-      if found is None:
-        raise xml.sax.SAXException("Could not find the any of the list files '%s'. Your FRGC base directory '%s' seems to be wrong or incomplete."%(files, base_dir))
-      handler = ListFileReader()
-#      print "Reading xml list '" + file + "'"
-      xml.sax.parse(found, handler)
-      list = handler.m_file_list
-      # integrate in dicts
-      for g in list:
-        for k,v in g.m_files.items():
-          file_dict[k] = g.m_signature
-        model_dict[g.m_model] = g.m_signature
+      with load_lock(key):
+        # another thread might have read the list, while we were waiting for the lock
+        list = stored_list(key)
+        if list:
+          return list
+        files = [file % {'v':v} for v in dir_variants]
+        found = None
+        for f in files:
+          if os.path.exists(f):
+            found = f
+        if found is None:
+          raise xml.sax.SAXException("Could not find the any of the list files '%s'. Your FRGC base directory '%s' seems to be wrong or incomplete."%(files, base_dir))
+        def parse():
+          handler = ListFileReader()
+#          print "Reading xml list '" + file + "'"
+          xml.sax.parse(found, handler)
+          return handler.m_file_list
+        stat = source_stat(found)
+        if cache_directory is None:
+          list = parse()
+        else:
+          list = cached('_'.join(key), stat, read_cached_list, parse, write_cached_list)
+        source_files[key] = stat
+        # integrate in dicts
+        for g in list:
+          model_dict[g.m_model] = g.m_signature
+        store_list(key, list)
 
     return list
 
   if group == 'world':
-    known_lists[group] = read_if_needed(os.path.join(base_dir, list_dir, xml_files[group]), known_lists[group])
-    return known_lists[group]
+    return read_if_needed(os.path.join(base_dir, list_dir, xml_files[group]), list_key(group))
 
   if group == 'dev':
     if protocol in ('2.0.1', '2.0.2'):
-      known_lists[group][protocol] = read_if_needed(os.path.join(base_dir, list_dir, xml_files[group][protocol]), known_lists[group][protocol])
-      return known_lists[group][protocol]
+      return read_if_needed(os.path.join(base_dir, list_dir, xml_files[group][protocol]), list_key(group, protocol))
     if protocol == '2.0.4':
-      known_lists[group][protocol][purpose] = read_if_needed(os.path.join(base_dir, list_dir, xml_files[group][protocol][purpose]), known_lists[group][protocol][purpose])
-      return known_lists[group][protocol][purpose]
+      return read_if_needed(os.path.join(base_dir, list_dir, xml_files[group][protocol][purpose]), list_key(group, protocol, purpose))
+
+# all list keys, with the groups, protocols and purposes to read them
+all_lists = {list_key('world') : ('world',),
+             list_key('dev', '2.0.1') : ('dev', '2.0.1'),
+             list_key('dev', '2.0.2') : ('dev', '2.0.2'),
+             list_key('dev', '2.0.4', 'enroll') : ('dev', '2.0.4', 'enroll'),
+             list_key('dev', '2.0.4', 'probe') : ('dev', '2.0.4', 'probe')}
+
+# the lists, which contain models (i.e., all but the 2.0.4 "Query" list)
+model_lists = [key for key in all_lists if key != list_key('dev', '2.0.4', 'probe')]
+
+
+def reverse_index_tables(lists):
+  """Inverts the given lists into the tables of the :py:class:`ReverseIndex`.
+  Models are referred to by (list key, position in the list), since the model ids are only valid in the current process."""
+  # client -> [presentation], in the order of their first occurrence
+  client_files = {}
+  # client -> [(list key, position)]
+  client_models = {}
+  # presentation -> [list key]
+  file_lists = {}
+  # presentation -> [(list key, position)]
+  file_models = {}
+  # presentation -> client and path
+  file_client = {}
+  file_path = {}
+
+  for key in sorted(lists):
+    for position, g in enumerate(lists[key]):
+      if key in model_lists:
+        client_models.setdefault(g.m_signature, []).append((key, position))
+      for presentation, path in g.m_files.items():
+        if presentation not in file_client:
+          file_client[presentation] = g.m_signature
+          file_path[presentation] = path
+          client_files.setdefault(g.m_signature, []).append(presentation)
+        keys = file_lists.setdefault(presentation, [])
+        if key not in keys:
+          keys.append(key)
+        if key in model_lists:
+          file_models.setdefault(presentation, []).append((key, position))
+
+  return {'client_files' : client_files, 'client_models' : client_models, 'file_lists' : file_lists, 'file_models' : file_models, 'file_client' : file_client, 'file_path' : file_path}
+
+def write_cached_reverse_index(tables, cache_file):
+  """Writes the given tables of the reverse index into the given JSON cache file."""
+  with open(cache_file, 'w') as f:
+    json.dump(tables, f)
+
+def read_cached_reverse_index(cache_file):
+  """Reads the tables of the reverse index written by :py:func:`write_cached_reverse_index`."""
+  with open(cache_file) as f:
+    tables = json.load(f)
+  # JSON stores tuples as lists
+  for name in ('client_models', 'file_models'):
+    tables[name] = dict((k, [(tuple(key), position) for key, position in v]) for k, v in tables[name].items())
+  tables['file_lists'] = dict((k, [tuple(key) for key in v]) for k, v in tables['file_lists'].items())
+  return tables
+
+
+class ReverseIndex:
+  """Index over all FRGC lists, which allows to look up the files and models of clients, and the lists, models and clients of files.
+  The tables are computed by :py:func:`reverse_index_tables`, unless they are given."""
+  def __init__(self, lists, tables=None):
+    if tables is None:
+      tables = reverse_index_tables(lists)
+    self.m_lists = lists
+    self.m_client_files = tables['client_files']
+    self.m_client_models = tables['client_models']
+    self.m_file_lists = tables['file_lists']
+    self.m_file_models = tables['file_models']
+    self.m_file_client = tables['file_client']
+    self.m_file_path = tables['file_path']
+
+  def client_files(self, client_id):
+    """Returns the sorted list of File objects of the given client."""
+    if client_id not in self.m_client_files:
+      raise ValueError("The client id '%s' is not known." % client_id)
+    return [File(client_id, presentation, self.m_file_path[presentation]) for presentation in sorted(self.m_client_files[client_id])]
+
+  def client_models(self, client_id):
+    """Returns the list of (list key, model id) of the given client."""
+    if client_id not in self.m_client_models:
+      raise ValueError("The client id '%s' does not have any models." % client_id)
+    return [(key, self.m_lists[key][position].m_model) for key, position in self.m_client_models[client_id]]
+
+  def file_lists(self, file_id):
+    """Returns the keys of the lists that contain the given file."""
+    if file_id not in self.m_file_lists:
+      raise ValueError("The file id '%s' is not known." % file_id)
+    return self.m_file_lists[file_id]
+
+  def file_models(self, file_id):
+    """Returns the ids of all models that contain the given file."""
+    self.file_lists(file_id)
+    return [self.m_lists[key][position].m_model for key, position in self.m_file_models.get(file_id, [])]
+
+
+# the reverse index over all lists, which is built on need
+global reverse_index
+reverse_index = None
+
+def get_reverse_index(base_dir):
+  """Reads all lists (if required) and returns the reverse index over them.
+  When the shared cache directory is set, the tables of the index are stored there, next to the lists."""
+  global reverse_index
+  if reverse_index is None:
+    lists = dict((key, get_list(base_dir, *all_lists[key])) for key in all_lists)
+    stats = [source_files.get(key) for key in sorted(all_lists)]
+    if cache_directory is None or None in stats:
+      reverse_index = ReverseIndex(lists)
+    else:
+      reverse_index = ReverseIndex(lists, cached('reverse_index', stats, read_cached_reverse_index, lambda: reverse_index_tables(lists), write_cached_reverse_index))
+  return reverse_index
+
+def invalidate_reverse_index(key):
+  """Drops the reverse index when any of the lists has changed."""
+  global reverse_index
+  if key[0] == 'list':
+    reverse_index = None
 
-def client_from_file(file_id):
-  """Returns the client id attached to the given file id. The file id must be already known (i.e., it must have been read from any list)."""
-  assert file_id in file_dict
-  return file_dict[file_id]
+add_invalidation_listener(invalidate_reverse_index)
 
-def client_from_model(model_id):
-  """Returns the client id attached to the given model id. The model id must be already known."""
-  assert model_id in model_dict
+
+def client_from_file(file_id, base_dir=None):
+  """Returns the client id attached to the given file id.
+  If the file id is unknown and the base directory is given, all lists are read to find it."""
+  if file_id not in presentation_index and base_dir is not None:
+    get_reverse_index(base_dir)
+  if file_id not in presentation_index:
+    raise ValueError("The file id '%s' is not known." % file_id)
+  return presentation_clients[presentation_index[file_id]]
+
+def client_from_model(model_id, base_dir=None):
+  """Returns the client id attached to the given model id.
+  If the model id is unknown and the base directory is given, all lists are read to find it."""
+  if model_id not in model_dict and base_dir is not None:
+    get_reverse_index(base_dir)
+  if model_id not in model_dict:
+    raise ValueError("The model id '%s' is not known; model ids need to be obtained from model_ids() of the current session." % model_id)
   return model_dict[model_id]
 
 
+# integer-coded lookup tables from presentation indices and model ids to client ids, which are built on need
+global client_tables
+client_tables = None
+
+def get_client_tables():
+  """Returns the lookup tables (stamp, client_ids, file_clients, model_clients), where ``client_ids`` is the sorted array of all client ids,
+  and ``file_clients`` and ``model_clients`` contain the index into ``client_ids`` for each presentation index and model id, or -1 for unknown model ids.
+  The tables are rebuilt when lists have been read or reloaded since they were built."""
+  global client_tables
+  stamp = (len(presentation_ids), model_index, len(model_dict))
+  tables = client_tables
+  if tables is None or tables[0] != stamp:
+    with presentation_lock:
+      file_client_ids = list(presentation_clients)
+    models = dict(model_dict)
+    client_ids = sorted(set(file_client_ids) | set(models.values()))
+    codes = dict((client_id, code) for code, client_id in enumerate(client_ids))
+    file_clients = numpy.array([codes[c] for c in file_client_ids], dtype=numpy.int32)
+    model_clients = numpy.full(max(models.keys() or [0]) + 1, -1, dtype=numpy.int32)
+    for model, client_id in models.items():
+      model_clients[model] = codes[client_id]
+    tables = client_tables = (stamp, numpy.array(client_ids, dtype=str), file_clients, model_clients)
+  return tables
+
+def invalidate_client_tables(key):
+  """Drops the client lookup tables when any of the lists has changed."""
+  global client_tables
+  if key[0] == 'list':
+    client_tables = None
+
+add_invalidation_listener(invalidate_client_tables)
+
+
+def unknown_ids(kind, ids):
+  """Returns the error for the given unknown ids."""
+  ids = list(ids)
+  return ValueError("%d %s id(s) are not known, e.g., %s" % (len(ids), kind, ", ".join("'%s'" % i for i in ids[:5])))
+
+def clients_from_files(file_ids, base_dir=None):
+  """Returns the client ids attached to the given file ids as an array of strings.
+  If any file id is unknown and the base directory is given, all lists are read to find it; still unknown file ids raise a :py:class:`ValueError`."""
+  file_ids = file_ids.reshape(-1).tolist() if isinstance(file_ids, numpy.ndarray) else list(file_ids)
+  def indices():
+    get = presentation_index.get
+    return numpy.fromiter((get(f, -1) for f in file_ids), dtype=numpy.int64, count=len(file_ids))
+  file_indices = indices()
+  if (file_indices < 0).any() and base_dir is not None:
+    get_reverse_index(base_dir)
+    file_indices = indices()
+  if (file_indices < 0).any():
+    raise unknown_ids('file', sorted(set(file_ids[i] for i in numpy.flatnonzero(file_indices < 0))))
+  stamp, client_ids, file_clients, model_clients = get_client_tables()
+  return client_ids[file_clients[file_indices]]
+
+def clients_from_models(model_ids, base_dir=None):
+  """Returns the client ids attached to the given model ids as an array of strings.
+  If any model id is unknown and the base directory is given, all lists are read to find it; still unknown model ids raise a :py:class:`ValueError`."""
+  model_ids = numpy.asarray(model_ids, dtype=numpy.int64).reshape(-1)
+  def codes():
+    stamp, client_ids, file_clients, model_clients = get_client_tables()
+    valid = (model_ids >= 0) & (model_ids < len(model_clients))
+    codes = numpy.full(len(model_ids), -1, dtype=numpy.int64)
+    codes[valid] = model_clients[model_ids[valid]]
+    return client_ids, codes
+  client_ids, model_codes = codes()
+  if (model_codes < 0).any() and base_dir is not None:
+    get_reverse_index(base_dir)
+    client_ids, model_codes = codes()
+  if (model_codes < 0).any():
+    raise unknown_ids('model', numpy.unique(model_ids[model_codes < 0]))
+  return client_ids[model_codes]
+
 
 ###############################################################
 ##### masks ###################################################
@@ -273,22 +935,242 @@ known_masks = {'2.0.1':{'maskI':None, 'maskII':None, 'maskIII':None},
                '2.0.4':{'maskI':None, 'maskII':None, 'maskIII':None}}
 
 def get_mask(base_dir, protocol, mask_type):
-  """Returns the mask ([query_index], [target_index]) for the given protocol and mask type."""
+  """Returns the mask ([query_index], [target_index]) for the given protocol and mask type.
+  For mask expressions (see :py:mod:`bob.db.frgc.masks`), a lazily evaluated mask is returned."""
   if mask_type is None:
     return None
+  if hasattr(mask_type, 'bind'):
+    return mask_type.bind(base_dir, protocol)
   if known_masks[protocol][mask_type] is None:
-    mask_files = [os.path.join(base_dir, mask_dir%{'v':v, 'e':protocol[-1:]}, mask_type + ".mtx") for v in dir_variants]
-    found = None
-    for f in mask_files:
-      if os.path.exists(f):
-        found = f
-    if found is None:
-      raise xml.sax.SAXException("Could not find any of the mask files '%s'. Your FRGC base directory '%s' seems to be wrong or incomplete."%(mask_files, base_dir))
-    known_masks[protocol][mask_type] = read_mask(found)
+    with load_lock(('mask', protocol, mask_type)):
+      # another thread might have read the mask, while we were waiting for the lock
+      if known_masks[protocol][mask_type] is None:
+        mask_files = [os.path.join(base_dir, mask_dir%{'v':v, 'e':protocol[-1:]}, mask_type + ".mtx") for v in dir_variants]
+        found = None
+        for f in mask_files:
+          if os.path.exists(f):
+            found = f
+        if found is None:
+          raise xml.sax.SAXException("Could not find any of the mask files '%s'. Your FRGC base directory '%s' seems to be wrong or incomplete."%(mask_files, base_dir))
+        stat = source_stat(found)
+        # masks are cached in the mask cache directory, if given, or in the shared cache directory
+        directory = mask_cache_directory if mask_cache_directory is not None else cache_directory
+        if directory is None:
+          known_masks[protocol][mask_type] = read_mask(found)
+        else:
+          known_masks[protocol][mask_type] = read_cached_mask(found, stat, mask_cache_file(directory, found, protocol, mask_type))
+        source_files[('mask', protocol, mask_type)] = stat
 
   return known_masks[protocol][mask_type]
 
 
+# the directory of the compressed mask cache; None disables the cache
+global mask_cache_directory
+mask_cache_directory = None
+
+def get_mask_cache_directory():
+  """Returns the directory, where compressed copies of the masks are cached, or ``None``."""
+  return mask_cache_directory
+
+def set_mask_cache_directory(directory):
+  """Sets the directory, where compressed copies of the masks are cached; ``None`` disables the cache.
+  For masks, this directory takes precedence over the shared cache directory, see :py:func:`set_cache_directory`."""
+  global mask_cache_directory
+  mask_cache_directory = directory
+
+def mask_cache_file(directory, mask_file, protocol, mask_type):
+  """Returns the file in the given cache directory, in which the given mask file of the given protocol and mask type is cached."""
+  return os.path.join(directory, "%s_%s.%s.mask" % (protocol, mask_type, source_tag(mask_file)))
+
+def write_compressed_mask(cache_file, mask, stat):
+  """Writes the given mask as compressed bit planes (one per distinct non-zero value) to the given cache file.
+  The header records the source file, its modification time and size."""
+  counts = numpy.bincount(mask.ravel(), minlength=256)
+  values = [int(v) for v in numpy.flatnonzero(counts[1:]) + 1]
+  planes = [zlib.compress(numpy.packbits(mask.ravel() == v).tobytes(), 1) for v in values]
+  header = {'source' : stat[0], 'mtime' : stat[1], 'size' : stat[2], 'shape' : list(mask.shape), 'values' : values, 'lengths' : [len(plane) for plane in planes]}
+
+  temp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+  with open(temp_file, 'wb') as f:
+    f.write(json.dumps(header).encode('utf-8') + b'\n')
+    for plane in planes:
+      f.write(plane)
+  os.rename(temp_file, cache_file)
+
+def read_compressed_mask(cache_file, stat):
+  """Reads the mask from the given cache file, if it was written for the source file with the given stat; otherwise None is returned."""
+  if not os.path.exists(cache_file):
+    return None
+  with open(cache_file, 'rb') as f:
+    header = json.loads(f.readline().decode('utf-8'))
+    if (header['source'], header['mtime'], header['size']) != tuple(stat):
+      return None
+    shape = tuple(header['shape'])
+    mask = numpy.zeros(shape[0] * shape[1], dtype=numpy.uint8)
+    for value, length in zip(header['values'], header['lengths']):
+      plane = numpy.unpackbits(numpy.frombuffer(zlib.decompress(f.read(length)), dtype=numpy.uint8), count=mask.size).view(bool)
+      mask[plane] = value
+  mask.shape = shape
+  return mask
+
+def read_cached_mask(mask_file, stat, cache_file):
+  """Reads the mask from the cache file if it is up to date, otherwise from the given mask file, updating the cache.
+  Only one process at a time reads the mask file and writes the cache file, while the other processes wait for the lock and read the cache file afterwards."""
+  def read_if_valid():
+    try:
+      return read_compressed_mask(cache_file, stat)
+    except (IOError, OSError, ValueError, KeyError, zlib.error) as e:
+      logger.warn("The cached mask '%s' cannot be read: %s", cache_file, e)
+    return None
+
+  mask = read_if_valid()
+  if mask is not None:
+    return mask
+  try:
+    directory = os.path.dirname(cache_file)
+    if directory and not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # another process might have created it in the meantime
+        if not os.path.isdir(directory):
+          raise
+    with cache_lock(cache_file + '.lock'):
+      # the mask might have been cached by another process, while we were waiting for the lock
+      mask = read_if_valid()
+      if mask is None:
+        mask = read_mask(mask_file)
+        write_compressed_mask(cache_file, mask, stat)
+  except (IOError, OSError) as e:
+    logger.warn("The mask cannot be cached in '%s': %s", cache_file, e)
+    if mask is None:
+      mask = read_mask(mask_file)
+  return mask
+
+
+# the number of mask rows that are processed at once
+mask_block_size = 1024
+
+def used_models(mask, model_count):
+  """Returns a boolean array defining which of the models (i.e., mask columns) are used by the given mask."""
+  if mask is None:
+    return numpy.ones(model_count, dtype=bool)
+  used = numpy.zeros(model_count, dtype=bool)
+  for first in range(0, mask.shape[0], mask_block_size):
+    used |= (numpy.asarray(mask[first : first + mask_block_size]) > 0).any(axis=0)
+  return used
+
+def model_weights(mask, model_count):
+  """Returns the number of probes that are compared to each of the models (i.e., the non-zero entries of each mask column).
+  Without mask, all models have the same weight."""
+  if mask is None:
+    return numpy.ones(model_count, dtype=numpy.int64)
+  weights = numpy.zeros(model_count, dtype=numpy.int64)
+  for first in range(0, mask.shape[0], mask_block_size):
+    weights += (numpy.asarray(mask[first : first + mask_block_size]) > 0).sum(axis=0)
+  return weights
+
+def sharded(weights, shard_index, num_shards):
+  """Partitions the items with the given weights into ``num_shards`` shards with (approximately) equal sums of weights.
+  The partition is deterministic: heavier items are distributed first, each to the shard with the lowest total weight so far.
+
+  Returns a boolean array defining which of the items belong to the shard with the given index."""
+  loads = [(0, s) for s in range(num_shards)]
+  selected = numpy.zeros(len(weights), dtype=bool)
+  for index in numpy.argsort(-numpy.asarray(weights), kind='stable'):
+    load, s = heapq.heappop(loads)
+    selected[index] = s == shard_index
+    heapq.heappush(loads, (load + int(weights[index]), s))
+  return selected
+
+def used_probes(mask, models, probe_count):
+  """Returns a boolean array defining which of the probes (i.e., mask rows) are used by the given boolean array of selected models."""
+  if mask is None:
+    return numpy.repeat(models.any(), probe_count)
+  columns = numpy.flatnonzero(models)
+  used = numpy.zeros(probe_count, dtype=bool)
+  if len(columns) == 0:
+    return used
+  for first in range(0, mask.shape[0], mask_block_size):
+    block = numpy.asarray(mask[first : first + mask_block_size])
+    if len(columns) < len(models):
+      block = block[:, columns]
+    used[first : first + len(block)] = (block > 0).any(axis=1)
+  return used
+
+def probe_weights(mask, models, probe_count):
+  """Returns the number of the given selected models (boolean array) that each of the probes (i.e., mask rows) is compared to."""
+  if mask is None:
+    return numpy.repeat(int(models.sum()), probe_count).astype(numpy.int64)
+  columns = numpy.flatnonzero(models)
+  weights = numpy.zeros(probe_count, dtype=numpy.int64)
+  if len(columns) == 0:
+    return weights
+  for first in range(0, mask.shape[0], mask_block_size):
+    block = numpy.asarray(mask[first : first + mask_block_size])
+    if len(columns) < len(models):
+      block = block[:, columns]
+    weights[first : first + len(block)] = (block > 0).sum(axis=1)
+  return weights
+
+
+def sample_ranks(random_state, total, count):
+  """Draws ``count`` distinct integers out of ``range(total)`` without enumerating the range, unless most of it is drawn; returns them sorted."""
+  count = min(count, total)
+  if 2 * count > total:
+    return numpy.sort(random_state.permutation(total)[:count])
+  ranks = set()
+  while len(ranks) < count:
+    ranks.update(random_state.randint(0, total, count - len(ranks)).tolist())
+  return numpy.array(sorted(ranks), dtype=numpy.int64)
+
+def equal_quotas(random_state, totals, count):
+  """Distributes ``count`` items as equally as possible over strata with the given numbers of available items.
+  Strata, which cannot fill their share, pass the remainder to the others; the last items are assigned to randomly chosen strata."""
+  quotas = numpy.zeros(len(totals), dtype=numpy.int64)
+  remaining = min(count, int(totals.sum()))
+  while remaining > 0:
+    active = numpy.flatnonzero(quotas < totals)
+    share = remaining // len(active)
+    if share == 0:
+      quotas[random_state.choice(active, remaining, replace=False)] += 1
+      break
+    added = numpy.minimum(share, totals[active] - quotas[active])
+    quotas[active] += added
+    remaining -= int(added.sum())
+  return quotas
+
+def sample_units(weights, count, strata=None, seed=None):
+  """Draws ``count`` distinct items out of units (e.g., probes), which contain the given numbers of items (e.g., comparisons) each.
+
+  If ``strata`` (e.g., client codes of the units) are given, the items are distributed as equally as possible over the strata, see :py:func:`equal_quotas`.
+  Items are drawn by their rank, without enumerating all items.
+
+  Returns: a tuple (units, offsets), which contains the unit of each drawn item and the index of the item within its unit, sorted by units and offsets
+  """
+  random_state = numpy.random.RandomState(seed)
+  weights = numpy.asarray(weights, dtype=numpy.int64)
+  if strata is None:
+    strata = numpy.zeros(len(weights), dtype=numpy.int64)
+  else:
+    strata = numpy.unique(numpy.asarray(strata), return_inverse=True)[1].reshape(-1)
+  totals = numpy.bincount(strata, weights=weights, minlength=int(strata.max()) + 1 if len(strata) else 0).astype(numpy.int64)
+  quotas = equal_quotas(random_state, totals, count) if len(totals) > 1 else numpy.minimum(totals, count)
+
+  # ranks of the items, where the units are grouped by their strata
+  order = numpy.argsort(strata, kind='stable')
+  ends = numpy.cumsum(weights[order])
+  starts = numpy.concatenate(([0], numpy.cumsum(totals)[:-1]))
+  ranks = [starts[s] + sample_ranks(random_state, int(totals[s]), int(quotas[s])) for s in numpy.flatnonzero(quotas)]
+  ranks = numpy.concatenate(ranks) if ranks else numpy.zeros(0, dtype=numpy.int64)
+
+  positions = numpy.searchsorted(ends, ranks, side='right')
+  units = order[positions]
+  offsets = ranks - (ends[positions] - weights[units])
+  sorted_indices = numpy.lexsort((offsets, units))
+  return units[sorted_indices], offsets[sorted_indices]
+
+
 
 ###############################################################
 ##### annotations ###############################################
@@ -297,22 +1179,306 @@ def get_mask(base_dir, protocol, mask_type):
 global annotations
 annotations = None
 
-def get_annotations(base_dir, file_id):
-  """Returns the eye, mouth and nose positions for the given file id."""
-  global annotations
+def load_annotations(base_dir):
+  """Reads the annotations (if they have not been read yet) and returns the dictionary of annotations for all file ids."""
+  global annotations, metadata
   # check if annotations need to be read
   if not annotations:
-    # read annotations file
-    metadata_files = [os.path.join(base_dir, meta_data_dir%{'v':v}, "FRGC_2.0_Metadata.xml") for v in dir_variants]
-    found = None
-    for f in metadata_files:
-      if os.path.exists(f):
-        found = f
-    if found is None:
-      raise xml.sax.SAXException("Could not find one of the metadata file '%s'. Your FRGC base directory '%s' seems to be wrong or incomplete."%(metadata_files, base_dir))
-#    print "Reading positions file '" + metadata_file + "'"
-    annotation_reader = AnnotationFileReader()
-    xml.sax.parse(found, annotation_reader)
-    annotations = annotation_reader.m_annotation_map
-
-  return annotations[file_id]
+    with load_lock(('annotations',)):
+      # another thread might have read the annotations, while we were waiting for the lock
+      if annotations:
+        return annotations
+      # read annotations file
+      metadata_files = [os.path.join(base_dir, meta_data_dir%{'v':v}, "FRGC_2.0_Metadata.xml") for v in dir_variants]
+      found = None
+      for f in metadata_files:
+        if os.path.exists(f):
+          found = f
+      if found is None:
+        raise xml.sax.SAXException("Could not find one of the metadata file '%s'. Your FRGC base directory '%s' seems to be wrong or incomplete."%(metadata_files, base_dir))
+      def parse():
+#        print "Reading positions file '" + metadata_file + "'"
+        annotation_reader = AnnotationFileReader()
+        xml.sax.parse(found, annotation_reader)
+        return annotation_reader.m_annotation_map, annotation_reader.m_metadata_map
+      stat = source_stat(found)
+      if cache_directory is None:
+        annotation_map, metadata_map = parse()
+      else:
+        annotation_map, metadata_map = cached('annotations', stat, read_cached_annotations, parse, write_cached_annotations)
+      annotations = annotation_map
+      # the metadata is read in the same pass
+      metadata = Metadata(metadata_map)
+      source_files[('annotations',)] = stat
+
+  return annotations
+
+def write_cached_annotations(maps, cache_file):
+  """Writes the given annotation and metadata maps into the given JSON cache file."""
+  with open(cache_file, 'w') as f:
+    json.dump({'annotations' : maps[0], 'metadata' : maps[1]}, f)
+
+def read_cached_annotations(cache_file):
+  """Reads the annotation and metadata maps written by :py:func:`write_cached_annotations`."""
+  with open(cache_file) as f:
+    maps = json.load(f)
+  annotation_map = dict((file_id, dict((key, tuple(position)) for key, position in positions.items())) for file_id, positions in maps['annotations'].items())
+  return annotation_map, maps['metadata']
+
+def get_annotations(base_dir, file_id):
+  """Returns the eye, mouth and nose positions for the given file id."""
+  return load_annotations(base_dir)[file_id]
+
+def get_metadata(base_dir):
+  """Returns the :py:class:`Metadata` of all recordings, which is read together with the annotations."""
+  load_annotations(base_dir)
+  return metadata
+
+
+global metadata
+metadata = None
+
+# the formats of dates in the metadata
+date_pattern = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$')
+
+def typed_column(values):
+  """Converts the given list of strings (or None for missing values) into a typed numpy array.
+  Integral, floating point and date (month/day/year) columns are detected; missing values are NaN or NaT, respectively.
+  All other columns are unicode strings, where missing values are empty."""
+  present = [v for v in values if v is not None]
+  for dtype in (numpy.int64, numpy.float64):
+    try:
+      converted = [dtype(v) for v in present]
+    except ValueError:
+      continue
+    if dtype is numpy.int64 and len(present) == len(values):
+      return numpy.array(converted, dtype=numpy.int64)
+    return numpy.array([numpy.nan if v is None else float(v) for v in values], dtype=numpy.float64)
+  matches = [date_pattern.match(v) for v in present]
+  if present and all(matches):
+    dates = iter('%s-%02d-%02d' % (m.group(3), int(m.group(1)), int(m.group(2))) for m in matches)
+    return numpy.array(['NaT' if v is None else next(dates) for v in values], dtype='datetime64[D]')
+  return numpy.array(['' if v is None else v for v in values], dtype=str)
+
+
+class Metadata:
+  """The metadata of all FRGC recordings, stored as typed columns keyed by presentation (file) id.
+
+  The attributes of each Recording are stored under their names, e.g., ``'subject_id'``,
+  the attributes of child and ancestor elements are prefixed with the element name, e.g., ``'Lighting.type'``.
+  """
+  def __init__(self, records):
+    self.ids = numpy.array(sorted(records), dtype=str)
+    self.m_rows = dict((file_id, row) for row, file_id in enumerate(self.ids.tolist()))
+    names = sorted(set(name for record in records.values() for name in record))
+    self.columns = dict((name, typed_column([records[file_id].get(name) for file_id in self.m_rows])) for name in names)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __contains__(self, file_id):
+    return file_id in self.m_rows
+
+  def __getitem__(self, name):
+    """Returns the column of the given attribute."""
+    if name not in self.columns:
+      raise ValueError("The metadata attribute '%s' is not known; known attributes are %s." % (name, sorted(self.columns)))
+    return self.columns[name]
+
+  def rows(self, file_ids):
+    """Returns the rows of the given file ids, where unknown file ids get the row -1."""
+    return numpy.array([self.m_rows.get(file_id, -1) for file_id in file_ids], dtype=numpy.int64)
+
+  def record(self, file_id):
+    """Returns the dictionary of all attributes of the given file id."""
+    row = self.m_rows[file_id]
+    return dict((name, column[row].item()) for name, column in self.columns.items())
+
+  def select(self, filters):
+    """Evaluates the given attribute filters on all rows and returns a boolean array of the selected rows.
+
+    The filters are a dictionary from attribute name to:
+
+    * a callable, which is evaluated on the whole column and returns a boolean array, e.g., ``lambda dates: dates >= numpy.datetime64('2003-01-01')``,
+    * a list, tuple or set of values, one of which the attribute must have,
+    * or a single value, which the attribute must have.
+    """
+    def values(column, values):
+      # dates might be given as strings
+      return numpy.array(values, dtype=column.dtype) if column.dtype.kind == 'M' else numpy.asarray(values)
+
+    selected = numpy.ones(len(self.ids), dtype=bool)
+    for name, condition in filters.items():
+      column = self[name]
+      if callable(condition):
+        selected &= numpy.asarray(condition(column), dtype=bool)
+      elif isinstance(condition, (list, tuple, set, frozenset)):
+        selected &= numpy.isin(column, values(column, list(condition)))
+      else:
+        selected &= column == values(column, condition)
+    return selected
+
+  def selected(self, filters, file_ids):
+    """Returns a boolean array defining which of the given file ids fulfill the given filters; file ids without metadata are not selected."""
+    rows = self.rows(file_ids)
+    if not len(self.ids):
+      return numpy.zeros(len(rows), dtype=bool)
+    return (rows >= 0) & self.select(filters)[rows]
+
+def metadata_selected(base_dir, frgc_files, filters):
+  """Returns a boolean array defining which of the given FRGCFile's fulfill the given metadata filters (see :py:meth:`Metadata.select`).
+  For file sets, all files need to fulfill the filters."""
+  indices, offsets = presentation_arrays(frgc_files)
+  selected = get_metadata(base_dir).selected(filters, [presentation_ids[i] for i in indices])
+  rejected = numpy.concatenate(([0], numpy.cumsum(~selected)))
+  return rejected[offsets[1:]] == rejected[offsets[:-1]]
+
+
+
+###############################################################
+##### refreshing ################################################
+
+def refresh(base_dir):
+  """Reloads all lists, masks and annotations, whose source files have changed since they have been read.
+  All registered invalidation listeners are informed about the changed sources before they are reloaded.
+  Presentations stay in the presentation table, while their paths and clients are updated when they are read again.
+
+  .. note ::
+     The models of reloaded lists get new model ids.
+
+  Returns a list of keys of the sources that have been reloaded."""
+  global annotations, metadata
+  changed = sorted(key for key in list(source_files) if source_changed(key))
+
+  for key in changed:
+    del source_files[key]
+    if key[0] == 'list':
+      # drop the list and its models
+      for g in loaded_lists().get(key, []):
+        model_dict.pop(g.m_model, None)
+      store_list(key, None)
+    elif key[0] == 'mask':
+      known_masks[key[1]][key[2]] = None
+    elif key[0] == 'annotations':
+      annotations = None
+      metadata = None
+
+  for key in changed:
+    for listener in list(invalidation_listeners):
+      listener(key)
+
+  # reload what has changed
+  for key in changed:
+    if key[0] == 'list':
+      get_list(base_dir, *key[1:])
+    elif key[0] == 'mask':
+      get_mask(base_dir, key[1], key[2])
+    elif key[0] == 'annotations':
+      load_annotations(base_dir)
+
+  return changed
+
+
+def clear():
+  """Drops all lists, masks and annotations that have been read, e.g., before reading the files of another FRGC base directory.
+  All registered invalidation listeners are informed about the dropped sources.
+  Presentations stay in the presentation table."""
+  global annotations, metadata
+  keys = list(loaded_lists()) + [('mask', protocol, mask_type) for protocol in sorted(known_masks) for mask_type in sorted(known_masks[protocol]) if known_masks[protocol][mask_type] is not None]
+  if annotations is not None:
+    keys.append(('annotations',))
+  for key in keys:
+    if key[0] == 'list':
+      store_list(key, None)
+    elif key[0] == 'mask':
+      known_masks[key[1]][key[2]] = None
+  model_dict.clear()
+  source_files.clear()
+  annotations = None
+  metadata = None
+  for key in keys:
+    for listener in list(invalidation_listeners):
+      listener(key)
+
+
+###############################################################
+##### snapshots ###############################################
+
+def snapshot():
+  """Returns a compact snapshot of all lists that have been read so far, which can be restored in another process by :py:func:`restore_snapshot`.
+
+  The snapshot contains the presentation table as newline-separated strings, and for each list the client ids (as strings),
+  the model ids, and the presentation indices of its entries (as integer arrays).
+  Masks and annotations are not included; they are read again from their source files (or from the mask cache) on need.
+  """
+  with presentation_lock:
+    state = {'presentation_ids' : '\n'.join(presentation_ids),
+             'presentation_paths' : '\n'.join(presentation_paths),
+             'presentation_clients' : '\n'.join(presentation_clients)}
+  for key, frgc_files in loaded_lists().items():
+    name = 'list:' + '/'.join(key[1:])
+    indices, offsets = presentation_arrays(frgc_files)
+    state[name + ':signatures'] = '\n'.join(f.m_signature for f in frgc_files)
+    state[name + ':models'] = numpy.array([f.m_model for f in frgc_files], dtype=numpy.int64)
+    state[name + ':presentations'] = indices
+    state[name + ':offsets'] = offsets
+    if key in source_files:
+      state[name + ':source'] = json.dumps(source_files[key])
+  return state
+
+def restore_snapshot(state):
+  """Restores the lists of the given snapshot, including their model ids, which replace the lists that have been read in this process.
+  Lists with model ids that collide with the ones of the snapshot are dropped, they are read again with new model ids on need."""
+  def split(text):
+    return text.split('\n') if text else []
+
+  # map the presentation indices of the snapshot to the ones of this process
+  mapping = numpy.array([intern_presentation(*presentation) for presentation in zip(split(state['presentation_ids']), split(state['presentation_paths']), split(state['presentation_clients']))], dtype=numpy.int64)
+
+  restored = [key for key in all_lists if 'list:%s:models' % '/'.join(key[1:]) in state]
+  # lists that are already loaded with the same model ids are kept
+  loaded = loaded_lists()
+  restored = [key for key in restored if key not in loaded or [f.m_model for f in loaded[key]] != numpy.asarray(state['list:%s:models' % '/'.join(key[1:])]).tolist()]
+  models = set()
+  for key in restored:
+    models.update(int(m) for m in state['list:%s:models' % '/'.join(key[1:])])
+
+  # drop the lists that are replaced or that would have the same model ids
+  changed = set(restored)
+  for key, frgc_files in loaded.items():
+    if key in changed or any(f.m_model in models for f in frgc_files):
+      for f in frgc_files:
+        model_dict.pop(f.m_model, None)
+      store_list(key, None)
+      source_files.pop(key, None)
+      changed.add(key)
+
+  for key in restored:
+    name = 'list:' + '/'.join(key[1:])
+    indices, offsets = mapping[numpy.asarray(state[name + ':presentations'], dtype=numpy.int64)].tolist(), numpy.asarray(state[name + ':offsets']).tolist()
+    frgc_files = []
+    for index, (signature, model) in enumerate(zip(split(state[name + ':signatures']), numpy.asarray(state[name + ':models']).tolist())):
+      frgc_file = FRGCFile(signature, model)
+      frgc_file.m_presentations = tuple(indices[offsets[index] : offsets[index + 1]])
+      model_dict[model] = frgc_file.m_signature
+      frgc_files.append(frgc_file)
+    store_list(key, frgc_files)
+    if name + ':source' in state:
+      source_files[key] = tuple(json.loads(str(state[name + ':source'])))
+
+  for key in sorted(changed):
+    for listener in list(invalidation_listeners):
+      listener(key)
+
+def save_snapshot(filename, state):
+  """Writes the given snapshot to the given ``.npz`` file."""
+  numpy.savez(filename, **dict((name, numpy.asarray(value)) for name, value in state.items()))
+
+def load_snapshot(filename):
+  """Reads a snapshot written by :py:func:`save_snapshot`."""
+  state = {}
+  with numpy.load(filename) as arrays:
+    for name in arrays.files:
+      value = arrays[name]
+      state[name] = value.item() if value.ndim == 0 else value
+  return state
@@ -5,7 +5,14 @@
 FRGC database in the most obvious ways.
 """
 
-from .models import get_list, get_mask, get_annotations, client_from_file, client_from_model, File, FileSet
+from .models import get_list, get_mask, get_annotations, get_metadata, metadata_selected, get_reverse_index, refresh, get_mask_cache_directory, set_mask_cache_directory, get_cache_directory, set_cache_directory, snapshot, restore_snapshot, save_snapshot, load_snapshot, used_models, used_probes, model_weights, probe_weights, sharded, sample_units, get_client_tables, client_from_file, client_from_model, clients_from_files, clients_from_models, presentation_arrays, presentation_ids, presentation_paths, presentation_clients, resolve_paths, File
+from .scores import write_score_file
+from .evaluate import evaluate
+from .sqlindex import SQLiteIndex
+from .loader import load_images, load_batches
+from .facecache import build_face_cache, FaceCache
+from .masks import MaskExpression
+from .server import QueryClient, NotForwardable
 
 from .driver import Interface
 interface = Interface()
@@ -16,15 +23,63 @@ import logging
 logger = logging.getLogger("bob.db.frgc")
 
 import os
+import functools
+import inspect
 import six
+import numpy
+
+
+# the arguments of the forwarded queries, which contain ids issued by the server process
+server_id_arguments = ('model_id', 'model_ids')
+
+def forwarded(method):
+  """Forwards the decorated query to the query server, if the :py:class:`Database` is a client of it.
+  Queries, whose arguments cannot be sent to the server (e.g., lambda functions), are executed locally,
+  unless they contain model ids, which are only valid in the server process; in this case, the :py:class:`NotForwardable` error is re-raised."""
+  @functools.wraps(method)
+  def query(self, *args, **kwargs):
+    if self.m_client is not None:
+      try:
+        return self.m_client.call(method.__name__, args, kwargs)
+      except NotForwardable as e:
+        arguments = inspect.getcallargs(method, self, *args, **kwargs)
+        if any(arguments.get(name) is not None for name in server_id_arguments):
+          raise
+        logger.debug("Executing the query locally: %s", e)
+    return method(self, *args, **kwargs)
+  return query
 
 
 class Database(bob.db.base.Database):
   """The Database class reads the original XML lists and provides access
   using the common bob.db API.
+
+  If an ``sqlite_file`` is given (see ``bob_dbmanage.py frgc create``), the queries :py:meth:`objects`, :py:meth:`model_ids`, :py:meth:`client_ids` and :py:meth:`annotations`,
+  as well as the client id lookups are answered from this SQLite index instead.
+
+  .. warning ::
+    The model ids of the SQLite index are stable, but they differ from the model ids generated when reading the XML lists, which are used by all other functions.
+
+  If a ``mask_cache_directory`` is given, the masks are cached there in a compressed format, which is much faster to read than the original masks on slow (network) storage.
+  Cached masks are used only if the modification time and size of the original mask file are unchanged.
+
+  If a ``cache_directory`` is given, the parsed lists, the reverse index over them, the masks and the annotations are cached there, so that many processes (e.g., grid jobs) starting at once read the original files only once.
+  Each cache file is built by one process under a file lock, while the other processes wait and then read it.
+  The cache files are tied to the modification time and size of the original files, and they are rebuilt when these change.
+  Masks are stored in the same compressed format and under the same file lock in both directories.
+  If both directories are given, the masks are cached in the ``mask_cache_directory``, and everything else in the ``cache_directory``.
+
+  If a ``server_socket`` is given, this database is a thin client of a query server (see ``bob_dbmanage.py frgc serve``),
+  which keeps all lists, masks and annotations in memory.
+  The queries :py:meth:`objects`, :py:meth:`model_ids`, :py:meth:`client_ids`, :py:meth:`annotations`, the count functions, :py:meth:`cost_estimate`
+  and the client id lookups are forwarded to the server, while all other functions are executed locally.
+
+  .. warning ::
+    The model ids returned by the server are those of the server process; they should only be passed to other queries that are forwarded to the server.
+    Queries with model ids, whose arguments cannot be sent to the server, raise a :py:class:`NotForwardable` error instead of being executed locally.
   """
 
-  def __init__(self, original_directory=interface.frgc_database_directory(), original_extension='.jpg'):
+  def __init__(self, original_directory=interface.frgc_database_directory(), original_extension='.jpg', sqlite_file=None, mask_cache_directory=None, cache_directory=None, server_socket=None):
     # NOTE: For some images, the image extension is '.JPG' instead.
     # this interface will keep track of this automatically and always return
     # the correct image name
@@ -42,6 +97,20 @@ class Database(bob.db.base.Database):
     # usually, only maskIII (the most difficult one) is used.
     self.m_mask_types = ('maskI', 'maskII', 'maskIII')
 
+    if mask_cache_directory is not None:
+      set_mask_cache_directory(mask_cache_directory)
+    if cache_directory is not None:
+      set_cache_directory(cache_directory)
+
+    # the optional SQLite index
+    self.m_index = SQLiteIndex(sqlite_file) if sqlite_file is not None else None
+    # the face caches that have been opened
+    self.m_face_caches = {}
+    # the optional connection to the query server
+    self.m_client = QueryClient(server_socket) if server_socket is not None else None
+    # the snapshot file that is shipped with pickled copies of this database
+    self.m_snapshot_file = None
+
   def groups(self, protocol=None):
     """Returns a list of groups for the given protocol
 
@@ -61,6 +130,7 @@ class Database(bob.db.base.Database):
         protocol, 'protocol', self.m_protocols)
     return protocol == '2.0.2'
 
+  @forwarded
   def client_ids(self, groups=None, protocol=None, purposes=None, mask_type='maskIII'):
     """Returns a list of client ids for the specific query by the user.
 
@@ -79,12 +149,21 @@ class Database(bob.db.base.Database):
       For some protocol/mask_type pairs, not all clients are used for enrollment / for probe.
 
     mask_type
-      One of the mask types ('maskI', 'maskII', 'maskIII').
+      One of the mask types ('maskI', 'maskII', 'maskIII') or a mask expression of :py:mod:`bob.db.frgc.masks`.
 
     Returns: A list containing all the client id's which have the given properties.
     """
     groups = self.check_parameters_for_validity(groups, "group", self.m_groups)
 
+    if self.m_index is not None:
+      purposes = self.check_parameters_for_validity(
+          purposes, "purpose", self.m_purposes)
+      if 'dev' in groups:
+        protocol = self.check_parameter_for_validity(
+            protocol, "protocol", self.m_protocols)
+      mask_type = self._check_mask_type(mask_type)
+      return self.m_index.client_ids(groups, protocol, purposes, mask_type)
+
     retval = set()
 
     if 'world' in groups:
@@ -97,9 +176,7 @@ class Database(bob.db.base.Database):
           purposes, "purpose", self.m_purposes)
       protocol = self.check_parameter_for_validity(
           protocol, "protocol", self.m_protocols)
-      if mask_type is not None:
-        mask_type = self.check_parameter_for_validity(
-            mask_type, "mask type", self.m_mask_types)
+      mask_type = self._check_mask_type(mask_type)
 
       # take only those models/probes that are really required by the current
       # mask
@@ -108,22 +185,22 @@ class Database(bob.db.base.Database):
       if 'enroll' in purposes:
         files = get_list(self.original_directory, 'dev',
                          protocol, purpose='enroll')
-        for index in range(len(files)):
-          # check if this model is used by the mask
-          if mask is None or (mask[:, index] > 0).any():
-            retval.add(files[index].m_signature)
+        # check which models are used by the mask
+        for index in numpy.flatnonzero(used_models(mask, len(files))):
+          retval.add(files[index].m_signature)
 
       if 'probe' in purposes:
         files = get_list(self.original_directory, 'dev',
                          protocol, purpose='probe')
-        for index in range(len(files)):
-          # check if this probe is used by the mask
-          if mask is None or (mask[index, :] > 0).any():
-            retval.add(files[index].m_signature)
+        models = numpy.ones(mask.shape[1] if mask is not None else 1, dtype=bool)
+        # check which probes are used by the mask
+        for index in numpy.flatnonzero(used_probes(mask, models, len(files))):
+          retval.add(files[index].m_signature)
 
     return sorted(list(retval))
 
-  def model_ids(self, groups=None, protocol=None, mask_type='maskIII'):
+  @forwarded
+  def model_ids(self, groups=None, protocol=None, mask_type='maskIII', shard_index=None, num_shards=None):
     """Returns a set of model ids for the specific query by the user.
 
     The models are dependent on the protocol and the mask.
@@ -143,34 +220,40 @@ class Database(bob.db.base.Database):
       required only if one of the groups is 'dev'.
 
     mask_type
-      One of the mask types ('maskI', 'maskII', 'maskIII').
+      One of the mask types ('maskI', 'maskII', 'maskIII') or a mask expression of :py:mod:`bob.db.frgc.masks`.
+
+    shard_index, num_shards
+      If given, only the models of the shard with the given index are returned, see :py:meth:`objects` for details.
 
     Returns: A list containing all the model id's belonging to the given group.
     """
     groups = self.check_parameters_for_validity(groups, "group", self.m_groups)
-    # for models, purpose is always 'enroll'
-    purpose = 'enroll'
+    shard = self._check_shard(shard_index, num_shards)
+
+    if self.m_index is not None:
+      if 'dev' in groups:
+        protocol = self.check_parameter_for_validity(
+            protocol, "protocol", self.m_protocols)
+      mask_type = self._check_mask_type(mask_type)
+      return self.m_index.model_ids(groups, protocol, mask_type, shard)
 
     retval = set()
     if 'world' in groups:
-      for file in get_list(self.original_directory, 'world'):
-        retval.add(file.m_model)
+      files = get_list(self.original_directory, 'world')
+      for index in numpy.flatnonzero(self._world_models(files, shard)):
+        retval.add(files[index].m_model)
 
     if 'dev' in groups:
       protocol = self.check_parameter_for_validity(
           protocol, "protocol", self.m_protocols)
-      if mask_type is not None:
-        mask_type = self.check_parameter_for_validity(
-            mask_type, "mask type", self.m_mask_types)
-      files = get_list(self.original_directory, 'dev', protocol, purpose)
+      mask_type = self._check_mask_type(mask_type)
       # take only those models that are really required by the current mask
-      mask = get_mask(self.original_directory, protocol, mask_type)
-      for index in range(len(files)):
-        if mask is None or (mask[:, index] > 0).any():
-          retval.add(files[index].m_model)
+      for file in self._dev_files(protocol, ('enroll',), None, mask_type, shard)['enroll']:
+        retval.add(file.m_model)
 
     return sorted(list(retval))
 
+  @forwarded
   def get_client_id_from_model_id(self, model_id, **kwargs):
     """Returns the client_id attached to the given model_id.
 
@@ -185,8 +268,11 @@ class Database(bob.db.base.Database):
 
     Returns: The client_id attached to the given model_id
     """
-    return client_from_model(model_id)
+    if self.m_index is not None:
+      return self.m_index.client_from_model(model_id)
+    return client_from_model(model_id, self.original_directory)
 
+  @forwarded
   def get_client_id_from_file_id(self, file_id, **kwargs):
     """Returns the client_id (real client id) attached to the given file_id
 
@@ -197,9 +283,306 @@ class Database(bob.db.base.Database):
 
     Returns: The client_id attached to the given file_id
     """
-    return client_from_file(file_id)
+    if self.m_index is not None:
+      return self.m_index.client_from_file(file_id)
+    return client_from_file(file_id, self.original_directory)
+
+  @forwarded
+  def get_client_ids_from_model_ids(self, model_ids):
+    """Returns the client ids attached to the given model ids at once.
+
+    Keyword Parameters:
+
+    model_ids
+      A list or array of model ids, which must have been the result of previous calls to model_ids() of the **same** database object.
+
+    Returns: An array of client ids, one for each of the given model_ids; a ValueError is raised if any model id is unknown
+    """
+    if self.m_index is not None:
+      unique, inverse = numpy.unique(numpy.asarray(model_ids, dtype=numpy.int64).reshape(-1), return_inverse=True)
+      return numpy.array([self.m_index.client_from_model(int(model_id)) for model_id in unique], dtype=str)[inverse.reshape(-1)]
+    return clients_from_models(model_ids, self.original_directory)
+
+  @forwarded
+  def get_client_ids_from_file_ids(self, file_ids):
+    """Returns the client ids attached to the given file ids at once, e.g., for all lines of a score file.
+
+    Keyword Parameters:
+
+    file_ids
+      A list or array of file ids, which might contain duplicates
+
+    Returns: An array of client ids, one for each of the given file_ids; a ValueError is raised if any file id is unknown
+    """
+    if self.m_index is not None:
+      unique, inverse = numpy.unique(numpy.asarray(file_ids, dtype=str), return_inverse=True)
+      return numpy.array([self.m_index.client_from_file(file_id) for file_id in unique.tolist()], dtype=str)[inverse.reshape(-1)]
+    return clients_from_files(file_ids, self.original_directory)
+
+  def get_files_from_client_id(self, client_id):
+    """Returns all File objects of the given client, from all FRGC lists.
+
+    Keyword Parameters:
+
+    client_id
+      The client id to consider
+
+    Returns: A sorted list of File objects
+    """
+    return get_reverse_index(self.original_directory).client_files(client_id)
+
+  def get_model_ids_from_client_id(self, client_id, groups=None, protocol=None):
+    """Returns the model ids of the given client.
+
+    Keyword Parameters:
+
+    client_id
+      The client id to consider
+
+    groups
+      One or several groups to which the models belong ('world', 'dev').
+
+    protocol
+      One or several of the FRGC protocols ('2.0.1', '2.0.2, '2.0.4'), used only for the group 'dev'.
+
+    Returns: A sorted list of model ids, irrespective of the mask
+    """
+    groups = self.check_parameters_for_validity(groups, "group", self.m_groups)
+    protocols = self.check_parameters_for_validity(
+        protocol, "protocol", self.m_protocols)
+    return sorted(model_id for key, model_id in get_reverse_index(self.original_directory).client_models(client_id) if key[1] in groups and (key[1] == 'world' or key[2] in protocols))
+
+  def get_model_ids_from_file_id(self, file_id):
+    """Returns the ids of all models (of the 'world' and 'dev' groups) that contain the given file.
+
+    Keyword Parameters:
+
+    file_id
+      The file_id to consider
+
+    Returns: A sorted list of model ids
+    """
+    return sorted(get_reverse_index(self.original_directory).file_models(file_id))
+
+  def get_lists_from_file_id(self, file_id):
+    """Returns the FRGC lists that contain the given file.
+
+    Keyword Parameters:
+
+    file_id
+      The file_id to consider
+
+    Returns: A list of list keys such as ``('list', 'world')``, ``('list', 'dev', '2.0.2')`` or ``('list', 'dev', '2.0.4', 'probe')``
+    """
+    return list(get_reverse_index(self.original_directory).file_lists(file_id))
+
+  def _check_mask_type(self, mask_type):
+    """Checks the given mask type, which might be one of the FRGC mask types, a :py:class:`bob.db.frgc.masks.MaskExpression`, or None."""
+    if isinstance(mask_type, MaskExpression):
+      if self.m_index is not None:
+        raise ValueError("Mask expressions are not supported by the SQLite index.")
+      return mask_type
+    if mask_type is None:
+      return None
+    return self.check_parameter_for_validity(mask_type, "mask type", self.m_mask_types)
+
+  def _check_model_ids(self, model_ids):
+    """Returns the given model ids (a single one or several) as a set for fast membership tests, or None if no model ids are given."""
+    if isinstance(model_ids, six.integer_types + six.string_types):
+      return frozenset((model_ids,))
+    if not model_ids:
+      return None
+    return frozenset(model_ids)
+
+  def _filtered(self, files, filters):
+    """Returns the given File's, whose metadata fulfill the given attribute filters."""
+    if not filters:
+      return files
+    selected = get_metadata(self.original_directory).selected(filters, [file.id for file in files])
+    return [file for file, s in zip(files, selected) if s]
+
+  def _check_shard(self, shard_index, num_shards):
+    """Checks the given sharding parameters and returns them as a tuple, or None if no sharding is requested."""
+    if shard_index is None and num_shards is None:
+      return None
+    if shard_index is None or num_shards is None:
+      raise ValueError("Please specify both the shard_index and the num_shards, or none of them.")
+    if not isinstance(shard_index, six.integer_types) or not isinstance(num_shards, six.integer_types) or not 0 <= shard_index < num_shards:
+      raise ValueError("The shard index %s is not valid for %s shards." % (shard_index, num_shards))
+    return (shard_index, num_shards)
+
+  def _world_models(self, world_files, shard):
+    """Returns a boolean array defining which of the given training FRGCFile's belong to the given shard."""
+    if shard is None:
+      return numpy.ones(len(world_files), dtype=bool)
+    return sharded(numpy.array([len(file.m_presentations) for file in world_files]), *shard)
+
+  def _dev_models(self, protocol, model_ids, mask_type, shard=None):
+    """Selects the models of the 'dev' group of the given protocol that are required by the given mask and model ids.
+    If a shard is given, only the models of this shard are selected.
+
+    Returns: a tuple (model_files, mask, models), where models is a boolean array defining the selected models
+    """
+    model_files = get_list(self.original_directory, 'dev', protocol, 'enroll')
+    mask = get_mask(self.original_directory, protocol, mask_type)
+
+    # select only those models that are used by this mask, and that have the given ids
+    if shard is None:
+      models = used_models(mask, len(model_files))
+    else:
+      # balance the shards by the number of comparisons of each model
+      weights = model_weights(mask, len(model_files))
+      models = sharded(weights, *shard) & (weights > 0)
+    if model_ids is not None:
+      models &= numpy.array([model.m_model in model_ids for model in model_files], dtype=bool)
+    return model_files, mask, models
+
+  def _dev_files(self, protocol, purposes, model_ids, mask_type, shard=None):
+    """Returns the FRGCFile's of the 'dev' group of the given protocol that are required by the given mask and model ids.
+    If a shard is given, only the models of this shard and the probes that are compared to these models are returned.
+
+    Returns: a dictionary with a list of FRGCFile's for each of the given purposes
+    """
+    model_files, mask, models = self._dev_models(protocol, model_ids, mask_type, shard)
+
+    retval = {}
+    if 'enroll' in purposes:
+      retval['enroll'] = [model_files[index] for index in numpy.flatnonzero(models)]
+    if 'probe' in purposes:
+      # select the probes that are compared to any of the selected models
+      probe_files = get_list(self.original_directory, 'dev', protocol, 'probe')
+      probes = used_probes(mask, models, len(probe_files))
+      retval['probe'] = [probe_files[index] for index in numpy.flatnonzero(probes)]
+    return retval
+
+  def _selected_files(self, groups=None, protocol=None, purposes=None, model_ids=None, mask_type='maskIII', shard_index=None, num_shards=None):
+    """Returns the FRGCFile's selected by the given query, see :py:meth:`objects` for the parameters.
+    The same FRGCFile might be returned several times."""
+    # check that every parameter is as expected
+    groups = self.check_parameters_for_validity(groups, "group", self.m_groups)
+    protocols = self.check_parameters_for_validity(
+        protocol, "protocol", self.m_protocols)
+    shard = self._check_shard(shard_index, num_shards)
+    model_ids = self._check_model_ids(model_ids)
+
+    retval = []
+    if 'world' in groups:
+      world_files = get_list(self.original_directory, 'world')
+      for index in numpy.flatnonzero(self._world_models(world_files, shard)):
+        if model_ids is None or world_files[index].m_signature in model_ids:
+          retval.append(world_files[index])
+
+    if 'dev' in groups:
+      mask_type = self._check_mask_type(mask_type)
+      purposes = self.check_parameters_for_validity(
+          purposes, "purpose", self.m_purposes)
+      for p in protocols:
+        for frgc_files in self._dev_files(p, purposes, model_ids, mask_type, shard).values():
+          retval.extend(frgc_files)
+
+    return retval
+
+  @forwarded
+  def count_objects(self, groups=None, protocol=None, purposes=None, model_ids=None, mask_type='maskIII', shard_index=None, num_shards=None, filters=None):
+    """Returns the number of File objects that :py:meth:`objects` would return for the same parameters, without creating them."""
+    presentations = set()
+    for frgc_file in self._selected_files(groups, protocol, purposes, model_ids, mask_type, shard_index, num_shards):
+      presentations.update(frgc_file.m_presentations)
+    if filters:
+      return int(get_metadata(self.original_directory).selected(filters, [presentation_ids[index] for index in presentations]).sum())
+    return len(presentations)
+
+  @forwarded
+  def count_object_sets(self, groups=None, protocol='2.0.2', purposes=None, model_ids=None, mask_type='maskIII', shard_index=None, num_shards=None, filters=None):
+    """Returns the number of FileSet objects that :py:meth:`object_sets` would return for the same parameters, without creating them."""
+    self.check_parameters_for_validity(groups, "group", ('dev',))
+    self.check_parameters_for_validity(protocol, "protocol", ('2.0.2',))
+    frgc_files = dict((frgc_file.m_model, frgc_file) for frgc_file in self._selected_files('dev', protocol, purposes, model_ids, mask_type, shard_index, num_shards))
+    if filters:
+      return int(metadata_selected(self.original_directory, list(frgc_files.values()), filters).sum())
+    return len(frgc_files)
+
+  @forwarded
+  def count_model_ids(self, groups=None, protocol=None, mask_type='maskIII', shard_index=None, num_shards=None):
+    """Returns the number of model ids that :py:meth:`model_ids` would return for the same parameters, computed from the list lengths and mask sums."""
+    groups = self.check_parameters_for_validity(groups, "group", self.m_groups)
+    shard = self._check_shard(shard_index, num_shards)
+
+    count = 0
+    if 'world' in groups:
+      count += int(self._world_models(get_list(self.original_directory, 'world'), shard).sum())
+    if 'dev' in groups:
+      protocol = self.check_parameter_for_validity(
+          protocol, "protocol", self.m_protocols)
+      mask_type = self._check_mask_type(mask_type)
+      count += int(self._dev_models(protocol, None, mask_type, shard)[2].sum())
+    return count
+
+  @forwarded
+  def count_comparisons(self, protocol='2.0.1', mask_type='maskIII', model_ids=None, shard_index=None, num_shards=None):
+    """Returns the number of comparisons between models and probes that are required by the given mask, i.e., the number of scores to compute.
+
+    Keyword Parameters:
+
+    protocol
+      One of the FRGC protocols ('2.0.1', '2.0.2', '2.0.4').
+
+    mask_type
+      One of the mask types ('maskI', 'maskII', 'maskIII') or a mask expression of :py:mod:`bob.db.frgc.masks`, or ``None`` for all pairs.
 
-  def objects(self, groups=None, protocol=None, purposes=None, model_ids=None, mask_type='maskIII'):
+    model_ids, shard_index, num_shards
+      If given, only the comparisons of the given models, or the models of the given shard are counted, see :py:meth:`objects`.
+
+    Returns: the number of comparisons
+    """
+    return self.cost_estimate(protocol, mask_type, model_ids, shard_index, num_shards)['comparisons']
+
+  @forwarded
+  def cost_estimate(self, protocol='2.0.1', mask_type='maskIII', model_ids=None, shard_index=None, num_shards=None, dtype='float32'):
+    """Estimates the cost of an experiment, without creating any File objects.
+
+    Keyword Parameters:
+
+    protocol
+      One of the FRGC protocols ('2.0.1', '2.0.2', '2.0.4').
+
+    mask_type
+      One of the mask types ('maskI', 'maskII', 'maskIII') or a mask expression of :py:mod:`bob.db.frgc.masks`, or ``None`` for all pairs.
+
+    model_ids, shard_index, num_shards
+      If given, only the given models, or the models of the given shard are taken into account, see :py:meth:`objects`.
+
+    dtype
+      The data type of the scores, used to compute the size of the score matrix.
+
+    Returns: a dictionary with the number of ``'models'``, ``'probes'`` and ``'comparisons'``,
+    the ``'score_matrix_shape'`` (probes x models) and ``'score_matrix_bytes'`` of a dense score matrix of the selected models and probes,
+    and the ``'full_matrix_shape'`` and ``'full_matrix_bytes'`` of the score matrix over the full lists (laid out as the masks).
+    """
+    protocol = self.check_parameter_for_validity(
+        protocol, "protocol", self.m_protocols)
+    mask_type = self._check_mask_type(mask_type)
+    model_files, mask, models = self._dev_models(protocol, self._check_model_ids(model_ids), mask_type, self._check_shard(shard_index, num_shards))
+    probe_count = len(get_list(self.original_directory, 'dev', protocol, 'probe'))
+    probes = int(used_probes(mask, models, probe_count).sum())
+    if mask is None:
+      comparisons = int(models.sum()) * probe_count
+    else:
+      comparisons = int(model_weights(mask, len(model_files))[models].sum())
+
+    itemsize = numpy.dtype(dtype).itemsize
+    return {
+      'models' : int(models.sum()),
+      'probes' : probes,
+      'comparisons' : comparisons,
+      'score_matrix_shape' : (probes, int(models.sum())),
+      'score_matrix_bytes' : probes * int(models.sum()) * itemsize,
+      'full_matrix_shape' : (probe_count, len(model_files)),
+      'full_matrix_bytes' : probe_count * len(model_files) * itemsize,
+    }
+
+  @forwarded
+  def objects(self, groups=None, protocol=None, purposes=None, model_ids=None, mask_type='maskIII', shard_index=None, num_shards=None, filters=None):
     """Using the specified restrictions, this function returns a list of File objects.
 
     Keyword Parameters:
@@ -227,13 +610,25 @@ class Database(bob.db.base.Database):
         whereas for group 'dev' model ids are real model ids (as returned by 'model_ids()')
 
     mask_type
-      One of the mask types ('maskI', 'maskII', 'maskIII').
+      One of the mask types ('maskI', 'maskII', 'maskIII') or a mask expression of :py:mod:`bob.db.frgc.masks`.
+
+    shard_index, num_shards
+      If given, the models are partitioned deterministically into ``num_shards`` shards, and only the files of the shard with index ``shard_index`` are returned.
+      In the 'dev' group, shards are balanced by the number of comparisons (i.e., non-zero mask entries) of their models,
+      and the returned probe files are those that are compared to the models of the shard.
+      In the 'world' group, the training signatures are partitioned, balanced by their number of files.
+
+    filters
+      If given, only the files are returned, whose metadata fulfill these attribute filters, see :py:meth:`metadata`.
+      For example, ``filters = {'environment' : 'controlled'}`` selects the files recorded under controlled conditions.
     """
     def extend_files(files, frgc_file):
       """Extends the given file list with File's created from the given FRGCFile."""
-      for presentation in frgc_file.m_files:
-        files[presentation] = File(
-            frgc_file.m_signature, presentation, frgc_file.m_files[presentation])
+      for index in frgc_file.m_presentations:
+        presentation = presentation_ids[index]
+        if presentation not in files:
+          files[presentation] = File(
+              frgc_file.m_signature, presentation, presentation_paths[index])
 
     # check that every parameter is as expected
     groups = self.check_parameters_for_validity(groups, "group", self.m_groups)
@@ -241,61 +636,22 @@ class Database(bob.db.base.Database):
     protocols = self.check_parameters_for_validity(
         protocol, "protocol", self.m_protocols)
 
-    if isinstance(model_ids, six.integer_types):
-      model_ids = (model_ids,)
+    if self.m_index is not None:
+      shard = self._check_shard(shard_index, num_shards)
+      mask_type = self._check_mask_type(mask_type)
+      purposes = self.check_parameters_for_validity(
+          purposes, "purpose", self.m_purposes)
+      return self._filtered(self.m_index.objects(groups, protocols, purposes, self._check_model_ids(model_ids), mask_type, shard), filters)
 
+    # each selected training signature and dev model or probe is expanded exactly once
     files = {}
+    for frgc_file in self._selected_files(groups, protocols, purposes, model_ids, mask_type, shard_index, num_shards):
+      extend_files(files, frgc_file)
 
-    if 'world' in groups:
-      # extract training files
-      for file in get_list(self.original_directory, 'world'):
-        if not model_ids or file.m_signature in model_ids:
-          for id, path in list(file.m_files.items()):
-            extend_files(files, file)
+    return self._filtered([files[presentation] for presentation in sorted(files.keys())], filters)
 
-    if 'dev' in groups:
-      # check protocol, mask, and purposes only in group dev
-      if mask_type is not None:
-        mask_type = self.check_parameter_for_validity(
-            mask_type, "mask type", self.m_mask_types)
-      purposes = self.check_parameters_for_validity(
-          purposes, "purpose", self.m_purposes)
-
-      for p in protocols:
-        # extract dev files
-        if 'enroll' in purposes:
-          model_files = get_list(self.original_directory, 'dev', p, 'enroll')
-          # return only those files that are required by the given protocol
-          mask = get_mask(self.original_directory, p, mask_type)
-          for model_index in range(len(model_files)):
-            model = model_files[model_index]
-            if not model_ids or model.m_model in model_ids:
-              # test if the model is used by this mask
-              if mask is None or (mask[:, model_index] > 0).any():
-                extend_files(files, model)
-
-        if 'probe' in purposes:
-          probe_files = get_list(self.original_directory, 'dev', p, 'probe')
-          # assure that every probe file is returned only once
-          probe_indices = list(range(len(probe_files)))
-
-          # select only that files that belong to the models of with the given ids,
-          # or to any model if no model id is specified
-          model_files = get_list(self.original_directory, 'dev', p, 'enroll')
-          mask = get_mask(self.original_directory, p, mask_type)
-
-          for model_index in range(len(model_files)):
-            model = model_files[model_index]
-            if not model_ids or model.m_model in model_ids:
-              probe_indices_for_this_model = probe_indices[:]
-              for probe_index in probe_indices_for_this_model:
-                if mask is None or mask[probe_index, model_index]:
-                  extend_files(files, probe_files[probe_index])
-                  probe_indices.remove(probe_index)
-
-    return [files[presentation] for presentation in sorted(files.keys())]
-
-  def object_sets(self, groups=None, protocol='2.0.2', purposes=None, model_ids=None, mask_type='maskIII'):
+  @forwarded
+  def object_sets(self, groups=None, protocol='2.0.2', purposes=None, model_ids=None, mask_type='maskIII', shard_index=None, num_shards=None, filters=None):
     """Using the specified restrictions, this function returns a list of FileSet objects.
 
     Keyword Parameters:
@@ -316,11 +672,17 @@ class Database(bob.db.base.Database):
       belonging to the specified model id is returned.
 
     mask_type
-      One of the mask types ('maskI', 'maskII', 'maskIII').
+      One of the mask types ('maskI', 'maskII', 'maskIII') or a mask expression of :py:mod:`bob.db.frgc.masks`.
+
+    shard_index, num_shards
+      If given, only the model sets of the shard with index ``shard_index`` and the probe sets that are compared to them are returned, see :py:meth:`objects`.
+
+    filters
+      If given, only the file sets are returned, for which the metadata of all files fulfill these attribute filters, see :py:meth:`metadata`.
     """
     def extend_files(files, frgc_file):
-      """Extends the given file list with the FileSet created from the given FRGCFile."""
-      files[frgc_file.m_model] = FileSet(frgc_file)
+      """Extends the given file list with the FRGCFile, whose FileSet is returned."""
+      files[frgc_file.m_model] = frgc_file
 
     # check that every parameter is as expected
     groups = self.check_parameters_for_validity(groups, "group", ('dev',))
@@ -328,53 +690,414 @@ class Database(bob.db.base.Database):
     protocols = self.check_parameters_for_validity(
         protocol, "protocol", ('2.0.2',))
 
-    if isinstance(model_ids, six.integer_types):
-      model_ids = (model_ids,)
+    shard = self._check_shard(shard_index, num_shards)
+    model_ids = self._check_model_ids(model_ids)
 
     files = {}
 
     if 'dev' in groups:
       # check protocol, mask, and purposes only in group dev
-      if mask_type is not None:
-        mask_type = self.check_parameter_for_validity(
-            mask_type, "mask type", self.m_mask_types)
+      mask_type = self._check_mask_type(mask_type)
       purposes = self.check_parameters_for_validity(
           purposes, "purpose", self.m_purposes)
 
       for p in protocols:
         # extract dev files
-        if 'enroll' in purposes:
-          model_files = get_list(self.original_directory, 'dev', p, 'enroll')
-          # return only those files that are required by the given protocol
-          mask = get_mask(self.original_directory, p, mask_type)
-          for model_index in range(len(model_files)):
-            model = model_files[model_index]
-            if not model_ids or model.m_model in model_ids:
-              # test if the model is used by this mask
-              if mask is None or (mask[:, model_index] > 0).any():
-                extend_files(files, model)
-
-        if 'probe' in purposes:
-          probe_files = get_list(self.original_directory, 'dev', p, 'probe')
-          # assure that every probe file is returned only once
-          probe_indices = list(range(len(probe_files)))
-
-          # select only that files that belong to the models of with the given ids,
-          # or to any model if no model id is specified
-          model_files = get_list(self.original_directory, 'dev', p, 'enroll')
-          mask = get_mask(self.original_directory, p, mask_type)
-
-          for model_index in range(len(model_files)):
-            model = model_files[model_index]
-            if not model_ids or model.m_model in model_ids:
-              probe_indices_for_this_model = probe_indices[:]
-              for probe_index in probe_indices_for_this_model:
-                if mask is None or mask[probe_index, model_index]:
-                  extend_files(files, probe_files[probe_index])
-                  probe_indices.remove(probe_index)
-
-    return [files[file_set_id] for file_set_id in sorted(files.keys())]
+        for frgc_files in self._dev_files(p, purposes, model_ids, mask_type, shard).values():
+          for frgc_file in frgc_files:
+            extend_files(files, frgc_file)
 
+    frgc_files = [files[file_set_id] for file_set_id in sorted(files.keys())]
+    if filters:
+      frgc_files = [frgc_file for frgc_file, selected in zip(frgc_files, metadata_selected(self.original_directory, frgc_files, filters)) if selected]
+    return [frgc_file.file_set() for frgc_file in frgc_files]
+
+  @forwarded
+  def sample_objects(self, count, groups=None, protocol=None, purposes=None, mask_type='maskIII', seed=None, by_client=False, filters=None):
+    """Returns a random sample of the File objects that :py:meth:`objects` would return for the same parameters.
+    Only the sampled File objects are created.
+
+    Keyword Parameters:
+
+    count
+      The number of files to sample; if fewer files are selected by the query, all of them are returned.
+
+    groups, protocol, purposes, mask_type, filters
+      The restrictions of the files, see :py:meth:`objects`.
+
+    seed
+      The seed of the random number generator; the same seed returns the same sample.
+
+    by_client
+      If enabled, the files are distributed as equally as possible over the clients.
+
+    Returns: a list of File objects, sorted by their ids
+    """
+    frgc_files = self._selected_files(groups, protocol, purposes, None, mask_type)
+    indices = numpy.unique(presentation_arrays(frgc_files)[0])
+    if filters:
+      indices = indices[get_metadata(self.original_directory).selected(filters, [presentation_ids[index] for index in indices])]
+    strata = get_client_tables()[2][indices] if by_client else None
+    units = sample_units(numpy.ones(len(indices), dtype=numpy.int64), count, strata, seed)[0]
+    return [File(presentation_clients[index], presentation_ids[index], presentation_paths[index]) for index in sorted(indices[units], key=lambda index: presentation_ids[index])]
+
+  @forwarded
+  def sample_model_ids(self, count, groups=None, protocol=None, mask_type='maskIII', seed=None, by_client=False):
+    """Returns a random sample of the model ids that :py:meth:`model_ids` would return for the same parameters.
+
+    Keyword Parameters:
+
+    count
+      The number of model ids to sample; if fewer models are selected by the query, all of them are returned.
+
+    groups, protocol, mask_type
+      The restrictions of the models, see :py:meth:`model_ids`.
+
+    seed
+      The seed of the random number generator; the same seed returns the same sample.
+
+    by_client
+      If enabled, the models are distributed as equally as possible over the clients.
+
+    Returns: a sorted list of model ids
+    """
+    groups = self.check_parameters_for_validity(groups, "group", self.m_groups)
+    model_files = []
+    if 'world' in groups:
+      model_files.extend(get_list(self.original_directory, 'world'))
+    if 'dev' in groups:
+      protocol = self.check_parameter_for_validity(
+          protocol, "protocol", self.m_protocols)
+      dev_files, mask, models = self._dev_models(protocol, None, self._check_mask_type(mask_type))
+      model_files.extend(dev_files[index] for index in numpy.flatnonzero(models))
+    strata = [model.m_signature for model in model_files] if by_client else None
+    units = sample_units(numpy.ones(len(model_files), dtype=numpy.int64), count, strata, seed)[0]
+    return sorted(set(model_files[unit].m_model for unit in units))
+
+  @forwarded
+  def sample_pairs(self, count, protocol='2.0.1', mask_type='maskIII', seed=None, by_client=False):
+    """Returns a random sample of the comparisons between models and probes that are required by the given mask.
+    The pairs are drawn by their rank within the non-zero mask entries, so that neither the pairs nor the probe File objects are enumerated.
+
+    Keyword Parameters:
+
+    count
+      The number of pairs to sample; if the mask contains fewer pairs, all of them are returned.
+
+    protocol
+      One of the FRGC protocols ('2.0.1', '2.0.2', '2.0.4').
+
+    mask_type
+      One of the mask types ('maskI', 'maskII', 'maskIII') or a mask expression of :py:mod:`bob.db.frgc.masks`, or ``None`` for all pairs.
+
+    seed
+      The seed of the random number generator; the same seed returns the same sample.
+
+    by_client
+      If enabled, the pairs are distributed as equally as possible over the clients of the probes.
+
+    Returns: a list of tuples (model_id, probe), where the probe is a File, or a FileSet for protocol '2.0.2'; sorted by probes
+    """
+    protocol = self.check_parameter_for_validity(
+        protocol, "protocol", self.m_protocols)
+    mask_type = self._check_mask_type(mask_type)
+    model_files, mask, models = self._dev_models(protocol, None, mask_type)
+    probe_files = get_list(self.original_directory, 'dev', protocol, 'probe')
+    strata = [probe.m_signature for probe in probe_files] if by_client else None
+    rows, offsets = sample_units(probe_weights(mask, models, len(probe_files)), count, strata, seed)
+
+    retval = []
+    for row in numpy.unique(rows):
+      # the selected models of this probe, in the order of the mask columns
+      if mask is None:
+        columns = numpy.flatnonzero(models)
+      else:
+        columns = numpy.flatnonzero((numpy.asarray(mask[int(row)]) > 0) & models)
+      probe = probe_files[row]
+      if protocol == '2.0.2':
+        probe = probe.file_set()
+      else:
+        index = probe.m_presentations[0]
+        probe = File(probe.m_signature, presentation_ids[index], presentation_paths[index])
+      retval.extend((model_files[column].m_model, probe) for column in columns[offsets[rows == row]])
+    return retval
+
+  def write_score_file(self, scores, filename, protocol='2.0.1', mask_type='maskIII', five_column=False, compressed=None, chunk_size=1000000):
+    """Writes the given score matrix into a score file, containing only the pairs that are selected by the given mask.
+
+    Keyword Parameters:
+
+    scores
+      A 2D score matrix laid out like the FRGC masks, i.e., with one row per "Query" and one column per "Target" entry of the original lists.
+      Memory-mapped arrays are supported and are read block-wise.
+
+    filename
+      The name of the score file to write; if it ends with ``.gz``, the file will be gzip compressed.
+
+    protocol
+      One of the FRGC protocols ('2.0.1', '2.0.2', '2.0.4').
+
+    mask_type
+      One of the mask types ('maskI', 'maskII', 'maskIII') or a mask expression of :py:mod:`bob.db.frgc.masks`, or ``None`` to write all scores.
+
+    five_column
+      If enabled, the model ids are written as well, resulting in a 5-column score file.
+
+    compressed
+      Enforces or disables gzip compression; by default, it is deduced from the ``filename``.
+
+    chunk_size
+      The (approximate) maximum number of scores that are formatted at once.
+
+    Returns: the number of written scores
+    """
+    protocol = self.check_parameter_for_validity(
+        protocol, "protocol", self.m_protocols)
+    mask_type = self._check_mask_type(mask_type)
+
+    model_files = get_list(self.original_directory, 'dev', protocol, 'enroll')
+    probe_files = get_list(self.original_directory, 'dev', protocol, 'probe')
+    mask = get_mask(self.original_directory, protocol, mask_type)
+
+    return write_score_file(filename, scores, model_files, probe_files, mask, five_column=five_column, chunk_size=chunk_size, compressed=compressed)
+
+  def evaluate(self, scores, protocol='2.0.1', mask_types=None, far_values=(0.001,), bins=65536, score_range=None, block_size=256, parallel=None, exact=True):
+    """Computes the ROC curves and the verification rates at the given false acceptance rates for the given score matrix.
+
+    All masks are evaluated in the same pass over the score matrix, which is processed block-wise (possibly in parallel).
+    Instead of sorting the scores, histograms are accumulated and the thresholds are refined using partial selection, see :py:func:`bob.db.frgc.evaluate.evaluate` for details.
+
+    Keyword Parameters:
+
+    scores
+      A 2D score matrix laid out like the FRGC masks, i.e., with one row per "Query" and one column per "Target" entry of the original lists.
+
+    protocol
+      One of the FRGC protocols ('2.0.1', '2.0.2', '2.0.4').
+
+    mask_types
+      One or several of the mask types ('maskI', 'maskII', 'maskIII') or mask expressions (see :py:mod:`bob.db.frgc.masks`); by default, all masks are evaluated.
+
+    far_values
+      The false acceptance rates, for which the verification rates are computed.
+
+    bins, score_range, block_size, parallel, exact
+      See :py:func:`bob.db.frgc.evaluate.evaluate`.
+
+    Returns: a dictionary with the ROC and the verification rates for each of the mask types
+    """
+    protocol = self.check_parameter_for_validity(
+        protocol, "protocol", self.m_protocols)
+    if mask_types is None:
+      mask_types = self.m_mask_types
+    elif isinstance(mask_types, (six.string_types, MaskExpression)):
+      mask_types = (mask_types,)
+    mask_types = [self._check_mask_type(mask_type) for mask_type in mask_types]
+
+    model_files = get_list(self.original_directory, 'dev', protocol, 'enroll')
+    probe_files = get_list(self.original_directory, 'dev', protocol, 'probe')
+    masks = dict((mask_type, get_mask(self.original_directory, protocol, mask_type)) for mask_type in mask_types)
+
+    return evaluate(scores, model_files, probe_files, masks, far_values, bins=bins, score_range=score_range, block_size=block_size, parallel=parallel, exact=exact)
+
+  def training_batches(self, batch_size=1000, seed=None, clients=None, shard_index=None, num_shards=None, filters=None):
+    """Yields the files of the 'world' group in batches of whole clients, e.g., to train projectors that require the files grouped by client.
+    Only the File objects of the current batch are created, so that memory stays bounded.
+
+    Keyword Parameters:
+
+    batch_size
+      The maximum number of files in a batch.
+      Clients are never split between batches, so that a client with more files than ``batch_size`` forms its own batch.
+
+    seed
+      If given, the order of the clients is shuffled with this seed; otherwise, the clients are ordered by their client ids.
+      The files of each client are always ordered by their file ids.
+
+    clients
+      If given (as a list of client ids or a single one), only the files of these clients are returned.
+
+    shard_index, num_shards, filters
+      If given, only the files of the training signatures of this shard, or only the files fulfilling these metadata filters are returned, see :py:meth:`objects`.
+
+    Yields: one list per batch, which contains one list of File objects per client
+    """
+    if batch_size < 1:
+      raise ValueError("The batch size %d is not valid." % batch_size)
+    frgc_files = self._selected_files('world', None, None, clients, None, shard_index, num_shards)
+    indices = numpy.unique(presentation_arrays(frgc_files)[0])
+    if filters:
+      indices = indices[get_metadata(self.original_directory).selected(filters, [presentation_ids[index] for index in indices])]
+    if not len(indices):
+      return
+
+    # sort the presentations by client, and by file id inside each client
+    codes = get_client_tables()[2][indices]
+    ranks = numpy.argsort(numpy.array([presentation_ids[index] for index in indices]), kind='stable')
+    order = ranks[numpy.argsort(codes[ranks], kind='stable')]
+    indices, codes = indices[order], codes[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], codes[1:] != codes[:-1])))
+    ends = numpy.concatenate((starts[1:], [len(indices)]))
+    client_order = numpy.arange(len(starts)) if seed is None else numpy.random.RandomState(seed).permutation(len(starts))
+
+    batch, size = [], 0
+    for client in client_order:
+      if batch and size + ends[client] - starts[client] > batch_size:
+        yield batch
+        batch, size = [], 0
+      batch.append([File(presentation_clients[index], presentation_ids[index], presentation_paths[index]) for index in indices[starts[client] : ends[client]]])
+      size += ends[client] - starts[client]
+    if batch:
+      yield batch
+
+  def file_paths(self, files, directory=None, extension=None, as_array=False):
+    """Returns the complete paths of all given files at once, as :py:meth:`File.make_path` would return them one by one.
+    For the '.jpg' extension, each directory is listed only once to decide between '.jpg' and '.JPG', instead of querying the file system for each file.
+
+    Keyword Parameters:
+
+    files
+      A list of File objects, e.g., as returned by :py:meth:`objects`.
+
+    directory, extension
+      The base directory and the extension that are added to the paths, see :py:meth:`File.make_path`.
+
+    as_array
+      If enabled, the paths are returned as a NumPy array of strings instead of a list.
+
+    Returns: the list (or array) of paths
+    """
+    paths = resolve_paths([f.path for f in files], directory, extension)
+    return numpy.array(paths, dtype=str) if as_array else paths
+
+  def load_images(self, files, directory=None, extension=None, loader=None, parallel=4, prefetch=16, processes=False):
+    """Loads the images of the given files in parallel, while yielding them in order.
+
+    Keyword Parameters:
+
+    files
+      A list of File objects, e.g., as returned by :py:meth:`objects`.
+
+    directory, extension
+      The base directory and the extension of the images; by default, the ``original_directory`` and ``original_extension`` of this database are used.
+
+    loader, parallel, prefetch, processes
+      See :py:func:`bob.db.frgc.loader.load_images`.
+
+    Yields: tuples (file, image)
+    """
+    return load_images(files, directory or self.original_directory, extension or self.original_extension, loader, parallel, prefetch, processes)
+
+  def load_batches(self, batches, directory=None, extension=None, loader=None, parallel=4, prefetch=16, processes=False):
+    """Loads the images of the given client-grouped batches of files in parallel, while yielding them batch by batch.
+
+    Keyword Parameters:
+
+    batches
+      The batches of File objects, e.g., as yielded by :py:meth:`training_batches`.
+
+    directory, extension
+      The base directory and the extension of the images; by default, the ``original_directory`` and ``original_extension`` of this database are used.
+
+    loader, parallel, prefetch, processes
+      See :py:func:`bob.db.frgc.loader.load_images`.
+
+    Yields: one list per batch, which contains one list of tuples (file, image) per client
+    """
+    return load_batches(batches, directory or self.original_directory, extension or self.original_extension, loader, parallel, prefetch, processes)
+
+  def build_face_cache(self, files, cache_dir, **kwargs):
+    """Decodes the images of the given files once, crops the faces using the eye positions of :py:meth:`annotations`, and stores them in memory-mappable shards.
+
+    Keyword Parameters:
+
+    files
+      A list of File objects, e.g., as returned by :py:meth:`objects`.
+
+    cache_dir
+      The directory, where the cache is written to.
+
+    kwargs
+      The cropping and loading parameters, see :py:func:`bob.db.frgc.facecache.build_face_cache`.
+
+    Returns: the :py:class:`bob.db.frgc.facecache.FaceCache` of the new cache
+    """
+    self.m_face_caches[cache_dir] = build_face_cache(self, files, cache_dir, **kwargs)
+    return self.m_face_caches[cache_dir]
+
+  def face_cache(self, cache_dir):
+    """Returns the face cache stored in the given directory, see :py:meth:`build_face_cache`.
+    Faces can be looked up by File or file id, e.g., ``db.face_cache(cache_dir)[file]``, or for a list of files with ``db.face_cache(cache_dir).faces(files)``."""
+    if cache_dir not in self.m_face_caches:
+      self.m_face_caches[cache_dir] = FaceCache(cache_dir)
+    return self.m_face_caches[cache_dir]
+
+  def refresh(self):
+    """Checks the modification times and sizes of all lists, masks and annotation files that have been read so far, and reloads those that have changed.
+
+    .. warning ::
+      The models of reloaded lists get new model ids, so model ids obtained before need to be queried again.
+
+    Returns: a list of keys of the reloaded sources, e.g., ``('list', 'dev', '2.0.1')`` or ``('mask', '2.0.1', 'maskIII')``
+    """
+    return refresh(self.original_directory)
+
+  @forwarded
   def annotations(self, file):
     """Returns the annotations for the given file as a dictionary {'reye':(y,x), 'leye':(y,x), 'mouth':(y,x), 'nose':(y,x)}."""
+    if self.m_index is not None:
+      return self.m_index.annotations(file.id)
     return get_annotations(self.original_directory, file.id)
+
+  def save_snapshot(self, filename):
+    """Writes a snapshot of all lists that have been read so far (see :py:func:`bob.db.frgc.models.snapshot`) into the given ``.npz`` file.
+    Afterwards, pickled copies of this database carry only the name of this file, from which the lists are restored when unpickling.
+    Hence, the file needs to be accessible by all processes that unpickle this database."""
+    save_snapshot(filename, snapshot())
+    self.m_snapshot_file = filename
+
+  def __getstate__(self):
+    """Returns the state of this database for pickling, e.g., when it is sent to other processes of a process pool.
+
+    The state includes a compact snapshot of all lists read so far, or the name of the snapshot file written by :py:meth:`save_snapshot`.
+    Unpickled copies restore these lists, so that they do not need to read the XML lists again, and they use the same model ids as this database.
+    The SQLite index, the connection to the query server and the cache directories are re-opened, while face caches are not shipped.
+    """
+    state = self.__dict__.copy()
+    state['m_index'] = None if self.m_index is None else self.m_index.m_sqlite_file
+    state['m_client'] = None if self.m_client is None else self.m_client.m_socket_file
+    state['m_face_caches'] = {}
+    state['mask_cache_directory'] = get_mask_cache_directory()
+    state['cache_directory'] = get_cache_directory()
+    state['snapshot'] = self.m_snapshot_file if self.m_snapshot_file is not None else snapshot()
+    return state
+
+  def __setstate__(self, state):
+    state = dict(state)
+    lists = state.pop('snapshot')
+    mask_cache_directory = state.pop('mask_cache_directory')
+    cache_directory = state.pop('cache_directory', None)
+    self.__dict__.update(state)
+    self.m_index = SQLiteIndex(state['m_index']) if state['m_index'] is not None else None
+    self.m_client = QueryClient(state['m_client']) if state['m_client'] is not None else None
+    if mask_cache_directory is not None:
+      set_mask_cache_directory(mask_cache_directory)
+    if cache_directory is not None:
+      set_cache_directory(cache_directory)
+    restore_snapshot(load_snapshot(lists) if isinstance(lists, six.string_types) else lists)
+
+  def metadata(self, file=None):
+    """Returns the metadata of the FRGC recordings, which is read from the metadata file together with the annotations.
+
+    If a ``file`` is given, a dictionary of all its metadata attributes is returned.
+    Otherwise, the :py:class:`bob.db.frgc.models.Metadata` is returned, which stores all attributes as typed columns, e.g.,
+    ``metadata['capturedate']`` is an array of dates, which is aligned with the file ids in ``metadata.ids``.
+
+    Recording attributes are stored under their names, while attributes of child and ancestor elements of the Recording are prefixed by the element name.
+    The attribute filters accepted by :py:meth:`objects` and :py:class:`bob.db.frgc.masks.MetadataRestriction` map attribute names to values, lists of values,
+    or vectorized predicates that are evaluated on the whole column, see :py:meth:`bob.db.frgc.models.Metadata.select`.
+    """
+    metadata = get_metadata(self.original_directory)
+    if file is None:
+      return metadata
+    return metadata.record(file.id)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Writing of score files for full FRGC experiments
+"""
+
+import gzip
+import numpy
+
+from .models import presentation_paths
+
+
+def probe_label(frgc_file):
+  """Returns the path that is written as the probe label for the given FRGCFile.
+  For file sets (protocol '2.0.2'), this is the path of the according FileSet."""
+  if len(frgc_file.m_presentations) == 1:
+    return presentation_paths[frgc_file.m_presentations[0]]
+  return frgc_file.file_set().path
+
+
+def open_score_file(filename, compressed=None):
+  """Opens the given score file for writing; if ``compressed`` is ``None``, files ending with ``.gz`` are gzip compressed."""
+  if compressed is None:
+    compressed = filename.endswith('.gz')
+  if compressed:
+    return gzip.open(filename, 'wt', compresslevel=1)
+  return open(filename, 'w')
+
+
+def write_score_file(filename, scores, model_files, probe_files, mask=None, five_column=False, score_format='%.8g', chunk_size=1000000, compressed=None):
+  """Writes the scores of the given score matrix into a score file in the 4- or 5-column format of bob.
+
+  The lines are written in blocks of rows of the score matrix, where only the pairs selected by the mask are written.
+  Each block is formatted at once, so that at most ``chunk_size`` scores are held in memory as text.
+
+  Keyword parameters:
+
+  filename
+    The name of the score file to write; if it ends with ``.gz``, the file is gzip compressed.
+
+  scores
+    A 2D score matrix (any array-like, such as a memory-mapped :py:class:`numpy.memmap`), which is laid out like the FRGC masks,
+    i.e., with shape ``(len(probe_files), len(model_files))``.
+
+  model_files, probe_files
+    The lists of FRGCFile's for the "Target" and "Query" lists, as returned by :py:func:`get_list`.
+
+  mask
+    If given, a mask of the same shape as ``scores``; only the pairs with non-zero mask entries are written.
+
+  five_column
+    If enabled, the 5-column format is written, which includes the model id: ``claimed_id model_id real_id probe_path score``.
+    Otherwise, the 4-column format ``claimed_id real_id probe_path score`` is written.
+
+  score_format
+    The format used to write the scores.
+
+  chunk_size
+    The (approximate) maximum number of scores that are formatted at once.
+
+  compressed
+    Enforces (``True``) or disables (``False``) gzip compression; by default, it is deduced from the ``filename``.
+
+  Returns the number of scores that were written.
+  """
+  shape = (len(probe_files), len(model_files))
+  if tuple(scores.shape) != shape:
+    raise ValueError("The score matrix of shape %s does not fit to the %d probes and %d models." % (scores.shape, shape[0], shape[1]))
+  if mask is not None and tuple(mask.shape) != shape:
+    raise ValueError("The mask of shape %s does not fit to the score matrix of shape %s." % (mask.shape, shape))
+
+  # pre-compute the textual parts of all lines
+  if five_column:
+    model_text = numpy.array(['%s %d ' % (f.m_signature, f.m_model) for f in model_files], dtype=object)
+  else:
+    model_text = numpy.array(['%s ' % f.m_signature for f in model_files], dtype=object)
+  probe_text = numpy.array(['%s %s ' % (f.m_signature, probe_label(f)) for f in probe_files], dtype=object)
+
+  rows = max(1, chunk_size // max(shape[1], 1))
+  count = 0
+  with open_score_file(filename, compressed) as f:
+    for first in range(0, shape[0], rows):
+      block = numpy.asarray(scores[first : first + rows])
+      if mask is None:
+        probes, models = numpy.nonzero(numpy.ones(block.shape, dtype=bool))
+      else:
+        probes, models = numpy.nonzero(numpy.asarray(mask[first : first + rows]))
+      if not len(probes):
+        continue
+      values = numpy.char.mod(score_format, block[probes, models]).astype(object)
+      lines = model_text[models] + probe_text[probes + first] + values
+      f.write('\n'.join(lines))
+      f.write('\n')
+      count += len(probes)
+
+  return count
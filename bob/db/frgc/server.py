@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""A local query server, which keeps the FRGC lists, masks and annotations in memory and answers queries over a Unix domain socket
+"""
+
+import os
+import errno
+import stat
+import socket
+import struct
+import tempfile
+import pickle
+import threading
+from six.moves import socketserver
+
+from .models import File, get_list, get_mask, load_annotations, all_lists
+
+import logging
+logger = logging.getLogger("bob.db.frgc")
+
+# the queries of the bob.db.frgc.Database that are answered by the server
+forwarded_methods = ('client_ids', 'model_ids', 'objects', 'object_sets', 'annotations',
+    'count_objects', 'count_object_sets', 'count_model_ids', 'count_comparisons', 'cost_estimate',
+    'get_client_id_from_model_id', 'get_client_id_from_file_id', 'get_client_ids_from_model_ids', 'get_client_ids_from_file_ids',
+    'sample_objects', 'sample_model_ids', 'sample_pairs')
+
+class NotForwardable (TypeError):
+  """Raised by :py:meth:`QueryClient.call`, when the arguments of a query cannot be sent to the server."""
+  pass
+
+def socket_directory():
+  """Returns the per-user directory of the default query server socket, which is ``$XDG_RUNTIME_DIR``, if set,
+  or a ``bob.db.frgc-<uid>`` directory in the temporary directory otherwise, which is created by :py:func:`check_directory`."""
+  directory = os.environ.get('XDG_RUNTIME_DIR')
+  if not directory:
+    directory = os.path.join(tempfile.gettempdir(), 'bob.db.frgc-%d' % os.getuid())
+  return directory
+
+def check_directory(directory, create=False):
+  """Checks that the given directory of a socket is owned by the current user and cannot be written by others, so that no other user can place a socket in it.
+  If ``create`` is enabled, a missing directory is created, which only the current user may access.
+  An IOError is raised if the directory does not fulfill these requirements."""
+  if create:
+    try:
+      os.mkdir(directory, 0o700)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+  try:
+    status = os.lstat(directory)
+  except OSError:
+    raise IOError("The directory '%s' of the FRGC query server socket does not exist." % directory)
+  if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o022:
+    raise IOError("The directory '%s' of the FRGC query server socket must be owned by the current user and must not be writable by others." % directory)
+
+def check_peer(connection, socket_file):
+  """Checks that the other end of the given Unix domain socket connection is a process of the current user; raises an IOError otherwise.
+  The user is read with SO_PEERCRED; on systems without it, the owner of the socket file is used instead."""
+  if hasattr(socket, 'SO_PEERCRED'):
+    credentials = struct.Struct('3i')
+    uid = credentials.unpack(connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, credentials.size))[1]
+  else:
+    uid = os.stat(socket_file).st_uid
+  if uid != os.getuid():
+    raise IOError("The FRGC query server socket '%s' is used by another user (uid %d)." % (socket_file, uid))
+
+
+# messages are prefixed by their length
+header = struct.Struct('!Q')
+
+
+def encode_message(message):
+  """Encodes the given object as a length-prefixed pickle."""
+  data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+  return header.pack(len(data)) + data
+
+def receive_message(connection):
+  """Receives a length-prefixed pickle; returns None if the connection has been closed."""
+  def receive(size):
+    data = bytearray()
+    while len(data) < size:
+      chunk = connection.recv(min(size - len(data), 1 << 20))
+      if not chunk:
+        if data:
+          raise IOError("The connection was closed in the middle of a message.")
+        return None
+      data.extend(chunk)
+    return bytes(data)
+  size = receive(header.size)
+  if size is None:
+    return None
+  return pickle.loads(receive(header.unpack(size)[0]))
+
+
+def pack_result(result):
+  """Packs lists of File's compactly into three newline-separated strings."""
+  if isinstance(result, list) and result and all(isinstance(f, File) for f in result):
+    return ('files', '\n'.join(f.client_id for f in result), '\n'.join(f.id for f in result), '\n'.join(f.path for f in result))
+  return ('value', result)
+
+def unpack_result(packed):
+  """Reverts :py:func:`pack_result`."""
+  if packed[0] == 'files':
+    return [File(client_id, file_id, path) for client_id, file_id, path in zip(*(p.split('\n') for p in packed[1:]))]
+  return packed[1]
+
+
+class QueryHandler (socketserver.BaseRequestHandler):
+  """Answers the requests of one client connection, until the client closes it."""
+  def handle(self):
+    server = self.server
+    try:
+      check_peer(self.request, server.server_address)
+    except IOError as e:
+      logger.warn("Refusing the connection: %s", e)
+      return
+    while True:
+      request = receive_message(self.request)
+      if request is None:
+        return
+      method, args, kwargs = request
+      try:
+        if method not in forwarded_methods:
+          raise ValueError("The query '%s' is not supported by the server." % method)
+        with server.m_lock:
+          result = getattr(server.m_database, method)(*args, **kwargs)
+        response = ('ok', pack_result(result))
+      except Exception as e:
+        response = ('error', e)
+      try:
+        data = encode_message(response)
+      except (pickle.PicklingError, AttributeError, TypeError) as e:
+        data = encode_message(('error', RuntimeError("The result of the query '%s' cannot be sent to the client: %s" % (method, e))))
+      self.request.sendall(data)
+
+
+class QueryServer (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  """A server that answers the queries of :py:class:`bob.db.frgc.Database` clients over a Unix domain socket.
+  The queries are executed one at a time, while the requests and responses of several clients are transferred in parallel."""
+  daemon_threads = True
+
+  def __init__(self, database, socket_file):
+    check_directory(os.path.dirname(os.path.abspath(socket_file)), create=True)
+    if os.path.exists(socket_file):
+      os.remove(socket_file)
+    # only the owner may connect, since requests are unpickled; the socket is created with these permissions, so that others can never connect
+    umask = os.umask(0o077)
+    try:
+      socketserver.UnixStreamServer.__init__(self, socket_file, QueryHandler)
+    finally:
+      os.umask(umask)
+    self.m_database = database
+    self.m_lock = threading.Lock()
+
+  def server_close(self):
+    socketserver.UnixStreamServer.server_close(self)
+    if os.path.exists(self.server_address):
+      os.remove(self.server_address)
+
+
+def preload(database):
+  """Loads all lists, masks and annotations of the given database."""
+  directory = database.original_directory
+  for key in sorted(all_lists):
+    get_list(directory, *all_lists[key])
+  for protocol in database.m_protocols:
+    for mask_type in database.m_mask_types:
+      get_mask(directory, protocol, mask_type)
+  load_annotations(directory)
+
+
+def serve(database, socket_file, load=True):
+  """Serves the queries of the given :py:class:`bob.db.frgc.Database` on the given Unix domain socket, until interrupted.
+  If ``load`` is enabled, all lists, masks and annotations are loaded before the first request is accepted."""
+  if load:
+    preload(database)
+  server = QueryServer(database, socket_file)
+  logger.info("Serving the FRGC database '%s' on '%s'", database.original_directory, socket_file)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+class QueryClient:
+  """Forwards queries to a :py:class:`QueryServer` over a persistent connection, which is re-opened when it was lost."""
+  def __init__(self, socket_file):
+    self.m_socket_file = socket_file
+    self.m_connection = None
+    self.m_lock = threading.Lock()
+
+  def _connect(self):
+    # the responses are unpickled, so the server must be a process of the current user
+    check_directory(os.path.dirname(os.path.abspath(self.m_socket_file)))
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      connection.connect(self.m_socket_file)
+    except socket.error:
+      connection.close()
+      raise IOError("Could not connect to the FRGC query server at '%s'; please start it with 'bob_dbmanage.py frgc serve'." % self.m_socket_file)
+    try:
+      check_peer(connection, self.m_socket_file)
+    except IOError:
+      connection.close()
+      raise
+    return connection
+
+  def call(self, method, args, kwargs):
+    """Executes the given query on the server and returns its result; exceptions of the server are re-raised.
+    A :py:class:`NotForwardable` error is raised, when the arguments cannot be sent to the server, e.g., since they contain lambda functions."""
+    try:
+      request = encode_message((method, args, kwargs))
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+      raise NotForwardable("The arguments of the query '%s' cannot be sent to the server: %s" % (method, e))
+    with self.m_lock:
+      for attempt in (0, 1):
+        if self.m_connection is None:
+          self.m_connection = self._connect()
+        try:
+          self.m_connection.sendall(request)
+          response = receive_message(self.m_connection)
+          if response is not None:
+            break
+        except (socket.error, IOError):
+          if attempt:
+            raise
+        # the connection was lost, e.g., by a restart of the server
+        self.close()
+      else:
+        raise IOError("The FRGC query server at '%s' closed the connection." % self.m_socket_file)
+    status, result = response
+    if status == 'error':
+      raise result
+    return unpack_result(result)
+
+  def close(self):
+    if self.m_connection is not None:
+      self.m_connection.close()
+      self.m_connection = None
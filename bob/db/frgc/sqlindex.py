@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""An optional SQLite index of the FRGC lists, masks and annotations
+"""
+
+import os
+import sqlite3
+import zlib
+import numpy
+
+from .models import File, get_list, get_mask, load_annotations, list_key, all_lists, used_probes, sharded
+
+# the protocols and mask types stored in the index
+protocols = ('2.0.1', '2.0.2', '2.0.4')
+mask_types = ('maskI', 'maskII', 'maskIII')
+
+schema = """
+CREATE TABLE info (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE file (id TEXT PRIMARY KEY, client_id TEXT NOT NULL, path TEXT NOT NULL);
+CREATE TABLE signature (list TEXT NOT NULL, list_index INTEGER NOT NULL, model_id INTEGER NOT NULL UNIQUE, client_id TEXT NOT NULL, PRIMARY KEY (list, list_index));
+CREATE TABLE signature_file (list TEXT NOT NULL, list_index INTEGER NOT NULL, file_id TEXT NOT NULL);
+CREATE TABLE mask_model (protocol TEXT NOT NULL, mask_type TEXT NOT NULL, model_index INTEGER NOT NULL, comparisons INTEGER NOT NULL, probes BLOB NOT NULL, PRIMARY KEY (protocol, mask_type, model_index));
+CREATE TABLE mask_probe (protocol TEXT NOT NULL, mask_type TEXT NOT NULL, probe_index INTEGER NOT NULL, PRIMARY KEY (protocol, mask_type, probe_index));
+CREATE TABLE annotation (file_id TEXT PRIMARY KEY, leye_y INTEGER, leye_x INTEGER, reye_y INTEGER, reye_x INTEGER, nose_y INTEGER, nose_x INTEGER, mouth_y INTEGER, mouth_x INTEGER);
+CREATE INDEX signature_model ON signature (model_id);
+CREATE INDEX signature_client ON signature (client_id);
+CREATE INDEX signature_file_index ON signature_file (list, list_index, file_id);
+CREATE INDEX signature_file_file ON signature_file (file_id);
+"""
+
+# the landmarks stored in the annotation table
+landmarks = ('leye', 'reye', 'nose', 'mouth')
+
+# the maximum number of values in a single "IN (...)" clause, which is below the default limit of SQLite for the number of parameters
+max_in_values = 500
+
+
+def list_name(key):
+  """Returns the name of the list with the given key, as stored in the index, e.g., 'dev/2.0.4/enroll'."""
+  return '/'.join(key[1:])
+
+def dev_list_name(protocol, purpose):
+  """Returns the name of the 'dev' list of the given protocol and purpose."""
+  return list_name(list_key('dev', protocol, purpose))
+
+
+def create_index(base_dir, sqlite_file, block_size=1024):
+  """Creates the SQLite index file from the original lists, masks and annotations of the FRGC database in the given base directory.
+
+  Model ids are assigned once during creation; in contrast to the ids generated when reading the XML lists, they are stable for the lifetime of the index file.
+  The membership of each model in each mask is stored as a compressed bitmap of the probes it is compared to.
+  """
+  temp_file = sqlite_file + '.tmp'
+  if os.path.exists(temp_file):
+    os.remove(temp_file)
+  connection = sqlite3.connect(temp_file)
+  try:
+    connection.executescript(schema)
+
+    # lists, files and models
+    model_id = 1
+    for key in sorted(all_lists):
+      name = list_name(key)
+      for index, frgc_file in enumerate(get_list(base_dir, *all_lists[key])):
+        connection.execute("INSERT INTO signature VALUES (?,?,?,?)", (name, index, model_id, frgc_file.m_signature))
+        model_id += 1
+        for presentation, path in frgc_file.m_files.items():
+          connection.execute("INSERT OR IGNORE INTO file VALUES (?,?,?)", (presentation, frgc_file.m_signature, path))
+          connection.execute("INSERT INTO signature_file VALUES (?,?,?)", (name, index, presentation))
+
+    # masks
+    for protocol in protocols:
+      for mask_type in mask_types:
+        mask = get_mask(base_dir, protocol, mask_type)
+        for first in range(0, mask.shape[1], block_size):
+          columns = (numpy.asarray(mask[:, first : first + block_size]) > 0).T
+          comparisons = columns.sum(axis=1)
+          bitmaps = numpy.packbits(columns, axis=1)
+          for index in numpy.flatnonzero(comparisons):
+            connection.execute("INSERT INTO mask_model VALUES (?,?,?,?,?)", (protocol, mask_type, first + int(index), int(comparisons[index]), sqlite3.Binary(zlib.compress(bitmaps[index].tobytes()))))
+        probes = used_probes(mask, numpy.ones(mask.shape[1], dtype=bool), mask.shape[0])
+        connection.executemany("INSERT INTO mask_probe VALUES (?,?,?)", ((protocol, mask_type, int(index)) for index in numpy.flatnonzero(probes)))
+
+    # annotations
+    for file_id, annotation in load_annotations(base_dir).items():
+      connection.execute("INSERT INTO annotation VALUES (?,?,?,?,?,?,?,?,?)", (file_id,) + sum((tuple(annotation[l]) for l in landmarks), ()))
+
+    connection.execute("INSERT INTO info VALUES (?,?)", ('base_dir', base_dir))
+    connection.commit()
+  finally:
+    connection.close()
+  os.rename(temp_file, sqlite_file)
+
+
+class SQLiteIndex:
+  """Answers the queries of the :py:class:`bob.db.frgc.Database` from an index file created by :py:func:`create_index`."""
+  def __init__(self, sqlite_file):
+    if not os.path.exists(sqlite_file):
+      raise IOError("The SQLite index file '%s' does not exist; please create it with 'bob_dbmanage.py frgc create'." % sqlite_file)
+    self.m_sqlite_file = sqlite_file
+    self.m_connection = sqlite3.connect(sqlite_file, check_same_thread=False)
+
+  def _query(self, statement, *parameters):
+    return self.m_connection.execute(statement, parameters).fetchall()
+
+  def _query_in(self, statement, values, *parameters):
+    """Runs the given statement, in which ``%s`` is replaced by the placeholders of an "IN (...)" clause, for the given values.
+    The values are split into chunks, so that the number of parameters of a single statement stays limited."""
+    values = [int(v) for v in values]
+    rows = []
+    for first in range(0, len(values), max_in_values):
+      chunk = values[first : first + max_in_values]
+      rows.extend(self.m_connection.execute(statement % ','.join('?' * len(chunk)), parameters + tuple(chunk)).fetchall())
+    return rows
+
+  def _list_length(self, name):
+    return self._query("SELECT COUNT(*) FROM signature WHERE list=?", name)[0][0]
+
+  def _files(self, name, indices=None):
+    """Returns the File's of the signatures with the given indices (by default: all) of the given list."""
+    if indices is None:
+      rows = self._query("SELECT f.id, f.client_id, f.path FROM signature_file s JOIN file f ON f.id = s.file_id WHERE s.list=?", name)
+    else:
+      rows = self._query_in("SELECT f.id, f.client_id, f.path FROM signature_file s JOIN file f ON f.id = s.file_id WHERE s.list=? AND s.list_index IN (%s)", indices, name)
+    return [File(client_id, file_id, path) for file_id, client_id, path in rows]
+
+  def world_models(self, shard=None):
+    """Returns the (list_index, model_id, client_id) of the training signatures, possibly of the given shard."""
+    rows = self._query("SELECT list_index, model_id, client_id FROM signature WHERE list=? ORDER BY list_index", list_name(list_key('world')))
+    if shard is not None:
+      weights = numpy.zeros(len(rows), dtype=numpy.int64)
+      for index, count in self._query("SELECT list_index, COUNT(*) FROM signature_file WHERE list=? GROUP BY list_index", list_name(list_key('world'))):
+        weights[index] = count
+      selected = sharded(weights, *shard)
+      rows = [row for row in rows if selected[row[0]]]
+    return rows
+
+  def dev_models(self, protocol, mask_type, model_ids=None, shard=None):
+    """Returns the (list_index, model_id, client_id) of the models used by the given mask, possibly restricted to the given model ids or shard."""
+    name = dev_list_name(protocol, 'enroll')
+    rows = self._query("SELECT list_index, model_id, client_id FROM signature WHERE list=? ORDER BY list_index", name)
+    if mask_type is None:
+      weights = numpy.ones(len(rows), dtype=numpy.int64)
+    else:
+      weights = numpy.zeros(len(rows), dtype=numpy.int64)
+      for index, comparisons in self._query("SELECT model_index, comparisons FROM mask_model WHERE protocol=? AND mask_type=?", protocol, mask_type):
+        weights[index] = comparisons
+    selected = weights > 0
+    if shard is not None:
+      selected &= sharded(weights, *shard)
+    if model_ids:
+      model_ids = set(model_ids)
+      return [row for row in rows if selected[row[0]] and row[1] in model_ids]
+    return [row for row in rows if selected[row[0]]]
+
+  def dev_probes(self, protocol, mask_type, models=None):
+    """Returns the indices of the probes that are compared to the given models (list indices), or to any model if not given."""
+    probe_count = self._list_length(dev_list_name(protocol, 'probe'))
+    if mask_type is None:
+      return numpy.arange(probe_count) if models is None or len(models) else numpy.zeros(0, dtype=int)
+    if models is None:
+      return numpy.array([row[0] for row in self._query("SELECT probe_index FROM mask_probe WHERE protocol=? AND mask_type=?", protocol, mask_type)], dtype=int)
+    used = numpy.zeros(probe_count, dtype=bool)
+    for bitmap, in self._query_in("SELECT probes FROM mask_model WHERE protocol=? AND mask_type=? AND model_index IN (%s)", models, protocol, mask_type):
+      used |= numpy.unpackbits(numpy.frombuffer(zlib.decompress(bitmap), dtype=numpy.uint8), count=probe_count).astype(bool)
+    return numpy.flatnonzero(used)
+
+  def client_ids(self, groups, protocol, purposes, mask_type):
+    retval = set()
+    if 'world' in groups:
+      retval.update(row[2] for row in self.world_models())
+    if 'dev' in groups:
+      if 'enroll' in purposes:
+        retval.update(row[2] for row in self.dev_models(protocol, mask_type))
+      if 'probe' in purposes:
+        if mask_type is None:
+          rows = self._query("SELECT DISTINCT client_id FROM signature WHERE list=?", dev_list_name(protocol, 'probe'))
+        else:
+          rows = self._query("SELECT DISTINCT s.client_id FROM mask_probe p JOIN signature s ON s.list=? AND s.list_index = p.probe_index WHERE p.protocol=? AND p.mask_type=?", dev_list_name(protocol, 'probe'), protocol, mask_type)
+        retval.update(row[0] for row in rows)
+    return sorted(retval)
+
+  def model_ids(self, groups, protocol, mask_type, shard=None):
+    retval = set()
+    if 'world' in groups:
+      retval.update(row[1] for row in self.world_models(shard))
+    if 'dev' in groups:
+      retval.update(row[1] for row in self.dev_models(protocol, mask_type, shard=shard))
+    return sorted(retval)
+
+  def objects(self, groups, protocols, purposes, model_ids, mask_type, shard=None):
+    files = {}
+    if 'world' in groups:
+      # for the world group, model ids are client ids
+      models = [row[0] for row in self.world_models(shard) if not model_ids or row[2] in model_ids]
+      for file in self._files(list_name(list_key('world')), models):
+        files[file.id] = file
+    if 'dev' in groups:
+      for protocol in protocols:
+        models = [row[0] for row in self.dev_models(protocol, mask_type, model_ids, shard)]
+        if 'enroll' in purposes:
+          for file in self._files(dev_list_name(protocol, 'enroll'), models):
+            files[file.id] = file
+        if 'probe' in purposes:
+          probes = self.dev_probes(protocol, mask_type, None if not model_ids and shard is None else models)
+          for file in self._files(dev_list_name(protocol, 'probe'), probes):
+            files[file.id] = file
+    return [files[file_id] for file_id in sorted(files)]
+
+  def annotations(self, file_id):
+    rows = self._query("SELECT * FROM annotation WHERE file_id=?", file_id)
+    if not rows:
+      raise KeyError(file_id)
+    return dict((landmark, (rows[0][1 + 2 * i], rows[0][2 + 2 * i])) for i, landmark in enumerate(landmarks))
+
+  def client_from_file(self, file_id):
+    rows = self._query("SELECT client_id FROM file WHERE id=?", file_id)
+    if not rows:
+      raise ValueError("The file id '%s' is not known." % file_id)
+    return rows[0][0]
+
+  def client_from_model(self, model_id):
+    rows = self._query("SELECT client_id FROM signature WHERE model_id=?", model_id)
+    if not rows:
+      raise ValueError("The model id '%s' is not known." % model_id)
+    return rows[0][0]
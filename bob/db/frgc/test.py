@@ -10,6 +10,7 @@ from nose.plugins.skip import SkipTest
 
 
 import bob.db.frgc
+from bob.db.frgc.models import clear
 
 db = None
 
@@ -23,6 +24,8 @@ def db_available(test):
     db_directory = interface.frgc_database_directory()
     if os.path.exists(db_directory):
       global db
+      # drop the lists of the synthetic tree
+      clear()
       db = bob.db.frgc.Database()
       return test(*args, **kwargs)
     else:
@@ -31,6 +34,15 @@ def db_available(test):
   return wrapper
 
 
+# a small synthetic FRGC tree, on which the functionality is tested independently of the original FRGC data
+fixture_directory = os.path.join(os.path.dirname(__file__), 'test_data', 'FRGC')
+
+def fixture_database(**kwargs):
+  """Returns a Database of the synthetic FRGC tree, dropping the lists, masks and annotations read from other directories."""
+  clear()
+  return bob.db.frgc.Database(fixture_directory, **kwargs)
+
+
 @db_available
 def test_client_ids():
   # Tests that the 'client_ids()' and 'model_ids()' functions return the desired number of elements.
@@ -102,7 +114,7 @@ def test_objects():
   assert len(db.objects(groups='dev', protocol='2.0.4', purposes='probe', mask_type='maskIII')) == 4228
 
   # as far as I know, the number of probes should be identical for each model...
-  for model_id in random.sample(db.model_ids(groups='dev', protocol='2.0.4', mask_type='maskIII'), 50):
+  for model_id in db.sample_model_ids(50, groups='dev', protocol='2.0.4', mask_type='maskIII', seed=1):
     assert len(db.objects(groups='dev', protocol='2.0.4', purposes='probe', mask_type='maskIII', model_ids=model_id)) == 4228
 
 
@@ -126,17 +138,45 @@ def test_object_sets():
   assert len(db.object_sets(groups='dev', protocol='2.0.2', purposes='probe', mask_type='maskIII')) == 2114
 
   # as far as I know, the number of probes should be identical for each model...
-  for model_id in random.sample(db.model_ids(groups='dev', protocol='2.0.2', mask_type='maskIII'), 20):
+  for model_id in db.sample_model_ids(20, groups='dev', protocol='2.0.2', mask_type='maskIII', seed=2):
     assert len(db.object_sets(groups='dev', protocol='2.0.2', purposes='probe', mask_type='maskIII', model_ids=model_id)) == 2114
 
 
+def test_file_sets():
+  # Tests that the file sets of protocol 2.0.2 are selected by the mask and created once per signature
+  import numpy
+  from bob.db.frgc.models import get_list, get_mask
+  db = fixture_database()
+  signatures = get_list(fixture_directory, 'dev', '2.0.2')
+  columns = dict((f.m_model, index) for index, f in enumerate(signatures))
+  for mask_type in db.m_mask_types:
+    mask = get_mask(fixture_directory, '2.0.2', mask_type) > 0
+    models = db.object_sets(groups='dev', purposes='enroll', mask_type=mask_type)
+    assert [s.id for s in models] == db.model_ids(groups='dev', protocol='2.0.2', mask_type=mask_type)
+    probes = db.object_sets(groups='dev', purposes='probe', mask_type=mask_type)
+    assert sorted(s.id for s in probes) == [signatures[row].m_model for row in numpy.flatnonzero(mask.any(axis=1))]
+    assert sorted(f.id for s in probes for f in s.files) == [f.id for f in db.objects(groups='dev', protocol='2.0.2', purposes='probe', mask_type=mask_type)]
+    for model in models[:3]:
+      selected = db.object_sets(groups='dev', purposes='probe', mask_type=mask_type, model_ids=model.id)
+      assert sorted(s.id for s in selected) == [signatures[row].m_model for row in numpy.flatnonzero(mask[:, columns[model.id]])]
+
+  # the file sets are created once, and their files and paths are those of the list
+  sets = db.object_sets(groups='dev', purposes='enroll', mask_type=None)
+  assert all(first is second for first, second in zip(sets, db.object_sets(groups='dev', purposes='enroll', mask_type=None)))
+  for file_set in sets:
+    assert file_set.client_id == db.get_client_id_from_model_id(file_set.id)
+    assert all(f.client_id == file_set.client_id for f in file_set.files)
+    paths = [f.path for f in file_set.files]
+    assert file_set.path == paths[0] + ''.join('+' + path.split('d')[-1] for path in paths[1:])
+
+
 @db_available
 def test_file_ids():
   # Tests that the client id's returned by the 'get_client_id_from_file_id()' and 'get_client_id_from_model_id()' functions are correct.
   # this test might take a while...
   protocol = db.m_protocols[0]
   # extract all models
-  for model_id in random.sample(db.model_ids(groups='dev', protocol=protocol), 100):
+  for model_id in db.sample_model_ids(100, groups='dev', protocol=protocol, seed=3):
     # get the client id of the model
     client_id = db.get_client_id_from_model_id(model_id)
     # check that all files with the same model id share the same client id
@@ -149,8 +189,7 @@ def test_annotations():
   # Tests that the annotations are available for all files
   # we test only one of the protocols
   for protocol in random.sample(db.m_protocols, 1):
-    files = db.objects(protocol=protocol)
-    for file in random.sample(files, 1000):
+    for file in db.sample_objects(1000, protocol=protocol, seed=4):
       annotations = db.annotations(file)
       for t in 'leye', 'reye', 'mouth', 'nose':
         assert t in annotations
@@ -165,3 +204,928 @@ def test_driver_api():
   assert  main('frgc dumplist --group=dev --protocol=2.0.4 --purpose=enroll --self-test'.split()) == 0
   assert  main('frgc checkfiles --self-test'.split()) == 0
 
+
+def test_score_file():
+  # Tests that the score file writer writes exactly the masked scores
+  import numpy, tempfile, shutil, gzip
+  from bob.db.frgc.models import FRGCFile
+  from bob.db.frgc.scores import write_score_file
+
+  models, probes = [], []
+  for i in range(4):
+    models.append(FRGCFile('client%d' % (i % 2)))
+    models[-1].add('model%d' % i, 'dir/model%d.jpg' % i)
+  for i in range(3):
+    probes.append(FRGCFile('client%d' % (i % 2)))
+    probes[-1].add('probe%d' % i, 'dir/probe%d.jpg' % i)
+
+  scores = numpy.arange(12, dtype=numpy.float32).reshape(3, 4)
+  mask = numpy.array([[1, 0, 1, 0], [0, 0, 0, 1], [1, 1, 1, 1]], dtype=numpy.uint8)
+
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    score_file = os.path.join(temp_dir, 'scores.txt.gz')
+    assert write_score_file(score_file, scores, models, probes, mask, five_column=True, chunk_size=5) == 7
+    with gzip.open(score_file, 'rt') as f:
+      lines = [line.split() for line in f]
+    assert len(lines) == 7
+    for claimed, model_id, real, probe, score in lines:
+      m = [f.m_model for f in models].index(int(model_id))
+      p = [f.m_files['probe%d' % i] for i, f in enumerate(probes)].index(probe)
+      assert mask[p, m]
+      assert claimed == models[m].m_signature and real == probes[p].m_signature
+      assert float(score) == scores[p, m]
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_matrix_io():
+  # Tests that BEE matrices can be written block-wise and read back memory-mapped
+  import numpy, tempfile, shutil
+  from bob.db.frgc.models import read_mask
+
+  scores = numpy.random.rand(7, 5).astype(numpy.float32)
+  mask = (scores > 0.5).astype(numpy.uint8) * 255
+
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    score_file = os.path.join(temp_dir, 'scores.mtx')
+    with bob.db.frgc.MatrixWriter(score_file, scores.shape, 'target.xml', 'query.xml') as writer:
+      writer.write(scores[:3])
+      writer.write(scores[3])
+      writer.write(scores[4:])
+    matrix = bob.db.frgc.read_matrix(score_file)
+    assert isinstance(matrix, numpy.memmap)
+    assert numpy.array_equal(matrix, scores)
+    assert numpy.array_equal(matrix[mask > 0], scores[mask > 0])
+
+    mask_file = os.path.join(temp_dir, 'mask.mtx')
+    bob.db.frgc.write_matrix(mask_file, mask, matrix_type='B', block_size=2)
+    assert numpy.array_equal(read_mask(mask_file), mask)
+    # a similarity matrix is no mask
+    try:
+      read_mask(score_file)
+      assert False
+    except ValueError:
+      pass
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_evaluate():
+  # Tests that the histogram-based evaluation computes the exact verification rates
+  import numpy
+  from bob.db.frgc.models import FRGCFile
+  from bob.db.frgc.evaluate import evaluate
+
+  numpy.random.seed(7)
+  models = [FRGCFile('client%d' % (i % 20)) for i in range(300)]
+  probes = [FRGCFile('client%d' % (i % 20)) for i in range(200)]
+  genuine = numpy.array([[p.m_signature == m.m_signature for m in models] for p in probes])
+  scores = numpy.random.randn(200, 300).astype(numpy.float32) + 3. * genuine
+  mask = (numpy.random.rand(200, 300) < 0.6).astype(numpy.uint8)
+
+  result = evaluate(scores, models, probes, {'mask' : mask}, far_values=(0.001, 0.01), bins=32, block_size=17, parallel=2)['mask']
+  impostors = numpy.sort(scores[(mask > 0) & ~genuine])
+  genuines = scores[(mask > 0) & genuine]
+  assert result['impostors'] == len(impostors) and result['genuines'] == len(genuines)
+  for far, (threshold, far_value, vr) in result['vr_at_far'].items():
+    # the same threshold as when sorting all impostor scores
+    rejected = impostors[len(impostors) - int(far * len(impostors)) - 1]
+    assert threshold == numpy.nextafter(numpy.float64(rejected), numpy.inf)
+    assert far_value <= far
+    assert vr == (genuines >= threshold).mean()
+
+  # the histograms are accumulated in one pass over the scores, whose range needs not be known
+  class Rows:
+    def __init__(self, matrix):
+      self.matrix, self.shape, self.read = matrix, matrix.shape, 0
+    def __getitem__(self, rows):
+      self.read += len(range(*rows.indices(self.shape[0])))
+      return self.matrix[rows]
+  rows = Rows(scores * 1e-6)
+  result = evaluate(rows, models, probes, {'mask' : mask}, far_values=(0.01,), bins=32, block_size=17, parallel=2, exact=False)['mask']
+  assert rows.read == len(probes) and len(result['thresholds']) <= 32
+  assert result['impostors'] == len(impostors)
+
+  # masks need to be given
+  try:
+    evaluate(scores, models, probes, {'all' : None})
+    assert False
+  except ValueError:
+    pass
+
+
+def test_shards():
+  # Tests that the shards partition the models and cover all probes
+  db = fixture_database()
+  for protocol in ('2.0.1', '2.0.4'):
+    model_ids = db.model_ids(groups='dev', protocol=protocol)
+    probes = set(f.id for f in db.objects(groups='dev', protocol=protocol, purposes='probe'))
+    shards = [db.model_ids(groups='dev', protocol=protocol, shard_index=i, num_shards=7) for i in range(7)]
+    assert sorted(sum(shards, [])) == model_ids
+    sharded_probes = set()
+    for i in range(7):
+      sharded_probes.update(f.id for f in db.objects(groups='dev', protocol=protocol, purposes='probe', shard_index=i, num_shards=7))
+    assert sharded_probes == probes
+
+
+def test_async():
+  # Tests that concurrent asynchronous queries read each list once and return the same results as the synchronous ones
+  import asyncio
+  import concurrent.futures
+  from bob.db.frgc.asynchronous import AsyncDatabase
+  db = fixture_database()
+  executor = concurrent.futures.ThreadPoolExecutor(8)
+  async_db = AsyncDatabase(db, executor)
+
+  async def queries():
+    # 2.0.1 and 2.0.2 read enrollment and probe files from the same list
+    return await asyncio.gather(*[query for protocol in ('2.0.1', '2.0.2', '2.0.4') for query in (
+        async_db.model_ids(groups='dev', protocol=protocol),
+        async_db.objects(groups='dev', protocol=protocol, purposes='probe'),
+        async_db.client_ids(groups='dev', protocol=protocol, purposes='probe'))])
+
+  loop = asyncio.new_event_loop()
+  try:
+    results = loop.run_until_complete(queries())
+  finally:
+    loop.close()
+  for index, protocol in enumerate(('2.0.1', '2.0.2', '2.0.4')):
+    model_ids, probes, client_ids = results[3*index : 3*index+3]
+    assert model_ids
+    assert model_ids == db.model_ids(groups='dev', protocol=protocol)
+    assert [f.id for f in probes] == [f.id for f in db.objects(groups='dev', protocol=protocol, purposes='probe')]
+    assert client_ids == db.client_ids(groups='dev', protocol=protocol, purposes='probe')
+    # the model ids of the query results are those of the loaded lists
+    for model_id in model_ids:
+      assert db.get_client_id_from_model_id(model_id) in db.client_ids(groups='dev', protocol=protocol)
+
+  # the annotations of the SQLite index are read without the original directory
+  import tempfile, shutil
+  from bob.db.frgc.sqlindex import create_index
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    sqlite_file = os.path.join(temp_dir, 'frgc.sql3')
+    create_index(fixture_directory, sqlite_file)
+    # drop the annotations read by create_index
+    clear()
+    index_db = AsyncDatabase(bob.db.frgc.Database(os.path.join(temp_dir, 'missing'), sqlite_file=sqlite_file), executor)
+    loop = asyncio.new_event_loop()
+    try:
+      annotations = loop.run_until_complete(index_db.annotations(probes[0]))
+    finally:
+      loop.close()
+    assert annotations == db.annotations(probes[0])
+  finally:
+    shutil.rmtree(temp_dir)
+
+  # concurrent synchronous queries share the lists as well
+  db = fixture_database()
+  model_ids = executor.map(lambda protocol: db.model_ids(groups='dev', protocol=protocol), ['2.0.1', '2.0.2'] * 8)
+  for model_id in sum(model_ids, []):
+    db.get_client_id_from_model_id(model_id)
+
+  # different sources are read in parallel: a list is read, while another thread reads a mask
+  from bob.db.frgc.models import load_lock, get_list
+  clear()
+  with load_lock(('mask', '2.0.4', 'maskIII')):
+    assert executor.submit(get_list, fixture_directory, 'world').result(timeout=10)
+  executor.shutdown()
+
+
+def test_refresh():
+  # Tests that modified lists and masks are reloaded and that the invalidation listeners are informed
+  import tempfile, shutil
+  from bob.db.frgc.models import add_invalidation_listener, invalidation_listeners, read_mask
+
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  invalidated = []
+  try:
+    directory = os.path.join(temp_dir, 'FRGC')
+    shutil.copytree(fixture_directory, directory)
+    clear()
+    db = bob.db.frgc.Database(directory)
+    probes = db.objects(groups='dev', protocol='2.0.4', purposes='probe')
+    model_ids = db.model_ids(groups='dev', protocol='2.0.4')
+    assert db.refresh() == []
+    add_invalidation_listener(invalidated.append)
+
+    # move the first probe to another directory, and remove it from the mask
+    list_file = os.path.join(directory, 'BEE_DIST', 'FRGC2.0', 'signature_sets', 'experiments', 'FRGC_Exp_2.0.4_Query.xml')
+    with open(list_file) as f:
+      content = f.read()
+    with open(list_file, 'w') as f:
+      f.write(content.replace('file-name="' + probes[0].path, 'file-name="moved/' + probes[0].path, 1))
+    mask_file = os.path.join(directory, 'BEE_DIST', 'FRGC2.0', 'Experiment4', 'output', 'maskIII.mtx')
+    mask = read_mask(mask_file)
+    row = [f.id for f in db.objects(groups='dev', protocol='2.0.4', purposes='probe', mask_type=None)].index(probes[0].id)
+    mask[row] = 0
+    stat = os.stat(mask_file)
+    bob.db.frgc.write_matrix(mask_file, mask, matrix_type='B')
+    # the size of the mask is unchanged, so make sure that the modification is detected
+    os.utime(mask_file, (stat.st_atime, stat.st_mtime + 10))
+
+    changed = [('list', 'dev', '2.0.4', 'probe'), ('mask', '2.0.4', 'maskIII')]
+    assert db.refresh() == changed
+    assert invalidated == changed
+    assert db.refresh() == []
+    reloaded = db.objects(groups='dev', protocol='2.0.4', purposes='probe')
+    assert [f.id for f in reloaded] == [f.id for f in probes[1:]]
+    paths = dict((f.id, f.path) for f in db.objects(groups='dev', protocol='2.0.4', purposes='probe', mask_type=None))
+    assert paths[probes[0].id] == 'moved/' + probes[0].path
+    # the enrollment list has not changed
+    assert db.model_ids(groups='dev', protocol='2.0.4') == model_ids
+  finally:
+    if invalidated.append in invalidation_listeners:
+      invalidation_listeners.remove(invalidated.append)
+    clear()
+    shutil.rmtree(temp_dir)
+
+
+def test_reverse_index():
+  # Tests that the reverse index is consistent with the queries, also when it is read from the shared cache
+  import tempfile, shutil
+  from bob.db.frgc.models import set_cache_directory
+
+  def check(db):
+    for file in db.sample_objects(12, groups=('world', 'dev'), protocol=('2.0.1', '2.0.4'), seed=5):
+      client_id = db.get_client_id_from_file_id(file.id)
+      assert file.id in [f.id for f in db.get_files_from_client_id(client_id)]
+      for model_id in db.get_model_ids_from_file_id(file.id):
+        assert db.get_client_id_from_model_id(model_id) == client_id
+        assert model_id in db.get_model_ids_from_client_id(client_id)
+    return [(f.id, db.get_model_ids_from_file_id(f.id), db.get_lists_from_file_id(f.id)) for f in db.objects(groups='dev', protocol='2.0.2')]
+
+  expected = check(fixture_database())
+  assert expected
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    cache_directory = os.path.join(temp_dir, 'cache')
+    check(fixture_database(cache_directory=cache_directory))
+    assert any(f.startswith('reverse_index.') and not f.endswith('.lock') for f in os.listdir(cache_directory))
+    # the index read from the cache refers to the model ids of the lists read in this session
+    db = fixture_database(cache_directory=cache_directory)
+    model_ids = db.model_ids(groups='dev', protocol='2.0.2')
+    cached = check(db)
+    assert [(file_id, lists) for file_id, models, lists in cached] == [(file_id, lists) for file_id, models, lists in expected]
+    assert set(model_ids) <= set(sum([models for file_id, models, lists in cached], []))
+  finally:
+    set_cache_directory(None)
+    clear()
+    shutil.rmtree(temp_dir)
+
+
+def test_counts():
+  # Tests that the counts are identical to the number of queried objects
+  import numpy
+  from bob.db.frgc.models import get_mask
+  db = fixture_database()
+  assert db.count_objects(mask_type='maskIII') == len(db.objects(mask_type='maskIII'))
+  assert db.count_model_ids(groups='world') == len(db.model_ids(groups='world'))
+  for protocol in db.m_protocols:
+    for mask_type in db.m_mask_types:
+      assert db.count_model_ids(groups='dev', protocol=protocol, mask_type=mask_type) == len(db.model_ids(groups='dev', protocol=protocol, mask_type=mask_type))
+      for purpose in db.m_purposes:
+        assert db.count_objects(groups='dev', protocol=protocol, purposes=purpose, mask_type=mask_type) == len(db.objects(groups='dev', protocol=protocol, purposes=purpose, mask_type=mask_type))
+      assert sum(db.count_objects(groups='dev', protocol=protocol, purposes='probe', mask_type=mask_type, shard_index=i, num_shards=3) for i in range(3)) == \
+          sum(len(db.objects(groups='dev', protocol=protocol, purposes='probe', mask_type=mask_type, shard_index=i, num_shards=3)) for i in range(3))
+      estimate = db.cost_estimate(protocol, mask_type)
+      assert estimate['models'] == len(db.model_ids(groups='dev', protocol=protocol, mask_type=mask_type))
+      probes = db.object_sets(groups='dev', protocol=protocol, purposes='probe', mask_type=mask_type) if protocol == '2.0.2' else db.objects(groups='dev', protocol=protocol, purposes='probe', mask_type=mask_type)
+      assert estimate['probes'] == len(probes)
+      assert estimate['comparisons'] == numpy.count_nonzero(get_mask(fixture_directory, protocol, mask_type))
+      assert sum(db.count_comparisons(protocol, mask_type, shard_index=i, num_shards=3) for i in range(3)) == estimate['comparisons']
+  assert db.count_object_sets(purposes='probe', mask_type='maskIII') == len(db.object_sets(purposes='probe', mask_type='maskIII'))
+  assert db.count_objects(groups='dev', protocol='2.0.4', filters={'environment' : 'controlled'}) == len(db.objects(groups='dev', protocol='2.0.4', filters={'environment' : 'controlled'}))
+
+
+def test_sqlite_index():
+  # Tests that the queries answered from the SQLite index are identical to the ones answered from the XML lists
+  import tempfile, shutil
+  from bob.db.frgc.sqlindex import create_index
+  xml_db = fixture_database()
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    sqlite_file = os.path.join(temp_dir, 'frgc.sql3')
+    create_index(fixture_directory, sqlite_file)
+    sql_db = bob.db.frgc.Database(fixture_directory, sqlite_file=sqlite_file)
+
+    def ids(files):
+      return [f.id for f in files]
+
+    def clients(db, model_ids):
+      return [db.get_client_id_from_model_id(model_id) for model_id in model_ids]
+
+    assert ids(sql_db.objects(groups='world')) == ids(xml_db.objects(groups='world'))
+    for protocol in xml_db.m_protocols:
+      for mask_type in ('maskI', 'maskII', 'maskIII', None):
+        for purpose in xml_db.m_purposes:
+          assert sql_db.client_ids(groups='dev', protocol=protocol, purposes=purpose, mask_type=mask_type) == xml_db.client_ids(groups='dev', protocol=protocol, purposes=purpose, mask_type=mask_type)
+          assert ids(sql_db.objects(groups='dev', protocol=protocol, purposes=purpose, mask_type=mask_type)) == ids(xml_db.objects(groups='dev', protocol=protocol, purposes=purpose, mask_type=mask_type))
+        # the model ids differ, but both are assigned in the order of the list
+        sql_models = sql_db.model_ids(groups='dev', protocol=protocol, mask_type=mask_type)
+        xml_models = xml_db.model_ids(groups='dev', protocol=protocol, mask_type=mask_type)
+        assert clients(sql_db, sql_models) == clients(xml_db, xml_models)
+        assert ids(sql_db.objects(groups='dev', protocol=protocol, model_ids=sql_models[1:3], mask_type=mask_type)) == ids(xml_db.objects(groups='dev', protocol=protocol, model_ids=xml_models[1:3], mask_type=mask_type))
+        for i in range(3):
+          assert clients(sql_db, sql_db.model_ids(groups='dev', protocol=protocol, mask_type=mask_type, shard_index=i, num_shards=3)) == clients(xml_db, xml_db.model_ids(groups='dev', protocol=protocol, mask_type=mask_type, shard_index=i, num_shards=3))
+          assert ids(sql_db.objects(groups='dev', protocol=protocol, mask_type=mask_type, shard_index=i, num_shards=3)) == ids(xml_db.objects(groups='dev', protocol=protocol, mask_type=mask_type, shard_index=i, num_shards=3))
+    file = xml_db.objects(groups='dev', protocol='2.0.4', purposes='probe')[0]
+    assert sql_db.annotations(file) == xml_db.annotations(file)
+    assert sql_db.get_client_id_from_file_id(file.id) == xml_db.get_client_id_from_file_id(file.id)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_crop_face():
+  # Tests that the eyes end up at the requested positions in the cropped face
+  import numpy
+  from bob.db.frgc.facecache import crop_face
+  image = numpy.zeros((200, 300))
+  image[90, 200] = 255.
+  face = crop_face(image, {'reye' : (110, 100), 'leye' : (90, 200)}, crop_size=(80, 64), right_eye=(16, 15), left_eye=(16, 48))
+  assert face.shape == (80, 64)
+  assert numpy.unravel_index(face.argmax(), face.shape) == (16, 48)
+
+
+def test_face_cache():
+  # Tests that the face cache stores the cropped faces of the annotated images in shards
+  import numpy, tempfile, shutil
+  from bob.db.frgc.facecache import crop_face, to_gray, FaceCache
+  db = fixture_database()
+  files = db.objects(groups='dev', protocol='2.0.4', purposes='probe')
+
+  def loader(path):
+    # a color image, which depends on the file
+    random_state = numpy.random.RandomState(sum(bytearray(os.path.basename(path).encode('ascii'))))
+    return random_state.randint(0, 256, size=(3, 120, 100)).astype(numpy.uint8)
+
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    cache_dir = os.path.join(temp_dir, 'faces')
+    cache = db.build_face_cache(files, cache_dir, crop_size=(20, 16), right_eye=(5, 4), left_eye=(5, 12), shard_size=3, directory=temp_dir, extension='.jpg', loader=loader, parallel=2)
+    assert len(cache) == len(files)
+    assert len([f for f in os.listdir(cache_dir) if f.startswith('faces_')]) == (len(files) + 2) // 3
+    assert cache.info['crop_size'] == [20, 16] and cache.info['gray']
+    assert files[0] in cache and 'unknown' not in cache
+
+    # the faces are read back from a new cache object
+    cache = FaceCache(cache_dir)
+    faces = cache.faces(files)
+    assert faces.shape == (len(files), 20, 16) and faces.dtype == numpy.uint8
+    for f, face in zip(files, faces):
+      expected = crop_face(to_gray(loader(f.make_path(temp_dir, '.jpg'))), db.annotations(f), (20, 16), (5, 4), (5, 12))
+      assert numpy.array_equal(face, numpy.clip(numpy.round(expected), 0, 255).astype(numpy.uint8))
+      assert numpy.array_equal(cache[f.id], face)
+    try:
+      cache['unknown']
+      assert False
+    except KeyError:
+      pass
+
+    # files without annotations are reported before anything is written
+    missing_dir = os.path.join(temp_dir, 'missing')
+    try:
+      db.build_face_cache(files[:2] + [bob.db.frgc.File(files[0].client_id, 'nd1R99999d999', 'Spring2004/nd1R99999d999')], missing_dir, directory=temp_dir, extension='.jpg', loader=loader)
+      assert False
+    except ValueError as e:
+      assert 'nd1R99999d999' in str(e)
+    assert not os.path.exists(missing_dir)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_mask_cache():
+  # Tests that masks are cached losslessly and that outdated caches are not used
+  import numpy, tempfile, shutil
+  from bob.db.frgc.models import read_cached_mask, read_compressed_mask, source_stat
+
+  mask = numpy.zeros((50, 40), dtype=numpy.uint8)
+  mask[numpy.random.rand(50, 40) < 0.3] = 0x7f
+  mask[numpy.random.rand(50, 40) < 0.3] = 0xff
+
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    mask_file = os.path.join(temp_dir, 'mask.mtx')
+    cache_file = os.path.join(temp_dir, 'cache', 'mask.mask')
+    bob.db.frgc.write_matrix(mask_file, mask, matrix_type='B')
+    assert numpy.array_equal(read_cached_mask(mask_file, source_stat(mask_file), cache_file), mask)
+    assert numpy.array_equal(read_compressed_mask(cache_file, source_stat(mask_file)), mask)
+    # a modified mask file invalidates the cache
+    bob.db.frgc.write_matrix(mask_file, mask[:, :30], matrix_type='B')
+    assert read_compressed_mask(cache_file, source_stat(mask_file)) is None
+    assert numpy.array_equal(read_cached_mask(mask_file, source_stat(mask_file), cache_file), mask[:, :30])
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_shared_cache():
+  # Tests that artifacts are built once per generation of their source file, and read from the shared cache afterwards
+  import tempfile, shutil
+  from bob.db.frgc.models import cached, cache_generation, set_cache_directory, source_stat
+
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  builds = []
+  def build():
+    builds.append(source_file)
+    with open(source_file) as f:
+      return f.read().upper()
+  def write(artifact, cache_file):
+    with open(cache_file, 'w') as f:
+      f.write(artifact)
+  def read(cache_file):
+    with open(cache_file) as f:
+      return f.read()
+  try:
+    set_cache_directory(os.path.join(temp_dir, 'cache'))
+    source_file = os.path.join(temp_dir, 'source.txt')
+    with open(source_file, 'w') as f:
+      f.write('first')
+    for i in range(2):
+      assert cached('artifact', source_stat(source_file), read, build, write) == 'FIRST'
+    assert len(builds) == 1
+    # a modified source file replaces the cached generation
+    with open(source_file, 'w') as f:
+      f.write('second generation')
+    assert cached('artifact', source_stat(source_file), read, build, write) == 'SECOND GENERATION'
+    assert len(builds) == 2
+    assert set(os.listdir(os.path.join(temp_dir, 'cache'))) == set(('artifact.lock', 'artifact.' + cache_generation(source_stat(source_file))))
+  finally:
+    set_cache_directory(None)
+    shutil.rmtree(temp_dir)
+
+
+def test_cache_directories():
+  # Tests that masks are cached in the mask cache directory, if given, and in the shared cache directory otherwise
+  import numpy, tempfile, shutil
+  from bob.db.frgc.models import set_cache_directory, set_mask_cache_directory, get_mask, read_mask, read_compressed_mask, source_stat, mask_cache_file
+
+  mask_file = os.path.join(fixture_directory, 'BEE_DIST', 'FRGC2.0', 'Experiment1', 'output', 'maskIII.mtx')
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    mask_cache_directory, cache_directory = os.path.join(temp_dir, 'masks'), os.path.join(temp_dir, 'cache')
+    db = fixture_database(mask_cache_directory=mask_cache_directory, cache_directory=cache_directory)
+    files = [f.id for f in db.objects(groups='dev', protocol='2.0.1')]
+    cache_file = os.path.basename(mask_cache_file(mask_cache_directory, mask_file, '2.0.1', 'maskIII'))
+    assert cache_file.startswith('2.0.1_maskIII.')
+    assert sorted(os.listdir(mask_cache_directory)) == [cache_file, cache_file + '.lock']
+    assert not [f for f in os.listdir(cache_directory) if 'mask' in f]
+    assert any(f.startswith('list_dev_2.0.1.') for f in os.listdir(cache_directory))
+    assert numpy.array_equal(read_compressed_mask(os.path.join(mask_cache_directory, cache_file), source_stat(mask_file)), read_mask(mask_file))
+
+    # without mask cache directory, the masks are cached in the same format in the shared cache directory
+    set_mask_cache_directory(None)
+    db = fixture_database()
+    assert [f.id for f in db.objects(groups='dev', protocol='2.0.1')] == files
+    assert numpy.array_equal(read_compressed_mask(os.path.join(cache_directory, cache_file), source_stat(mask_file)), read_mask(mask_file))
+    # cached masks are read from the cache
+    clear()
+    assert numpy.array_equal(get_mask(fixture_directory, '2.0.1', 'maskIII'), read_mask(mask_file))
+
+    # the masks of several trees are cached in separate files of the shared cache directory
+    copy_directory = os.path.join(temp_dir, 'FRGC')
+    shutil.copytree(fixture_directory, copy_directory)
+    copy_file = os.path.join(copy_directory, 'BEE_DIST', 'FRGC2.0', 'Experiment1', 'output', 'maskIII.mtx')
+    mask = read_mask(mask_file)
+    bob.db.frgc.write_matrix(copy_file, (mask == 0).astype(numpy.uint8) * 0xff, 'FRGC_target.xml', 'FRGC_query.xml', matrix_type='B')
+    clear()
+    assert numpy.array_equal(get_mask(copy_directory, '2.0.1', 'maskIII'), read_mask(copy_file))
+    assert numpy.array_equal(read_compressed_mask(os.path.join(cache_directory, cache_file), source_stat(mask_file)), mask)
+    assert numpy.array_equal(read_compressed_mask(mask_cache_file(cache_directory, copy_file, '2.0.1', 'maskIII'), source_stat(copy_file)), read_mask(copy_file))
+  finally:
+    set_cache_directory(None)
+    set_mask_cache_directory(None)
+    clear()
+    shutil.rmtree(temp_dir)
+
+
+def test_lazy_mask():
+  # Tests the indexing of lazily evaluated masks on small lists in memory
+  import numpy
+  from bob.db.frgc.models import FRGCFile, intern_presentation, store_list, list_key, known_masks
+  from bob.db.frgc.masks import Mask, AllPairs, SameClient
+
+  def frgc_list(clients, prefix):
+    frgc_files = []
+    for index, client in enumerate(clients):
+      frgc_file = FRGCFile(client)
+      frgc_file.m_presentations = (intern_presentation('%s%d' % (prefix, index), 'lazy/%s%d' % (prefix, index), client),)
+      frgc_files.append(frgc_file)
+    return frgc_files
+
+  clear()
+  try:
+    model_clients, probe_clients = ['a', 'b', 'c', 'a'], ['b', 'a', 'c', 'c', 'd']
+    store_list(list_key('dev', '2.0.4', 'enroll'), frgc_list(model_clients, 'lazy_model_'))
+    store_list(list_key('dev', '2.0.4', 'probe'), frgc_list(probe_clients, 'lazy_probe_'))
+    mask = numpy.arange(20, dtype=numpy.uint8).reshape(5, 4) % 3 * 0x7f
+    known_masks['2.0.4']['maskI'] = mask
+
+    lazy = Mask('maskI').bind('lazy', '2.0.4')
+    assert lazy.shape == mask.shape
+    for index in range(-5, 5):
+      assert numpy.array_equal(lazy[index], mask[index] > 0)
+    for rows in (slice(None), slice(1, -1), slice(-2, None), slice(None, None, -2), slice(4, 10)):
+      assert numpy.array_equal(lazy[rows], mask[rows] > 0)
+    assert numpy.array_equal(lazy[-1, [0, 3]], mask[-1, [0, 3]] > 0)
+    for index in (5, -6):
+      try:
+        lazy[index]
+        assert False
+      except IndexError:
+        pass
+
+    all_pairs = AllPairs().bind('lazy', '2.0.4')
+    assert all_pairs[-1].shape == (4,) and all_pairs[-1].all()
+    for rows in (slice(None), slice(1, -1), slice(None, None, -2), slice(3, 1)):
+      assert all_pairs[rows].shape == numpy.ones(mask.shape)[rows].shape
+    # block-wise scans do not accumulate state in the mask
+    cached = len(all_pairs.m_cache)
+    for start in range(5):
+      all_pairs[start:start + 1]
+    assert len(all_pairs.m_cache) == cached
+    genuine = (Mask('maskI') | ~Mask('maskI')) & SameClient()
+    assert numpy.array_equal(numpy.asarray(genuine.bind('lazy', '2.0.4')), numpy.array(probe_clients)[:, None] == numpy.array(model_clients)[None, :])
+    assert numpy.array_equal(genuine.bind('lazy', '2.0.4')[-2], numpy.array(model_clients) == probe_clients[-2])
+  finally:
+    clear()
+
+
+def test_mask_expressions():
+  # Tests that mask expressions are evaluated like the original masks
+  from bob.db.frgc.masks import Mask, SameClient, ClientRestriction
+  db = fixture_database()
+  mask = Mask('maskIII')
+  assert [f.id for f in db.objects(groups='dev', protocol='2.0.1', mask_type=mask & mask)] == [f.id for f in db.objects(groups='dev', protocol='2.0.1', mask_type='maskIII')]
+  assert len(db.objects(groups='dev', protocol='2.0.1', mask_type=mask - mask)) == 0
+  genuines = db.count_comparisons(protocol='2.0.1', mask_type=mask & SameClient())
+  assert 0 < genuines < db.count_comparisons(protocol='2.0.1', mask_type='maskIII')
+  assert genuines + db.count_comparisons(protocol='2.0.1', mask_type=mask - SameClient()) == db.count_comparisons(protocol='2.0.1', mask_type='maskIII')
+  client = db.client_ids(groups='dev', protocol='2.0.1')[0]
+  assert db.client_ids(groups='dev', protocol='2.0.1', purposes='enroll', mask_type=mask & ClientRestriction(model_clients=[client])) == [client]
+
+
+def test_metadata():
+  # Tests that the metadata is read into typed columns and that attribute filters work
+  import numpy, xml.sax
+  from bob.db.frgc.models import AnnotationFileReader, Metadata
+  reader = AnnotationFileReader()
+  xml.sax.parseString(b'<Metadata><Session semester="Fall2003">'
+      b'<Recording recording_id="a" subject_id="s1" capturedate="9/3/2003" environment="controlled" yaw="1.5"><LeftEyeCenter x="1" y="2"/><RightEyeCenter x="3" y="4"/><Nose x="5" y="6"/><Mouth x="7" y="8"/></Recording>'
+      b'<Recording recording_id="b" subject_id="s2" capturedate="10/13/2003" environment="uncontrolled"><Lighting type="flash"/></Recording>'
+      b'</Session></Metadata>', reader)
+  assert list(reader.m_annotation_map) == ['a']
+  metadata = Metadata(reader.m_metadata_map)
+  assert metadata['capturedate'].dtype == numpy.dtype('datetime64[D]')
+  assert numpy.isnan(metadata['yaw'][1])
+  record = metadata.record('b')
+  assert sorted(record) == ['Lighting.type', 'Session.semester', 'capturedate', 'environment', 'subject_id', 'yaw']
+  assert record['Lighting.type'] == 'flash' and record['Session.semester'] == 'Fall2003' and record['capturedate'].month == 10
+  assert metadata.selected({'environment' : 'controlled'}, ['b', 'a', 'c']).tolist() == [False, True, False]
+  assert metadata.selected({'capturedate' : lambda dates: dates >= numpy.datetime64('2003-10-01')}, ['a', 'b']).tolist() == [False, True]
+  assert metadata.selected({'Session.semester' : ['Fall2003', 'Spring2004']}, ['a', 'b']).tolist() == [True, True]
+
+
+def test_metadata_filters():
+  # Tests the attribute filters of the queries
+  import numpy
+  from bob.db.frgc.masks import Mask, MetadataRestriction, MetadataPairRestriction
+  from bob.db.frgc.models import get_list, get_mask, presentation_ids
+  db = fixture_database()
+  controlled = db.objects(groups='dev', protocol='2.0.4', filters={'environment' : 'controlled'})
+  uncontrolled = db.objects(groups='dev', protocol='2.0.4', filters={'environment' : 'uncontrolled'})
+  assert controlled and uncontrolled
+  assert len(controlled) + len(uncontrolled) == len(db.objects(groups='dev', protocol='2.0.4'))
+  assert all(db.metadata(f)['environment'] == 'controlled' for f in controlled)
+  assert all(db.metadata(f)['environment'] == 'uncontrolled' for f in uncontrolled)
+
+  # compare the restricted masks with the metadata of the models and probes
+  def dates(purpose):
+    return numpy.array([db.metadata().record(presentation_ids[f.m_presentations[0]])['capturedate'] for f in get_list(fixture_directory, 'dev', '2.0.4', purpose)], dtype='datetime64[D]')
+  def environments(purpose):
+    return numpy.array([db.metadata().record(presentation_ids[f.m_presentations[0]])['environment'] for f in get_list(fixture_directory, 'dev', '2.0.4', purpose)])
+  mask = get_mask(fixture_directory, '2.0.4', 'maskIII') > 0
+  restricted = db.count_comparisons('2.0.4', Mask('maskIII') & MetadataRestriction(probes={'environment' : 'uncontrolled'}))
+  assert 0 < restricted < db.count_comparisons('2.0.4', 'maskIII')
+  assert restricted == numpy.count_nonzero(mask & (environments('probe') == 'uncontrolled')[:, None])
+  later = MetadataPairRestriction('capturedate', lambda probe, model: probe - model >= numpy.timedelta64(2, 'D'))
+  assert db.count_comparisons('2.0.4', Mask('maskIII') & later) == numpy.count_nonzero(mask & (dates('probe')[:, None] - dates('enroll')[None, :] >= numpy.timedelta64(2, 'D')))
+
+
+def test_server():
+  # Tests that the queries forwarded to the query server return the same results
+  import threading, tempfile, shutil, time, stat
+  from bob.db.frgc.server import serve, forwarded_methods, NotForwardable
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    socket_file = os.path.join(temp_dir, 'frgc.sock')
+    db = fixture_database()
+    thread = threading.Thread(target=serve, args=(db, socket_file))
+    thread.daemon = True
+    thread.start()
+    while not os.path.exists(socket_file):
+      time.sleep(0.01)
+    # only the owner may connect
+    assert stat.S_IMODE(os.stat(socket_file).st_mode) & 0o077 == 0
+
+    client = bob.db.frgc.Database(fixture_directory, server_socket=socket_file)
+    for method in forwarded_methods:
+      assert hasattr(getattr(bob.db.frgc.Database, method), '__wrapped__'), method
+    files = client.objects(groups='dev', protocol='2.0.4', purposes='probe')
+    assert [(f.id, f.client_id, f.path) for f in files] == [(f.id, f.client_id, f.path) for f in db.objects(groups='dev', protocol='2.0.4', purposes='probe')]
+    assert client.model_ids(groups='dev', protocol='2.0.1') == db.model_ids(groups='dev', protocol='2.0.1')
+    assert client.annotations(files[0]) == db.annotations(files[0])
+    assert client.count_comparisons('2.0.4') == db.count_comparisons('2.0.4')
+    assert [f.id for f in client.sample_objects(5, groups='world', seed=1)] == [f.id for f in db.sample_objects(5, groups='world', seed=1)]
+
+    # file sets are transferred with their model ids and files
+    def file_set(s):
+      return (s.id, s.client_id, s.path, [(f.id, f.path) for f in s.files])
+    assert [file_set(s) for s in client.object_sets(groups='dev', purposes='enroll')] == [file_set(s) for s in db.object_sets(groups='dev', purposes='enroll')]
+    # locally, the same FileSet objects would be returned
+    assert client.object_sets(groups='dev', purposes='enroll')[0] is not db.object_sets(groups='dev', purposes='enroll')[0]
+    for protocol in ('2.0.1', '2.0.2'):
+      pairs = client.sample_pairs(6, protocol=protocol, seed=2)
+      assert len(pairs) == 6
+      assert [(m, file_set(p) if protocol == '2.0.2' else p.id) for m, p in pairs] == [(m, file_set(p) if protocol == '2.0.2' else p.id) for m, p in db.sample_pairs(6, protocol=protocol, seed=2)]
+
+    # queries with lambda functions are executed locally, but only without the model ids of the server
+    from bob.db.frgc.masks import Mask, MetadataPairRestriction
+    later = Mask('maskIII') & MetadataPairRestriction('capturedate', lambda probe, model: probe >= model)
+    assert client.count_comparisons('2.0.4', later) == db.count_comparisons('2.0.4', later)
+    try:
+      client.count_comparisons('2.0.4', later, model_ids=client.model_ids(groups='dev', protocol='2.0.4')[:2])
+      assert False
+    except NotForwardable:
+      pass
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_server_socket():
+  # Tests that the query server socket is only used in directories that no other user can write
+  import socket, tempfile, shutil, stat
+  from bob.db.frgc.server import socket_directory, check_directory, check_peer, QueryServer, QueryClient
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  environment = dict((name, os.environ.pop(name, None)) for name in ('TMPDIR', 'XDG_RUNTIME_DIR'))
+  try:
+    # the default directory is created privately in the temporary directory, unless the XDG runtime directory is set
+    os.environ['TMPDIR'] = temp_dir
+    tempfile.tempdir = None
+    directory = socket_directory()
+    assert os.path.dirname(directory) == temp_dir
+    check_directory(directory, create=True)
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    assert os.path.dirname(bob.db.frgc.driver.Interface().server_socket()) == directory
+    os.environ['XDG_RUNTIME_DIR'] = directory
+    assert socket_directory() == directory
+
+    # neither server nor client use a socket in a directory that others can write
+    shared = os.path.join(temp_dir, 'shared')
+    os.mkdir(shared)
+    os.chmod(shared, 0o1777)
+    for create in (lambda: QueryServer(None, os.path.join(shared, 'frgc.sock')), lambda: QueryClient(os.path.join(shared, 'frgc.sock'))._connect()):
+      try:
+        create()
+        assert False
+      except IOError:
+        pass
+
+    # the peer of a connection is a process of the current user
+    first, second = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    check_peer(first, None)
+    first.close()
+    second.close()
+  finally:
+    for name, value in environment.items():
+      os.environ.pop(name, None)
+      if value is not None:
+        os.environ[name] = value
+    tempfile.tempdir = None
+    shutil.rmtree(temp_dir)
+
+
+def test_snapshot():
+  # Tests that pickled databases restore the lists with the same model ids
+  import pickle, tempfile, shutil
+  from bob.db.frgc.models import snapshot, restore_snapshot, store_list, loaded_lists
+  db = fixture_database()
+  model_ids = db.model_ids(groups='dev', protocol='2.0.4')
+  set_ids = db.model_ids(groups='dev', protocol='2.0.2')
+  files = db.objects(groups='dev', protocol='2.0.4', model_ids=model_ids[:5])
+  state = snapshot()
+  # simulate a new process, which has not read any list
+  for key in loaded_lists():
+    store_list(key, None)
+  restore_snapshot(state)
+  assert db.model_ids(groups='dev', protocol='2.0.4') == model_ids
+  assert db.model_ids(groups='dev', protocol='2.0.2') == set_ids
+  copy = pickle.loads(pickle.dumps(db))
+  assert copy.model_ids(groups='dev', protocol='2.0.4') == model_ids
+  assert [f.id for f in copy.objects(groups='dev', protocol='2.0.4', model_ids=model_ids[:5])] == [f.id for f in files]
+
+  # pickled databases with a snapshot file restore the lists from the file
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    db.save_snapshot(os.path.join(temp_dir, 'lists.npz'))
+    data = pickle.dumps(db)
+    for key in loaded_lists():
+      store_list(key, None)
+    copy = pickle.loads(data)
+    assert copy.model_ids(groups='dev', protocol='2.0.4') == model_ids
+    assert [f.id for f in copy.objects(groups='dev', protocol='2.0.4', model_ids=model_ids[:5])] == [f.id for f in files]
+  finally:
+    shutil.rmtree(temp_dir)
+    clear()
+
+
+def test_batch_client_ids():
+  # Tests that the batch lookups of client ids agree with the single lookups
+  db = fixture_database()
+  files = db.objects(groups=('world', 'dev'))
+  assert db.get_client_ids_from_file_ids([f.id for f in files] * 2).tolist() == [f.client_id for f in files] * 2
+  assert db.get_client_ids_from_file_ids([]).tolist() == []
+  model_ids = db.model_ids(groups='dev', protocol='2.0.4') + db.model_ids(groups='dev', protocol='2.0.2')
+  assert db.get_client_ids_from_model_ids(model_ids).tolist() == [db.get_client_id_from_model_id(m) for m in model_ids]
+  for function, ids in ((db.get_client_ids_from_file_ids, [files[0].id, 'unknown']), (db.get_client_ids_from_model_ids, [model_ids[0], -1])):
+    try:
+      function(ids)
+      assert False
+    except ValueError:
+      pass
+
+
+def test_manifest():
+  # Tests that manifests detect modified and missing files, and that unchanged files are not hashed again
+  import tempfile, shutil
+  from bob.db.frgc.manifest import check_files, read_manifest, write_manifest
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    paths = ['a.jpg', 'b.jpg', 'c.jpg']
+    for path in paths:
+      with open(os.path.join(temp_dir, path), 'wb') as f:
+        f.write(path.encode() * 100)
+    entries, missing, modified, hashed = check_files(paths, temp_dir, processes=2)
+    assert (len(entries), missing, modified, hashed) == (3, [], [], 3)
+    manifest_file = os.path.join(temp_dir, 'manifest.txt')
+    write_manifest(manifest_file, 'sha1', entries)
+    algorithm, manifest = read_manifest(manifest_file)
+    assert algorithm == 'sha1' and manifest == entries
+    assert check_files(paths, temp_dir, manifest, processes=2)[1:] == ([], [], 0)
+
+    with open(os.path.join(temp_dir, 'a.jpg'), 'wb') as f:
+      f.write(b'corrupt')
+    os.remove(os.path.join(temp_dir, 'b.jpg'))
+    assert check_files(paths, temp_dir, manifest, processes=2)[1:] == (['b.jpg'], ['a.jpg'], 1)
+
+    # the algorithm of an existing manifest is only changed when all files are hashed again
+    import argparse
+    from bob.db.frgc.driver import check_manifest
+    def check(algorithm, rehash):
+      args = argparse.Namespace(directory=temp_dir, manifest=manifest_file, algorithm=algorithm, processes=2, rehash=rehash, update=True)
+      return check_manifest(args, [os.path.join(temp_dir, path) for path in ('a.jpg', 'c.jpg')], bob.db.base.utils.null())
+    # the modification of a.jpg is accepted
+    assert check(None, False) == 1
+    assert check('sha1', False) == 0
+    assert check('md5', False) == 1
+    assert read_manifest(manifest_file)[0] == 'sha1'
+    assert check('md5', True) == 0
+    algorithm, manifest = read_manifest(manifest_file)
+    assert algorithm == 'md5' and sorted(manifest) == ['a.jpg', 'c.jpg']
+    assert check(None, False) == 0
+    assert read_manifest(manifest_file)[0] == 'md5'
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_sample_units():
+  # Tests that sampled items are distinct, reproducible and distributed over the strata
+  import numpy
+  from bob.db.frgc.models import sample_units
+  weights = numpy.array([3, 0, 2, 5, 1])
+  units, offsets = sample_units(weights, 6, strata=[0, 0, 1, 1, 2], seed=1)
+  assert len(set(zip(units.tolist(), offsets.tolist()))) == 6
+  assert (offsets < weights[units]).all()
+  assert sorted(numpy.bincount(numpy.array([0, 0, 1, 1, 2])[units]).tolist()) == [1, 2, 3]
+  assert all((a == b).all() for a, b in zip((units, offsets), sample_units(weights, 6, strata=[0, 0, 1, 1, 2], seed=1)))
+  assert len(sample_units(weights, 100)[0]) == 11
+
+
+def test_sample_pairs():
+  # Tests that sampled pairs are selected by the mask
+  db = fixture_database()
+  for protocol in ('2.0.1', '2.0.2', '2.0.4'):
+    model_ids = set(db.model_ids(groups='dev', protocol=protocol))
+    pairs = db.sample_pairs(20, protocol=protocol, seed=6, by_client=True)
+    assert len(pairs) == 20
+    assert len(set((model_id, probe.id) for model_id, probe in pairs)) == 20
+    assert [(m, p.id) for m, p in pairs] == [(m, p.id) for m, p in db.sample_pairs(20, protocol=protocol, seed=6, by_client=True)]
+    for model_id, probe in pairs:
+      assert model_id in model_ids
+      probes = db.object_sets(groups='dev', purposes='probe', model_ids=model_id) if protocol == '2.0.2' else db.objects(groups='dev', protocol=protocol, purposes='probe', model_ids=model_id)
+      assert probe.id in [p.id for p in probes]
+  # model ids are sampled from the same models that model_ids() returns for the same parameters
+  assert db.sample_model_ids(100000) == sorted(db.model_ids())
+  assert set(db.sample_model_ids(10, groups='dev', protocol='2.0.4', seed=6)) <= set(db.model_ids(groups='dev', protocol='2.0.4'))
+  # all pairs are returned, if the mask contains fewer pairs
+  assert len(db.sample_pairs(1000, protocol='2.0.4', seed=6)) == db.count_comparisons('2.0.4')
+
+
+def test_load_images():
+  # Tests that the images are loaded in the order of the files, and that only few images are loaded ahead
+  import tempfile, shutil, threading
+  db = fixture_database()
+  files = db.objects(groups='world')
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  loaded = []
+  lock = threading.Lock()
+  def loader(path):
+    with lock:
+      loaded.append(path)
+    return os.path.basename(path)
+  try:
+    for index, f in enumerate(files):
+      image = os.path.join(temp_dir, f.path + ('.JPG' if index % 2 else '.jpg'))
+      if not os.path.isdir(os.path.dirname(image)):
+        os.makedirs(os.path.dirname(image))
+      open(image, 'w').close()
+    images = list(db.load_images(files, temp_dir, '.jpg', loader=loader, parallel=3, prefetch=4))
+    assert [f.id for f, image in images] == [f.id for f in files]
+    assert [image for f, image in images] == [os.path.basename(path) for path in db.file_paths(files, temp_dir, '.jpg')]
+    assert sorted(loaded) == sorted(db.file_paths(files, temp_dir, '.jpg'))
+
+    # a consumer that stops early does not load all images
+    del loaded[:]
+    generator = db.load_images(files, temp_dir, '.jpg', loader=loader, parallel=1, prefetch=2)
+    next(generator)
+    generator.close()
+    assert len(loaded) < len(files)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_load_batches():
+  # Tests that loaded batches keep the grouping of the files by client
+  from bob.db.frgc.loader import load_batches
+  batches = [[[bob.db.frgc.File('c%d' % c, 'f%d_%d' % (c, i), 'p%d_%d' % (c, i)) for i in range(c + 1)] for c in range(b, b + 3)] for b in range(0, 9, 3)]
+  loaded = list(load_batches(iter(batches), 'dir', '.png', loader=lambda path: path, parallel=2, prefetch=3))
+  assert [[[f.id for f, image in client] for client in batch] for batch in loaded] == [[[f.id for f in client] for client in batch] for batch in batches]
+  assert all(image == os.path.join('dir', f.path + '.png') for batch in loaded for client in batch for f, image in client)
+
+
+def test_training_batches():
+  # Tests that the training batches contain all training files, grouped by client
+  db = fixture_database()
+  batches = list(db.training_batches(4, seed=7))
+  assert len(batches) > 1
+  assert sorted(f.id for batch in batches for client in batch for f in client) == [f.id for f in db.objects(groups='world')]
+  clients = [client[0].client_id for batch in batches for client in batch]
+  assert sorted(clients) == db.client_ids(groups='world')
+  for batch in batches:
+    assert len(batch) == 1 or sum(len(client) for client in batch) <= 4
+    assert all(f.client_id == client[0].client_id for client in batch for f in client)
+  # the same seed returns the same batches
+  assert [[f.id for client in batch for f in client] for batch in db.training_batches(4, seed=7)] == [[f.id for client in batch for f in client] for batch in batches]
+  # the shards partition the training files
+  sharded = [f.id for i in range(2) for batch in db.training_batches(4, seed=7, shard_index=i, num_shards=2) for client in batch for f in client]
+  assert sorted(sharded) == [f.id for f in db.objects(groups='world')]
+
+
+def test_resolve_paths():
+  # Tests that the bulk resolution of paths agrees with the resolution of single paths
+  import tempfile, shutil
+  from bob.db.frgc.models import resolve_path, resolve_paths
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    os.makedirs(os.path.join(temp_dir, 'a'))
+    for name in ('a/lower.jpg', 'a/upper.JPG', 'a/both.jpg', 'a/both.JPG'):
+      open(os.path.join(temp_dir, name), 'w').close()
+    paths = ['a/lower', 'a/upper', 'a/both', 'a/missing', 'b/missing']
+    for directory, extension in ((temp_dir, '.jpg'), (temp_dir + os.sep, '.jpg'), (None, '.jpg'), (temp_dir, '.png'), (None, None)):
+      assert resolve_paths(paths, directory, extension) == [resolve_path(path, directory, extension) for path in paths]
+    assert resolve_paths(['a/upper'], temp_dir, '.jpg') == [os.path.join(temp_dir, 'a/upper.JPG')]
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_file_paths():
+  # Tests that the paths of whole query results agree with the paths of the single files
+  import tempfile, shutil
+  db = fixture_database()
+  files = db.objects(groups='dev', protocol='2.0.4')
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    # create the images of some files, some of them with capital extension
+    for index, f in enumerate(files[::3]):
+      image = os.path.join(temp_dir, f.path + ('.JPG' if index % 2 else '.jpg'))
+      if not os.path.isdir(os.path.dirname(image)):
+        os.makedirs(os.path.dirname(image))
+      open(image, 'w').close()
+    for directory, extension in ((temp_dir, '.jpg'), (temp_dir, '.png'), (None, None)):
+      assert db.file_paths(files, directory, extension) == [f.make_path(directory, extension) for f in files]
+    assert db.file_paths(files, temp_dir, '.jpg', as_array=True).tolist() == [f.make_path(temp_dir, '.jpg') for f in files]
+    assert db.file_paths(files[3:4], temp_dir, '.jpg') == [os.path.join(temp_dir, files[3].path + '.JPG')]
+  finally:
+    shutil.rmtree(temp_dir)
+